@@ -136,6 +136,7 @@ setup(
     entry_points={
         'console_scripts': [
             'streamcorpus_dump = streamcorpus.dump:main',
+            'streamcorpus_migrate = streamcorpus.migrate:main',
         ]
     },
     install_requires=install_requires
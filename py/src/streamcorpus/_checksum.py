@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+'''
+Checksums that streamcorpus.Chunk can compute over the bytes that it
+reads or writes, selected by Chunk(checksum=name).
+
+md5 is the default, because chunk file names and manifests use it.
+crc32, crc32c and xxhash are much cheaper, and 'none' skips hashing.
+xxhash and crc32c need optional libraries of the same names.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+
+import sys
+import zlib
+import Queue
+import hashlib
+import threading
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+class crc_hash(object):
+    '''
+    hashlib-style object around a crc function(data, value)
+    '''
+    def __init__(self, crc):
+        self._crc = crc
+        self._value = 0
+
+    def update(self, data):
+        self._value = self._crc(data, self._value)
+
+    def hexdigest(self):
+        return '%08x' % (self._value & 0xffffffff)
+
+def _xxhash():
+    if xxhash is None:
+        raise Exception('checksum=%r needs the xxhash library' % 'xxhash')
+    return xxhash.xxh64()
+
+def _crc32c():
+    if crc32c is None:
+        raise Exception('checksum=%r needs the crc32c library' % 'crc32c')
+    return crc_hash(crc32c.crc32)
+
+## map from checksum name to a function that returns a new hash
+## object with update and hexdigest methods
+checksums = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'crc32': lambda: crc_hash(zlib.crc32),
+    'crc32c': _crc32c,
+    'xxhash': _xxhash,
+}
+
+def new_checksum(name, background=False):
+    '''
+    :param name: a key of checksums, or 'none' or None for no
+    checksum, in which case this returns None
+
+    :param background: if True, wrap the hash in a background_hash
+    '''
+    if name is None or name == 'none':
+        return None
+    if name not in checksums:
+        raise ValueError('checksum=%r not in %r' % (name, ['none'] + sorted(checksums)))
+    hasher = checksums[name]()
+    if background:
+        hasher = background_hash(hasher)
+    return hasher
+
+class background_hash(object):
+    '''
+    Feeds a hash object in a thread, so that hashing overlaps with
+    decoding or serializing in the calling thread.  hashlib and the
+    optional libraries release the GIL while hashing large strings.
+    At most max_pending strings wait to be hashed.
+
+    hexdigest and close stop the thread after it has hashed everything
+    passed to update, and a later update starts a new one.  An error
+    in the thread is raised by the next call to update, hexdigest or
+    close, and later updates are discarded.
+    '''
+    def __init__(self, hasher, max_pending=16):
+        self._hasher = hasher
+        self._max_pending = max_pending
+        self._queue = None
+        self._thread = None
+        self._error = None
+
+    def _run(self, queue):
+        while True:
+            data = queue.get()
+            if data is None:
+                return
+            try:
+                if self._error is None:
+                    self._hasher.update(data)
+            except:
+                self._error = sys.exc_info()
+
+    def _raise_error(self):
+        if self._error is not None:
+            exc_type, exc_value, exc_tb = self._error
+            raise exc_type, exc_value, exc_tb
+
+    def update(self, data):
+        self._raise_error()
+        if self._thread is None:
+            self._queue = Queue.Queue(self._max_pending)
+            self._thread = threading.Thread(target=self._run, args=(self._queue,))
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put(data)
+
+    def close(self):
+        'wait for everything passed to update so far, and stop the thread'
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+        self._raise_error()
+
+    def hexdigest(self):
+        self.close()
+        return self._hasher.hexdigest()
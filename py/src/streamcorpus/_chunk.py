@@ -34,27 +34,48 @@ try:
 except:
     lzma = None
 
-import gzip
 import os
+import sys
 import uuid
+import Queue
 import errno
+import mmap
 import shutil
-import hashlib
+import threading
 import subprocess
+import itertools
 import exceptions
 from cStringIO import StringIO
 
 from ttypes import StreamItem as StreamItem_v0_3_0
 from ttypes_v0_1_0 import StreamItem as StreamItem_v0_1_0
 from ttypes_v0_2_0 import StreamItem as StreamItem_v0_2_0
+from _index import ChunkIndex
+from _trailer import ChunkTrailer, TRAILER_HEADER, TRAILER_PREFIX_SIZE, trailer_size
+from _where import Where
+from _checksum import new_checksum
+from _gpg import GpgContext, _default_homedir
+from _codecs import codec_for_path, get_codec, detect_and_open, CodecReadError
 
 class VersionMismatchError(Exception):
     pass
 
+class ChunkTruncatedError(Exception):
+    '''
+    raised when reading a chunk with check_truncation=True finds that
+    it ends part way through a message, or that its compressed stream
+    was cut short
+    '''
+    pass
+
 def serialize(msg):
     '''
     Generate a serialized binary blob for a single message
     '''
+    if not fastbinary_import_failure and msg.thrift_spec is not None:
+        ## what msg.write does with TBinaryProtocolAccelerated, without
+        ## the copy through a transport
+        return fastbinary.encode_binary(msg, (msg.__class__, msg.thrift_spec))
     o_transport = StringIO()
     o_protocol = protocol(o_transport)
     msg.write(o_protocol)
@@ -75,10 +96,15 @@ class md5_file(object):
     '''
     Adapter around a filehandle that wraps .read and .write so that it
     can construct an md5_hexdigest property
+
+    :param checksum: name of the checksum to compute instead of md5,
+    or 'none', in which case md5_hexdigest is None; see _checksum
+
+    :param background: compute the checksum in a thread
     '''
-    def __init__(self, fh):
+    def __init__(self, fh, checksum='md5', background=False):
         self._fh = fh
-        self._md5 = hashlib.md5()
+        self._md5 = new_checksum(checksum, background)
         if hasattr(fh, 'get_value'):
             self.get_value = fh.get_value
         if hasattr(fh, 'seek'):
@@ -87,42 +113,410 @@ class md5_file(object):
             self.mode = fh.mode
         if hasattr(fh, 'flush'):
             self.flush = fh.flush
-        if hasattr(fh, 'close'):
-            self.close = fh.close
+
+    def close_checksum(self):
+        'stop any thread computing the checksum, raising its error'
+        if hasattr(self._md5, 'close'):
+            self._md5.close()
+
+    def close(self):
+        try:
+            self.close_checksum()
+        finally:
+            if hasattr(self._fh, 'close'):
+                self._fh.close()
 
     def read(self, *args, **kwargs):
         data = self._fh.read(*args, **kwargs)
-        self._md5.update(data)
+        if self._md5 is not None:
+            self._md5.update(data)
         return data
 
     def write(self, data, *args, **kwargs):
-        self._md5.update(data)
+        if self._md5 is not None:
+            self._md5.update(data)
         self._fh.write(data, *args, **kwargs)
 
 
     def readAll(self, sz):
         '''
         This method allows TBinaryProtocolAccelerated to actually function.
-
-        Copied from here
-        http://svn.apache.org/repos/asf/hive/trunk/service/lib/py/thrift/transport/TTransport.py
         '''
-        buff = ''
-        have = 0
-        while (have < sz):
-            chunk = self.read(sz-have)
-            have += len(chunk)
-            buff += chunk
+        return read_all(self.read, sz)
+
+
+    @property
+    def md5_hexdigest(self):
+        if self._md5 is None:
+            return None
+        return self._md5.hexdigest()
+
+def read_all(read, sz):
+    '''
+    Call read until it has returned sz bytes in total, like
+    TTransportBase.readAll, but in linear time: a short first read
+    switches to filling a preallocated bytearray, rather than
+    repeatedly concatenating strings.
+
+    :raises EOFError: if read returns no bytes before sz are read
+    '''
+    data = read(sz)
+    if len(data) == sz:
+        return data
+    if not data:
+        raise EOFError()
+    buff = bytearray(sz)
+    have = len(data)
+    buff[:have] = data
+    while have < sz:
+        data = read(sz - have)
+        if not data:
+            raise EOFError('read %d bytes instead of %d' % (have, sz))
+        buff[have:have + len(data)] = data
+        have += len(data)
+    return str(buff)
+
+def _read_up_to(transport, sz):
+    'read sz bytes from transport, or fewer if it ends first'
+    parts = []
+    have = 0
+    while have < sz:
+        data = transport.read(sz - have)
+        if not data:
+            break
+        parts.append(data)
+        have += len(data)
+    return ''.join(parts)
+
+class chunk_transport(TTransport.TTransportBase, TTransport.CReadableTransport):
+    '''
+    Buffered read transport, like TTransport.TBufferedTransport, that
+    also knows the absolute offset of the next byte in the stream.
+    This lets Chunk record where each message starts and ends while
+    decoding.
+
+    Calling mark() makes the transport hold on to every byte from
+    that point onward, so marked() can return the raw bytes of the
+    message that was just decoded.
 
-            if len(chunk) == 0:
+    :param checksum: optional hash object that is updated with every
+    string read from fh, so reading needs no md5_file in between
+    '''
+    DEFAULT_BUFFER = 2**16
+
+    def __init__(self, fh, rbuf_size=DEFAULT_BUFFER, checksum=None):
+        self._fh = fh
+        self._rbuf_size = rbuf_size
+        self._checksum = checksum
+        ## self._data is the string in self._rbuf, and self._base is
+        ## the offset of self._data[0] in the stream
+        self._data = ''
+        self._rbuf = StringIO(self._data)
+        self._base = 0
+        self._mark = None
+
+    def tell(self):
+        'offset of the next byte that will be read'
+        return self._base + self._rbuf.tell()
+
+    def mark(self):
+        'start holding on to bytes from the current offset'
+        self._mark = self.tell()
+
+    def marked(self):
+        'raw bytes read since the last call to mark()'
+        return self._data[self._mark - self._base : self._rbuf.tell()]
+
+    def rewind(self):
+        'go back to the offset of the last call to mark()'
+        self._rbuf.seek(self._mark - self._base)
+
+    def peek(self, sz):
+        'the next sz bytes, or fewer at the end, without reading them'
+        rbuf = self._rbuf
+        pos = rbuf.tell()
+        data = rbuf.read(sz)
+        rbuf.seek(pos)
+        if len(data) == sz:
+            return data
+        start = self._base + pos
+        try:
+            self.cstringio_refill(data, sz)
+        except EOFError:
+            pass
+        self._rbuf.seek(start - self._base)
+        data = self._rbuf.read(sz)
+        self._rbuf.seek(start - self._base)
+        return data
+
+    def read(self, sz):
+        ret = self._rbuf.read(sz)
+        if len(ret) != 0:
+            return ret
+        try:
+            self.cstringio_refill('', sz)
+        except EOFError:
+            return ''
+        return self._rbuf.read(sz)
+
+    # Implement the CReadableTransport interface.
+    @property
+    def cstringio_buf(self):
+        return self._rbuf
+
+    def cstringio_refill(self, partialread, reqlen):
+        ## partialread came from the end of the current buffer
+        pos = len(self._data) - len(partialread)
+        keep = pos
+        if self._mark is not None:
+            keep = min(keep, self._mark - self._base)
+        parts = [self._data[keep:]]
+        have = len(partialread)
+        ## read at least as much as we are keeping, so that holding
+        ## a large marked message does not become quadratic
+        want = max(reqlen - have, self._rbuf_size, len(parts[0]))
+        while True:
+            try:
+                data = self._fh.read(want)
+            except EOFError:
+                ## a decompressor found the end of its input before
+                ## the end of the compressed stream
+                self.stream_truncated = True
+                raise
+            except CodecReadError:
+                ## as when cut short, but a codec that says so with an
+                ## error of its own, which Chunk raises again unless it
+                ## is checking for truncation
+                self.stream_truncated = True
+                self.stream_error = sys.exc_info()
+                raise EOFError()
+            if not data:
+                ## keep what was read, so that marked() returns
+                ## everything up to the end of the stream
+                self._base += keep
+                self._data = ''.join(parts)
+                self._rbuf = StringIO(self._data)
+                self._rbuf.seek(len(self._data))
                 raise EOFError()
+            if self._checksum is not None:
+                self._checksum.update(data)
+            parts.append(data)
+            have += len(data)
+            if have >= reqlen:
+                break
+            want = reqlen - have
+        self._base += keep
+        self._data = ''.join(parts)
+        self._rbuf = StringIO(self._data)
+        self._rbuf.seek(pos - keep)
+        return self._rbuf
+
+class mmap_transport(TTransport.TTransportBase, TTransport.CReadableTransport):
+    '''
+    Read transport over the whole of a memory-mapped file.  The
+    cStringIO buffer that fastbinary decodes from points directly at
+    the mapped pages, so bytes are never copied on their way to the
+    decoder, and processes that map the same file share its pages.
+
+    Provides the same tell(), mark(), marked() and peek() as
+    chunk_transport.
+    '''
+    def __init__(self, mapped):
+        self._mapped = mapped
+        self._rbuf = StringIO(mapped)
+        self._mark = None
+
+    def tell(self):
+        return self._rbuf.tell()
+
+    def mark(self):
+        self._mark = self._rbuf.tell()
 
-        return buff
+    def marked(self):
+        return self._mapped[self._mark : self._rbuf.tell()]
 
+    def rewind(self):
+        self._rbuf.seek(self._mark)
+
+    def peek(self, sz):
+        pos = self._rbuf.tell()
+        return self._mapped[pos : pos + sz]
+
+    def read(self, sz):
+        return self._rbuf.read(sz)
 
     @property
-    def md5_hexdigest(self):
-        return self._md5.hexdigest()
+    def cstringio_buf(self):
+        return self._rbuf
+
+    def cstringio_refill(self, partialread, reqlen):
+        ## the whole file is already in the buffer
+        raise EOFError()
+
+class write_buffer(object):
+    '''
+    Output transport for Chunk that collects whole serialized
+    messages and passes them on to fh in one write once size bytes
+    are pending, or when flushed.  Unlike TTransport.TBufferedTransport,
+    which holds everything until it is flushed, memory use is bounded,
+    and since every write is made of whole messages, writers that are
+    message_aligned see message boundaries between writes.
+    '''
+    def __init__(self, fh, size=2**20):
+        self._fh = fh
+        self._size = size
+        self._parts = []
+        self._pending = 0
+
+    def write(self, data):
+        self._parts.append(data)
+        self._pending += len(data)
+        if self._pending >= self._size:
+            self._write_out()
+
+    def _write_out(self):
+        if not self._parts:
+            return
+        if len(self._parts) == 1:
+            data = self._parts[0]
+        else:
+            data = ''.join(self._parts)
+        self._parts = []
+        self._pending = 0
+        self._fh.write(data)
+
+    def flush(self):
+        self._write_out()
+        if hasattr(self._fh, 'flush'):
+            self._fh.flush()
+
+class background_writer(object):
+    '''
+    Passes writes on to fh in a thread, so that compressing and
+    writing a chunk overlaps with serializing messages in the calling
+    thread.  At most max_pending writes wait in the queue, after which
+    write blocks.  An error in the thread is raised by the next call
+    to write, flush or close, and later writes are discarded.
+    '''
+    def __init__(self, fh, max_pending=16):
+        self._fh = fh
+        self._queue = Queue.Queue(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            try:
+                if data is None:
+                    return
+                if self._error is None:
+                    self._fh.write(data)
+            except:
+                self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            exc_type, exc_value, exc_tb = self._error
+            raise exc_type, exc_value, exc_tb
+
+    def write(self, data):
+        self._raise_error()
+        self._queue.put(data)
+
+    def flush(self):
+        ## wait for everything written so far
+        self._queue.join()
+        self._raise_error()
+        if hasattr(self._fh, 'flush'):
+            self._fh.flush()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        try:
+            self._raise_error()
+        finally:
+            if hasattr(self._fh, 'close'):
+                self._fh.close()
+
+def project_thrift_spec(thrift_spec, fields):
+    '''
+    Construct a thrift_spec that only includes the named fields, so
+    that decoding with it skips over every other field in the binary
+    protocol without constructing it.
+
+    :param fields: list of field names; a dotted path, such as
+    'body.clean_visible', projects the fields of a nested struct.  A
+    name without a path, such as 'body', keeps the whole field.
+
+    :raises ValueError: if a field is not in thrift_spec
+    '''
+    ## map from field name to list of sub-paths, or None for the
+    ## whole field
+    wanted = {}
+    for field in fields:
+        name, _, rest = field.lstrip('.').partition('.')
+        if not rest:
+            wanted[name] = None
+        elif wanted.get(name, []) is not None:
+            wanted.setdefault(name, []).append(rest)
+
+    names = set(spec[2] for spec in thrift_spec if spec is not None)
+    for name in wanted:
+        if name not in names:
+            raise ValueError('no field %r in thrift_spec with %r' % (name, sorted(names)))
+
+    projected = []
+    for spec in thrift_spec:
+        if spec is None or spec[2] not in wanted:
+            projected.append(None)
+        elif wanted[spec[2]] is None:
+            projected.append(spec)
+        elif spec[1] != Thrift.TType.STRUCT:
+            raise ValueError('cannot project %r inside non-struct field %r' % (
+                    wanted[spec[2]], spec[2]))
+        else:
+            fid, ftype, name, (cls, cls_spec), default = spec
+            projected.append((fid, ftype, name,
+                              (cls, project_thrift_spec(cls_spec, wanted[name])),
+                              default))
+    return tuple(projected)
+
+def _decode(msg, i_protocol, thrift_spec=None):
+    '''
+    read msg from i_protocol, optionally using a thrift_spec that
+    differs from msg.thrift_spec, in which case any field missing from
+    thrift_spec is skipped without being constructed.
+    '''
+    if thrift_spec is None:
+        msg.read(i_protocol)
+    elif isinstance(i_protocol, TBinaryProtocolAccelerated) and not fastbinary_import_failure:
+        fastbinary.decode_binary(msg, i_protocol.trans, (msg.__class__, thrift_spec))
+    else:
+        i_protocol.readStruct(msg, thrift_spec)
+
+def _decoder(i_protocol, message, thrift_spec=None):
+    '''
+    function that reads one message from i_protocol into the instance
+    of message passed to it, making the choices in _decode once
+    rather than for every message
+    '''
+    if thrift_spec is None:
+        thrift_spec = message.thrift_spec
+    if isinstance(i_protocol, TBinaryProtocolAccelerated) and not fastbinary_import_failure:
+        decode_binary = fastbinary.decode_binary
+        i_transport = i_protocol.trans
+        spec = (message, thrift_spec)
+        return lambda msg: decode_binary(msg, i_transport, spec)
+    return lambda msg: i_protocol.readStruct(msg, thrift_spec)
 
 class Chunk(object):
     '''
@@ -131,6 +525,14 @@ class Chunk(object):
     def __init__(self, path=None, data=None, file_obj=None, mode='rb',
                  message=StreamItem_v0_3_0,
                  read_wrapper=None, write_wrapper=None,
+                 index=False, fields=None, lazy=False,
+                 compression=None, compression_level=None,
+                 compression_threads=1, compression_block_size=2**24,
+                 memory_map=False, checksum='md5', checksum_thread=False,
+                 verify_version=True, upgrade=False,
+                 write_buffer_size=2**20, write_thread=False,
+                 atomic=False, fsync=False, check_truncation=False,
+                 trailer=False, gpg=None, where=None,
         ):
         '''Load a chunk from an existing file handle or buffer of data.
         If no data is passed in, then chunk starts as empty and
@@ -140,9 +542,10 @@ class Chunk(object):
         open.
 
         :param path: path to a file in the local file system.  If path
-        ends in .xz then mode must be 'rb' and the entire file is
-        loaded into memory and decompressed before the Chunk is ready
-        for reading.
+        ends in the extension of a compression codec, such as .xz,
+        .gz, .zst or .lz4, then mode must be 'rb' or the file must not
+        exist yet, and the file is decompressed as it is read or
+        compressed as it is written.
 
         :param mode: read/write mode for opening the file; if
         mode='wb', then a file will be created.
@@ -153,7 +556,9 @@ class Chunk(object):
         :param data: bytes of data from which to read messages
 
         :param message: defaults to StreamItem_v0_3_0; you can specify
-        your own Thrift-generated class here.
+        your own Thrift-generated class here.  'auto' reads the version
+        of the first message and uses StreamItem_v0_1_0, v0_2_0 or
+        v0_3_0 to match.
 
         :param read_wrapper: a function that takes a deserialized
         message as input and returns a new object to yield from
@@ -162,6 +567,121 @@ class Chunk(object):
         :param write_wrapper: a function used in Chunk.add(obj) that
         takes the added object as input and returns another object
         that is a thrift class that can be serialized.
+
+        :param index: if True and path is specified, maintain a
+        sidecar ChunkIndex file next to the chunk.  When writing, the
+        offset of every added message is recorded and the sidecar is
+        written by Chunk.close.  When reading, an index built by
+        Chunk.get or Chunk.index is saved as a sidecar, if one did not
+        already exist.
+
+        :param fields: list of field names, or dotted paths such as
+        'body.clean_visible', to decode from each message.  All other
+        fields are skipped over in the binary protocol and left with
+        their default values on the messages yielded by __iter__ and
+        returned by Chunk.get.  The version field is always decoded.
+
+        :param lazy: if True, __iter__ and Chunk.get return lazy
+        subclasses of message that hold the serialized bytes and
+        decode containers and large structs, such as body,
+        other_content and body.sentences, only when they are first
+        accessed.  Cannot be combined with fields.
+
+        :param compression: name of the codec, such as 'zstd' or
+        'none', to use for path instead of the one chosen by its
+        extension; see streamcorpus.get_codec.  When reading data or
+        file_obj, the codec is detected from the magic bytes at the
+        start of the stream, including gpg around xz, unless
+        compression is given.  When writing to file_obj, the output
+        is compressed only if compression is given.  'xzcat' reads and
+        writes .xz through xzcat and xz child processes even if
+        backports.lzma is installed.
+
+        :param compression_level: codec-specific level for writing,
+        e.g. 1 through 22 for zstd or 0 through 9 for xz and gzip;
+        None uses the default of the codec
+
+        :param compression_threads: number of threads for the codec.
+        Reading an .xz file written with more than one block
+        decompresses blocks in parallel.  Writing .xz compresses
+        blocks of about compression_block_size uncompressed bytes in
+        parallel, and blocks end on message boundaries.  Writing .zst
+        compresses in zstd's own threads.
+
+        :param memory_map: if True and path is an uncompressed chunk
+        opened with mode='rb', map the file into memory and decode
+        messages directly from the mapped pages.  md5_hexdigest is
+        then computed over the whole file when it is first asked for,
+        rather than while reading.
+
+        :param checksum: checksum of the bytes read or written, which
+        is 'md5' by default and available as md5_hexdigest.  'none'
+        skips hashing, and 'crc32', 'crc32c' or 'xxhash' are much
+        cheaper than md5; their digests are available as
+        checksum_hexdigest, and md5_hexdigest is None.
+
+        :param checksum_thread: if True, compute the checksum in a
+        background thread, overlapping with encoding or decoding
+
+        :param verify_version: if False, do not check the version
+        field of each message read against the default version of
+        message, and do not decode it when reading only some fields.
+        For pipelines that already know what their chunks contain.
+
+        :param upgrade: if True, __iter__ and Chunk.get convert
+        StreamItems of older versions to StreamItem_v0_3_0 as they are
+        read; see streamcorpus.upgrade_stream_item.  v0_2_0 messages
+        are decoded directly into the v0_3_0 classes.  fields applies
+        to v0_2_0 and v0_3_0 chunks, and is ignored for v0_1_0.
+        iter_raw still yields the stored bytes.
+
+        :param write_buffer_size: when writing, serialized messages
+        are collected until this many bytes are pending and then
+        passed to the file, or its compressor, in a single write
+
+        :param write_thread: if True, compress and write the output in
+        a background thread, so that Chunk.add returns once a message
+        is serialized and queued.  Chunk.close waits for the thread,
+        and raises any error that it had.  The checksum is computed in
+        the thread too, so checksum_hexdigest is only current after
+        Chunk.flush or Chunk.close.
+
+        :param atomic: if True, with a path and mode='wb', write to a
+        temporary file in the same directory and rename it to path in
+        Chunk.close, so that path only ever holds a complete chunk.
+        Leaving a with block by an exception removes the temporary
+        file instead.
+
+        :param fsync: if True, with atomic=True, flush the chunk to
+        disk before renaming it, and the directory after
+
+        :param check_truncation: if True, __iter__ and iter_raw raise
+        ChunkTruncatedError if the chunk ends part way through a
+        message, or the codec fails to read the compressed stream to
+        its end, as when it was cut short, rather than stopping quietly
+        at the last complete message, or raising whatever error the
+        codec raised
+
+        :param trailer: if True, Chunk.close writes a ChunkTrailer
+        after the last message, with the number of messages, their
+        offsets, the range of their stream_times and the checksum of
+        their bytes.  Readers that do not know about trailers stop in
+        front of it.  When reading, see Chunk.trailer.
+
+        :param gpg: a GpgContext for decrypting, or encrypting, the
+        chunk through a gpg child process.  A path ending in .gpg is
+        decompressed or compressed according to the extension before
+        .gpg, e.g. .sc.xz.gpg.  data and file_obj are decrypted when
+        reading, and then compression is detected as usual, and are
+        encrypted when writing, after compressing them if compression
+        is given.
+
+        :param where: a Where, or a dict of arguments for one, that
+        __iter__ and iter_raw test each message against after decoding
+        only the fields that it needs.  Messages that do not match are
+        skipped without decoding anything else.  If the chunk has a
+        trailer, and its range of stream_times does not overlap the
+        times in where, no message is read at all.
         '''
         if not fastbinary_import_failure:
             logger.debug('using TBinaryProtocolAccelerated (fastbinary)')
@@ -177,21 +697,53 @@ class Chunk(object):
         assert mode in allowed_modes, 'mode=%r not in %r' % (mode, allowed_modes)
         self.mode = mode
 
-        ## class for constructing messages when reading
-        self.message = message
+        self._fields = fields
+        if isinstance(where, dict):
+            where = Where(**where)
+        self.where = where
+        self._verify_version = verify_version
+        self._upgrade = upgrade
+        self._lazy = lazy
+        if lazy:
+            assert fields is None, 'cannot combine lazy=True with fields'
+            assert not upgrade, 'cannot combine lazy=True with upgrade'
+
+        if message == 'auto' and mode == 'rb':
+            ## resolved from the first message by _input_protocol
+            self.message = None
+        else:
+            if message == 'auto':
+                message = StreamItem_v0_3_0
+            self._set_message(message)
+
+        self.path = path
+        self._gpg = gpg
+        self._tmp_path = None
+        self._fsync = fsync
+        self._check_truncation = check_truncation
+        self._save_index = bool(index and path is not None)
+        self._index = None
 
         ## initialize internal state before figuring out what data we
         ## are acting on
         self._count = 0
-        self._md5_hexdigest = None
+        self.checksum = checksum
+        self._checksum_thread = checksum_thread
+        self._checksum_hexdigest = None
+        self._trailer = None
+        self._trailer_checked = False
 
         ## might not have any output parts
         self._o_chunk_fh = None
         self._o_transport = None
         self._o_protocol = None
+        self._o_writer = None
+        self._o_trailer = None
+        self._o_trailer_partial = False
 
         ## might not have any input parts
         self._i_chunk_fh = None
+        self._mmap = None
         self._i_transport = None
         self._i_protocol = None
 
@@ -199,35 +751,38 @@ class Chunk(object):
         if path is not None:
             assert data is None and file_obj is None, \
                 'Must specify only path or data or file_obj'
+            if compression is None:
+                codec = codec_for_path(path)
+            else:
+                codec = get_codec(compression)
             if os.path.exists(path):
                 ## if the file is there, then use mode 
                 if mode not in ['rb', 'ab']:
                     exc = IOError('mode=%r would overwrite existing %s' % (mode, path))
                     exc.errno = errno.EEXIST
                     raise exc
-                if path.endswith('.xz'):
-                    assert mode == 'rb', 'mode=%r for .xz' % mode
-                    ## launch xz child
-                    xz_child = subprocess.Popen(
-                        ['xzcat', path],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE)
-                    file_obj = xz_child.stdout
-                    ## what to do with stderr
-                elif path.endswith('.gz'):
-                    assert mode == 'rb', 'mode=%r for .gz' % mode
-                    file_obj  = gzip.open(path)
+                if path.endswith('.gpg') and gpg is not None:
+                    assert mode == 'rb', 'mode=%r for .gpg' % mode
+                    file_obj = gpg.decrypt_reader(open(path, 'rb'))
+                    codec = _inner_codec(path, compression)
+                    if codec is not None:
+                        file_obj = codec.reader(file_obj, threads=compression_threads)
                 elif path.endswith('.xz.gpg'):
-                    assert mode == 'rb', 'mode=%r for .xz' % mode
-                    ## launch xz child
-                    xz_child = subprocess.Popen(
-                        ['gpg -d %s | xz --decompress' % path],
-                        stdout=subprocess.PIPE, shell=True)
-                        #stderr=subprocess.PIPE)
-                    file_obj = xz_child.stdout
-                    ## what to do with stderr?
+                    assert mode == 'rb', 'mode=%r for .xz.gpg' % mode
+                    ## decrypt with the keys of the user running the
+                    ## process
+                    file_obj = decrypt_and_uncompress_file(
+                        open(path, 'rb'), gpg=GpgContext(homedir=_default_homedir()),
+                        threads=compression_threads)
+                elif codec is not None:
+                    assert mode == 'rb', 'mode=%r for %s' % (mode, codec.name)
+                    file_obj = codec.reader(open(path, 'rb'), threads=compression_threads)
                 else:
                     file_obj = open(path, mode)
+                    if memory_map and mode == 'rb':
+                        self._mmap = _map_file(file_obj)
+                    if mode == 'ab':
+                        self._strip_trailer(file_obj)
             else:
                 ## otherwise make one for writing
                 if mode not in ['wb', 'ab']:
@@ -237,14 +792,23 @@ class Chunk(object):
                 dirname = os.path.dirname(path)
                 if dirname and not os.path.exists(dirname):
                     os.makedirs(dirname)
-                if path.endswith('.gz'):
-                    file_obj = gzip.open(path, mode)
-                elif path.endswith('.xz'):
-                    if lzma is None:
-                        raise Exception('file extension is .xz but backports.lzma is not installed')
-                    file_obj = lzma.open(path, mode)
-                else:
-                    file_obj = open(path, mode)
+                o_path = path
+                if atomic:
+                    assert mode == 'wb', 'atomic=True needs mode=\'wb\', not %r' % mode
+                    ## in the same directory, so that renaming is atomic
+                    self._tmp_path = o_path = os.path.join(
+                        dirname, '.%s.%s.tmp' % (os.path.basename(path), uuid.uuid4().hex))
+                file_obj = open(o_path, mode)
+                if path.endswith('.gpg'):
+                    if gpg is None:
+                        raise Exception('writing %s needs gpg=GpgContext(...)' % path)
+                    file_obj = gpg.encrypt_writer(file_obj)
+                    codec = _inner_codec(path, compression)
+                if codec is not None:
+                    file_obj = codec.writer(
+                        file_obj, mode, level=compression_level,
+                        threads=compression_threads,
+                        block_size=compression_block_size)
 
         ## if created without any arguments, then prepare to add
         ## messages to an in-memory file object
@@ -261,6 +825,10 @@ class Chunk(object):
                 file_obj = StringIO(data)
                 file_obj.seek(0)
             elif mode == 'ab':
+                self._trailer = ChunkTrailer.from_data(data)
+                if self._trailer is not None:
+                    ## new messages go where the trailer was
+                    data = data[:self._trailer.end_offset]
                 file_obj = StringIO()
                 file_obj.write(data)
                 ## and let it just keep writing to it
@@ -279,32 +847,240 @@ class Chunk(object):
             ## use the file object for writing out the data as it
             ## happens, i.e. in streaming mode.
 
+        if path is None and gpg is not None:
+            if mode == 'rb':
+                file_obj = gpg.decrypt_reader(file_obj)
+            elif data is None:
+                file_obj = gpg.encrypt_writer(file_obj)
+
+        if path is None and (data is not None or file_obj is not None):
+            ## data and file_obj have no extension, so use the magic
+            ## bytes at the start of the stream, unless told the codec
+            if compression is not None:
+                codec = get_codec(compression)
+                if codec is not None and mode == 'rb':
+                    file_obj = codec.reader(file_obj, threads=compression_threads)
+                elif codec is not None and data is None:
+                    file_obj = codec.writer(
+                        file_obj, mode, level=compression_level,
+                        threads=compression_threads,
+                        block_size=compression_block_size)
+            elif mode == 'rb':
+                file_obj = detect_and_open(file_obj, threads=compression_threads)
+
         if mode in ['ab', 'wb']:
-            self._o_chunk_fh = md5_file( file_obj )
-            self._o_transport = TTransport.TBufferedTransport(self._o_chunk_fh)
+            self._o_offset = 0
+            if index:
+                self._index = ChunkIndex()
+                if mode == 'ab':
+                    self._extend_index(path, data)
+            ## trailer to write in close
+            if trailer:
+                self._o_trailer = ChunkTrailer()
+                if mode == 'ab':
+                    self._extend_trailer(path, data)
+            self._o_chunk_fh = md5_file( file_obj, checksum, checksum_thread )
+            if getattr(file_obj, 'message_aligned', False):
+                ## the writer cuts blocks between writes, so do not
+                ## write more than a block at a time
+                write_buffer_size = min(write_buffer_size, compression_block_size)
+            o_fh = self._o_chunk_fh
+            if write_thread:
+                self._o_writer = o_fh = background_writer(self._o_chunk_fh)
+            self._o_transport = write_buffer(o_fh, write_buffer_size)
             self._o_protocol = protocol(self._o_transport)
 
         else:
             assert mode == 'rb', mode
-            self._i_chunk_fh = md5_file( file_obj )
+            self._i_chunk_fh = md5_file( file_obj, checksum, checksum_thread )
             #_i_transport and _i_protocol are set below in __iter__
 
+    def _set_message(self, message):
+        '''
+        Set self.message and everything derived from it for decoding
+        messages of that class.
+        '''
+        ## thrift_spec of the stored messages, and function applied
+        ## to each one after decoding
+        base_spec = message.thrift_spec
+        self._post = None
+        stored = message
+        if self._upgrade and message is StreamItem_v0_2_0:
+            from _upgrade import v0_2_0_thrift_spec, fix_v0_2_0
+            message = StreamItem_v0_3_0
+            base_spec = v0_2_0_thrift_spec
+            self._post = fix_v0_2_0
+        elif self._upgrade and message is StreamItem_v0_1_0:
+            from _upgrade import upgrade_v0_1_0
+            self._post = upgrade_v0_1_0
+
+        ## class for constructing messages when reading
+        self.message = message
+        self._base_spec = base_spec
+
+        ## version that every message read must have, or None to
+        ## skip the check; resolved once rather than per message
+        self._version = None
+        if self._verify_version:
+            self._version = getattr(stored(), 'version', None)
+
+        ## thrift_spec to use when decoding, if not message.thrift_spec
+        self._thrift_spec = None
+        if base_spec is not message.thrift_spec:
+            self._thrift_spec = base_spec
+        if self._fields is not None and not (self._upgrade and stored is StreamItem_v0_1_0):
+            fields = list(self._fields)
+            if self._version is not None:
+                fields.append('version')
+            self._thrift_spec = project_thrift_spec(base_spec, fields)
+        if self._lazy:
+            ## _lazy imports from this module
+            from _lazy import lazy_thrift_spec
+            self._thrift_spec = lazy_thrift_spec(message)
+
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        self.close()
+        if type is not None and self._tmp_path is not None:
+            ## do not put an incomplete chunk at path
+            self._discard()
+        else:
+            self.close()
+
+    def _discard(self):
+        '''
+        close the temporary file of an atomic write without renaming
+        it to path, and remove it
+        '''
+        tmp_path = self._tmp_path
+        ## so that close does not rename it
+        self._tmp_path = None
+        try:
+            self.close()
+        except Exception, exc:
+            logger.warn('failed to close %s: %r', tmp_path, exc)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    def _extend_index(self, path, data):
+        '''
+        when appending with index=True, start from the index of the
+        messages that are already in the chunk
+        '''
+        if path is not None and os.path.exists(path):
+            self._index = Chunk(path=path, mode='rb', message=self.message).index
+        elif data is not None:
+            self._index = Chunk(data=data, mode='rb', message=self.message).index
+        self._o_offset = self._index.end_offset
+
+    def _strip_trailer(self, fh):
+        '''
+        when appending to a chunk file that ends with a trailer,
+        truncate the trailer, which is rewritten by close if
+        trailer=True
+        '''
+        with open(fh.name, 'rb') as i_fh:
+            self._trailer = ChunkTrailer.from_file(i_fh)
+        if self._trailer is not None:
+            fh.truncate(self._trailer.end_offset)
+
+    def _extend_trailer(self, path, data):
+        '''
+        when appending with trailer=True, start from the trailer of
+        the chunk, or by scanning the messages that are already in it.
+        The checksum of the new trailer only covers the appended
+        bytes, so it is left out.
+        '''
+        old = self._trailer
+        if old is None and (data or (path is not None and os.path.exists(path))):
+            old = ChunkTrailer()
+            if path is not None:
+                i_chunk = Chunk(path=path, mode='rb', message=self.message)
+            else:
+                i_chunk = Chunk(data=data, mode='rb', message=self.message)
+            offset = 0
+            for msg, blob in i_chunk.iter_raw(fields=['stream_time']):
+                old.add(offset, len(blob), _epoch_ticks(msg))
+                offset += len(blob)
+        if old is not None:
+            old.checksum = old.hexdigest = None
+            self._o_trailer = old
+            self._o_offset = old.end_offset
+        self._o_trailer_partial = old is not None
 
     def add(self, msg):
         'add message instance to chunk'
         assert self._o_protocol, 'cannot add to a Chunk instantiated with data'
         assert self._o_chunk_fh is not None, 'cannot Chunk.add after Chunk.close'
+        self._o_transport.write(self._serialize(msg))
+        self._count += 1
+
+    def add_many(self, msgs):
+        '''
+        add every message instance in the iterable msgs to the chunk.
+        Messages are serialized into batches of about
+        write_buffer_size bytes, and each batch is written out with
+        a single write.
+        '''
+        assert self._o_protocol, 'cannot add to a Chunk instantiated with data'
+        assert self._o_chunk_fh is not None, 'cannot Chunk.add after Chunk.close'
+        serialize = self._serialize
+        write = self._o_transport.write
+        count = 0
+        try:
+            for msg in msgs:
+                write(serialize(msg))
+                count += 1
+        finally:
+            self._count += count
+
+    ## like list.extend
+    extend = add_many
+
+    def _serialize(self, msg):
+        '''
+        apply write_wrapper to msg, check its type, and record it in
+        the index, if there is one
+
+        :returns: serialized bytes of msg
+        '''
         if self.write_wrapper is not None:
             msg = self.write_wrapper(msg)
         if not (isinstance(msg, self.message) or (type(msg) == self.message)):
             raise VersionMismatchError(
                 'mismatched type: %s != %s' % (type(msg), self.message))
-        msg.write(self._o_protocol)
+        blob = serialize(msg)
+        if self._index is not None:
+            self._index.add(self._o_offset, len(blob),
+                            getattr(msg, 'stream_id', None),
+                            getattr(msg, 'doc_id', None))
+        if self._o_trailer is not None:
+            self._o_trailer.add(self._o_offset, len(blob), _epoch_ticks(msg))
+        self._o_offset += len(blob)
+        return blob
+
+    def add_raw(self, blob):
+        '''
+        add the serialized bytes of one message to the chunk, such as
+        those yielded by Chunk.iter_raw, without decoding them.  The
+        bytes are not checked against self.message.
+        '''
+        assert self._o_protocol, 'cannot add to a Chunk instantiated with data'
+        assert self._o_chunk_fh is not None, 'cannot Chunk.add after Chunk.close'
+        self._o_transport.write(blob)
+        if self._index is not None or self._o_trailer is not None:
+            ids = self.message()
+            _decode(ids, protocol(TTransport.TMemoryBuffer(blob)),
+                    project_thrift_spec(self.message.thrift_spec,
+                                        ['stream_id', 'doc_id', 'stream_time']))
+            if self._index is not None:
+                self._index.add(self._o_offset, len(blob),
+                                getattr(ids, 'stream_id', None),
+                                getattr(ids, 'doc_id', None))
+            if self._o_trailer is not None:
+                self._o_trailer.add(self._o_offset, len(blob), _epoch_ticks(ids))
+        self._o_offset += len(blob)
         self._count += 1
 
     def flush(self):
@@ -314,19 +1090,123 @@ class Chunk(object):
     def close(self):
         '''
         Close any chunk file that we might have had open for writing.
+        With atomic=True, this renames the temporary file to path,
+        unless it failed to write everything.
         '''
         if self._o_chunk_fh is not None:
+            try:
+                if self._o_trailer is not None:
+                    self._write_trailer()
+                if self._o_writer is not None:
+                    ## waits for the writer thread, which closes the
+                    ## file even if it failed
+                    try:
+                        self._o_transport.flush()
+                    finally:
+                        self._o_writer.close()
+                else:
+                    self._o_transport.flush()
+                    self._o_chunk_fh.close()
+            except:
+                ## never rename an incomplete chunk to path
+                if self._tmp_path is not None:
+                    os.remove(self._tmp_path)
+                    self._tmp_path = None
+                raise
+            finally:
+                ## make this method idempotent
+                self._checksum_hexdigest = self._o_chunk_fh.md5_hexdigest
+                self._o_chunk_fh = None
+            if self._tmp_path is not None:
+                self._rename_tmp()
+            if self._save_index:
+                self._index.save(self.path)
+        if self._i_chunk_fh is not None and self.path is None:
+            self._i_chunk_fh.close_checksum()
+        if self._i_chunk_fh is not None and self.path is not None:
+            ## we opened it, so close it, which also reaps any
+            ## decompression child process and checksum thread
+            self._i_chunk_fh.close()
+            ## never unmap explicitly: the buffers of transports made
+            ## by __iter__ point straight into the mapped pages, and a
+            ## generator may still be reading from them.  The map is
+            ## released when the last reference to it is gone.
+            self._mmap = None
+
+    def _write_trailer(self):
+        trailer = self._o_trailer
+        self._o_trailer = None
+        if not self._o_trailer_partial:
+            ## wait for the checksum to cover every message
             self._o_transport.flush()
-            self._o_chunk_fh.close()
-            ## make this method idempotent
-            self._md5_hexdigest = self._o_chunk_fh.md5_hexdigest
-            self._o_chunk_fh = None
+            trailer.hexdigest = self._o_chunk_fh.md5_hexdigest
+            if trailer.hexdigest is not None:
+                trailer.checksum = self.checksum
+        self._o_transport.write(trailer.dumps())
+
+    @property
+    def end_offset(self):
+        '''
+        when writing, the offset after the last message added, which
+        is the number of uncompressed bytes in the chunk so far
+        '''
+        return self._o_offset
+
+    @property
+    def trailer(self):
+        '''
+        ChunkTrailer at the end of this chunk, or None if it was
+        written without one, or if it only covers the last of several
+        chunks that were concatenated.  For an uncompressed chunk file or data,
+        this is read from the end without decoding any messages.  For
+        compressed or streamed chunks, it is only known once __iter__
+        or iter_raw with check_truncation=True has reached the end.
+        '''
+        if self._trailer is None and not self._trailer_checked and self.mode == 'rb':
+            self._trailer_checked = True
+            if self._mmap is not None:
+                self._trailer = ChunkTrailer.from_data(self._mmap)
+            else:
+                fh = self._i_chunk_fh._fh
+                if isinstance(fh, file) or hasattr(fh, 'getvalue'):
+                    try:
+                        self._trailer = ChunkTrailer.from_file(fh)
+                    except IOError:
+                        ## a pipe
+                        pass
+        return self._trailer
+
+    def _rename_tmp(self):
+        'finish an atomic write by renaming the temporary file to path'
+        if self._fsync:
+            _fsync_path(self._tmp_path)
+        os.rename(self._tmp_path, self.path)
+        self._tmp_path = None
+        if self._fsync:
+            ## make the rename itself durable
+            _fsync_path(os.path.dirname(self.path) or '.')
 
     @property
     def md5_hexdigest(self):
-        if self._md5_hexdigest:
+        if self.checksum != 'md5':
+            return None
+        return self.checksum_hexdigest
+
+    @property
+    def checksum_hexdigest(self):
+        '''
+        hex digest of the bytes read or written so far, using the
+        checksum passed to Chunk, or None if checksum='none'
+        '''
+        if self._checksum_hexdigest:
             ## only set if closed already
-            return self._md5_hexdigest
+            return self._checksum_hexdigest
+        if self._mmap is not None:
+            hasher = new_checksum(self.checksum)
+            if hasher is not None:
+                hasher.update(self._mmap)
+                self._checksum_hexdigest = hasher.hexdigest()
+            return self._checksum_hexdigest
         if self._o_chunk_fh:
             ## get it directly from the output chunk
             return self._o_chunk_fh.md5_hexdigest
@@ -345,11 +1225,14 @@ class Chunk(object):
 
     def __len__(self):
         ## how to make this pythonic given that we have __iter__?
+        if self.mode == 'rb' and self.where is None and self.trailer is not None:
+            return len(self.trailer)
         return self._count
 
-    def __iter__(self):
+    def _input_protocol(self):
         '''
-        Iterator over messages in the chunk
+        construct a thrift protocol for reading messages from the
+        start of the input
         '''
         assert self._i_chunk_fh, 'cannot iterate over a Chunk open for writing'
 
@@ -363,83 +1246,518 @@ class Chunk(object):
                 ## just assume that it is a pipe like stdin that need
                 ## not be seeked to start
 
-        ## wrap the file handle in buffered transport
-        i_transport = TTransport.TBufferedTransport(self._i_chunk_fh)
-        ## use the Thrift Binary Protocol
-        i_protocol = protocol(i_transport)
+        if self._mmap is not None:
+            i_protocol = protocol(mmap_transport(self._mmap))
+        else:
+            ## wrap the file handle in a buffered transport that
+            ## tracks offsets and feeds the checksum of md5_file, and
+            ## use the Thrift Binary Protocol
+            i_protocol = protocol(chunk_transport(self._i_chunk_fh._fh,
+                                                  checksum=self._i_chunk_fh._md5))
+        if self.message is None:
+            from _upgrade import sniff_message
+            self._set_message(sniff_message(i_protocol) or StreamItem_v0_3_0)
+        return i_protocol
+
+    def __iter__(self):
+        '''
+        Iterator over messages in the chunk
+        '''
+        i_protocol = self._input_protocol()
+        i_transport = i_protocol.trans
+        if self._lazy:
+            from _lazy import from_decoded
+
+        ## resolve everything that is the same for every message
+        message = self.message
+        decode = _decoder(i_protocol, message, self._thrift_spec)
+        version = self._version
+        lazy = self._lazy
+        post = self._post
+        read_wrapper = self.read_wrapper
+        check_truncation = self._check_truncation
+        where = self.where
+        if where is not None:
+            if self._skip_by_trailer():
+                return
+            decode_where = self._where_decoder(i_protocol)
+
+        ## messages read in this pass, including any that where
+        ## rejects, which are not counted in self._count
+        read = 0
+        ## offset and value of read where the messages covered by the
+        ## next trailer start
+        segment = [i_transport.tell(), 0]
+        peek = i_transport.peek
 
         ## read message instances until input buffer is exhausted
         while 1:
 
+            if peek(len(TRAILER_HEADER)) == TRAILER_HEADER:
+                self._read_trailer(i_transport, segment, read)
+                continue
+
             ## instantiate a message  instance 
-            msg = self.message()
+            msg = message()
+
+            if lazy or check_truncation or where is not None:
+                ## keep the bytes of the message
+                i_transport.mark()
 
+            ## read it from the thrift protocol instance
             try:
-                ## read it from the thrift protocol instance
-                msg.read(i_protocol)
-
-                if hasattr(msg, 'version'):
-                    ## compare the read version to the default version
-                    ## value on the identified message
-                    if not (msg.version == self.message().version):
-                        raise VersionMismatchError(
-                            'read msg.version = %d != %d = message().version):' % \
-                                (msg.version, self.message().version))
-                
-                ## yield is python primitive for iteration
-                self._count += 1
-
-                if self.read_wrapper is not None:
-                    msg = self.read_wrapper(msg)
-                yield msg
+                if where is not None:
+                    ## decode only the fields that where tests, and
+                    ## then go back and decode the whole message if
+                    ## it matches
+                    decode_where(msg)
+                    if version is not None and msg.version != version:
+                        self._check_version(msg)
+                    if not where(msg):
+                        read += 1
+                        continue
+                    i_transport.rewind()
+                    msg = message()
+                decode(msg)
+            except EOFError:
+                self._check_eof(i_transport, read)
+                break
+            read += 1
 
+            if version is not None and msg.version != version:
+                self._check_version(msg)
+
+            if lazy:
+                msg = from_decoded(msg, i_transport.marked())
+            elif post is not None:
+                msg = post(msg)
+
+            self._count += 1
+
+            if read_wrapper is not None:
+                msg = read_wrapper(msg)
+
+            ## yield is python primitive for iteration
+            yield msg
+
+    def iter_raw(self, fields=None):
+        '''
+        Iterator over the serialized bytes of each message in the
+        chunk.  Message boundaries are found by skipping over fields
+        in the binary protocol without constructing them, so this is
+        much faster than __iter__ followed by serialize.  The version
+        field is still checked against self.message.  With
+        upgrade=True, the bytes are still those of the stored version.
+
+        :param fields: if given, yield (msg, blob) pairs instead,
+        where msg has only these fields decoded, as in Chunk(fields=)
+        '''
+        i_protocol = self._input_protocol()
+        i_transport = i_protocol.trans
+
+        names = list(fields or [])
+        if self._version is not None:
+            names.append('version')
+        where = self.where
+        if where is not None:
+            if self._skip_by_trailer():
+                return
+            names.extend(where.fields)
+        thrift_spec = project_thrift_spec(self._base_spec, names)
+
+        message = self.message
+        decode = _decoder(i_protocol, message, thrift_spec)
+        read = 0
+        segment = [i_transport.tell(), 0]
+        peek = i_transport.peek
+        while 1:
+            if peek(len(TRAILER_HEADER)) == TRAILER_HEADER:
+                self._read_trailer(i_transport, segment, read)
+                continue
+            msg = message()
+            i_transport.mark()
+            try:
+                decode(msg)
             except EOFError:
+                self._check_eof(i_transport, read)
                 break
+            read += 1
+            self._check_version(msg)
+            if where is not None and not where(msg):
+                continue
+            self._count += 1
+            if fields is None:
+                yield i_transport.marked()
+            else:
+                yield msg, i_transport.marked()
+
+    def _where_decoder(self, i_protocol):
+        'decoder for the fields that self.where tests'
+        names = list(self.where.fields)
+        if self._version is not None:
+            names.append('version')
+        return _decoder(i_protocol, self.message, project_thrift_spec(self._base_spec, names))
+
+    def _skip_by_trailer(self):
+        '''
+        True if the trailer shows that no message can match the
+        stream_time range of self.where
+        '''
+        if 'stream_time' not in self.where.fields or self.trailer is None:
+            return False
+        trailer = self.trailer
+        if trailer.min_stream_time is None:
+            ## no message has a stream_time
+            return len(trailer) > 0
+        return not self.where.overlaps(trailer.min_stream_time, trailer.max_stream_time)
+
+    def _read_trailer(self, i_transport, segment, read):
+        '''
+        called when the next bytes of i_transport are TRAILER_HEADER.
+        Reads exactly the bytes of the trailer, which may be followed
+        by another chunk, if chunks were concatenated.  A trailer at
+        the end of the input that covers all of it becomes
+        self.trailer.
+
+        :param segment: [offset, read] where the messages covered by
+        the trailer start, which is moved to just after it
+
+        :param read: number of messages read so far
+
+        :raises ChunkTruncatedError: with check_truncation, if the
+        trailer is incomplete or does not match the messages before it
+        '''
+        where = self.path or 'chunk'
+        start = i_transport.tell()
+        data = _read_up_to(i_transport, TRAILER_PREFIX_SIZE)
+        if len(data) == TRAILER_PREFIX_SIZE:
+            size = trailer_size(data)
+            data += _read_up_to(i_transport, size - len(data))
+        try:
+            trailer = ChunkTrailer.loads(data)
+        except ValueError, exc:
+            if self._check_truncation:
+                raise ChunkTruncatedError('%s: bad trailer at offset %d: %s' % (where, start, exc))
+            return
+        count = read - segment[1]
+        if self._check_truncation and (
+                trailer.end_offset != start - segment[0] or len(trailer) != count):
+            raise ChunkTruncatedError(
+                '%s: trailer for %d messages ending at %d, but read %d ending at %d'
+                % (where, len(trailer), trailer.end_offset, count, start - segment[0]))
+        if segment[0] == 0 and not i_transport.peek(1):
+            self._trailer = trailer
+        segment[:] = [i_transport.tell(), read]
+
+    def _check_eof(self, i_transport, read):
+        '''
+        called when decoding the message marked on i_transport reached
+        the end of the input, after read complete messages.
+
+        :raises ChunkTruncatedError: with check_truncation, unless the
+        input ended cleanly after the last message or trailer
+
+        :raises CodecReadError: without check_truncation, if the codec
+        failed to read the compressed stream
+        '''
+        error = getattr(i_transport, 'stream_error', None)
+        if not self._check_truncation:
+            if error is not None:
+                raise error[0], error[1], error[2]
+            return
+        tail = i_transport.marked()
+        start = i_transport.tell() - len(tail)
+        where = self.path or 'chunk'
+        if getattr(i_transport, 'stream_truncated', False):
+            raise ChunkTruncatedError(
+                '%s: compressed stream ends early, after %d complete messages at offset %d%s'
+                % (where, read, start, error and ': %s' % error[1] or ''))
+        if tail:
+            raise ChunkTruncatedError(
+                '%s: partial message of %d bytes at offset %d, after %d complete messages'
+                % (where, len(tail), start, read))
+
+    def _check_version(self, msg):
+        ## compare the read version to the default version value on
+        ## the identified message
+        if self._version is not None and msg.version != self._version:
+            raise VersionMismatchError(
+                'read msg.version = %r != %d = message().version):' % \
+                    (msg.version, self._version))
+
+    @property
+    def index(self):
+        '''
+        ChunkIndex of the messages in this chunk.  It is loaded from
+        the sidecar file if there is one, and otherwise built by
+        scanning the chunk without constructing any field other than
+        stream_id and doc_id.
+        '''
+        if self._index is None:
+            self._index = self._sidecar_index()
+            if self._index is None:
+                self._index = self._build_index()
+                if self._save_index:
+                    self._index.save(self.path)
+        return self._index
+
+    def _sidecar_index(self):
+        '''
+        self._index, or else the sidecar ChunkIndex if there is a
+        current one, or None, without building an index
+        '''
+        if self._index is None and self.path is not None:
+            index = ChunkIndex.from_sidecar(self.path)
+            if index is not None:
+                self._index = index
+                if not self._index_is_current():
+                    logger.warn('ignoring stale index for %s', self.path)
+                    self._index = None
+        return self._index
+
+    def _index_is_current(self):
+        ## can only check the size of chunks stored uncompressed
+        if self.path.endswith('.gpg') or codec_for_path(self.path) is not None:
+            return True
+        end_offset = os.path.getsize(self.path)
+        if self.trailer is not None:
+            end_offset = self.trailer.end_offset
+        return end_offset == self._index.end_offset
+
+    def _build_index(self):
+        index = ChunkIndex()
+        i_protocol = self._input_protocol()
+        i_transport = i_protocol.trans
+        message = self.message
+        decode = _decoder(i_protocol, message,
+                          project_thrift_spec(self._base_spec, ['stream_id', 'doc_id']))
+        read = 0
+        segment = [i_transport.tell(), 0]
+        peek = i_transport.peek
+        while 1:
+            if peek(len(TRAILER_HEADER)) == TRAILER_HEADER:
+                self._read_trailer(i_transport, segment, read)
+                continue
+            offset = i_transport.tell()
+            msg = message()
+            try:
+                decode(msg)
+            except EOFError:
+                error = getattr(i_transport, 'stream_error', None)
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                break
+            read += 1
+            index.add(offset, i_transport.tell() - offset,
+                      getattr(msg, 'stream_id', None),
+                      getattr(msg, 'doc_id', None))
+        return index
+
+    def get(self, stream_id):
+        '''
+        Read and decode only the message with this stream_id, using
+        the index to find it.
 
-def decrypt_and_uncompress(data, gpg_private=None, tmp_dir='/tmp'):
+        :raises KeyError: if stream_id is not in this chunk
+        '''
+        offset, length = self.index.find(stream_id)
+        return self._get_range(offset, length)
+
+    def find_raw(self, stream_ids):
+        '''
+        Generate (stream_id, blob) for every message whose stream_id
+        is in stream_ids, in chunk order, with the serialized bytes of
+        each message, as from iter_raw.  Stops reading as soon as all
+        of stream_ids have been found.
+
+        If a sidecar index has been loaded or saved for this chunk,
+        only the matching messages are read.  Otherwise, the chunk is
+        scanned decoding only stream_id.  A chunk whose trailer shows
+        that it has no messages is not read at all.
+
+        :param stream_ids: a set, or any iterable, of stream_ids
+        '''
+        wanted = set(stream_ids)
+        if not wanted:
+            return
+        if self.mode == 'rb' and self.trailer is not None and len(self.trailer) == 0:
+            return
+
+        index = self._sidecar_index()
+        if index is not None:
+            hits = sorted(index.find(stream_id) + (stream_id,)
+                          for stream_id in wanted if stream_id in index)
+            ranges = [(offset, length) for offset, length, stream_id in hits]
+            blobs = self._iter_ranges(ranges)
+            if blobs is not None:
+                where = self.where
+                if where is not None:
+                    spec = project_thrift_spec(self._base_spec, where.fields)
+                for (offset, length, stream_id), blob in itertools.izip(hits, blobs):
+                    if where is not None:
+                        msg = self.message()
+                        _decode(msg, protocol(TTransport.TMemoryBuffer(blob)), spec)
+                        if not where(msg):
+                            continue
+                    yield stream_id, blob
+                return
+
+        for msg, blob in self.iter_raw(fields=['stream_id']):
+            if msg.stream_id in wanted:
+                wanted.remove(msg.stream_id)
+                yield msg.stream_id, blob
+                if not wanted:
+                    return
+
+    def _iter_ranges(self, ranges):
+        '''
+        iterator over the bytes of each (offset, length) in ranges,
+        which must be in order of offset, as for _read_range.  Reads
+        from a single new stream if the input cannot seek.  None if it
+        cannot seek and there is no path to open again.
+        '''
+        if self.message is None:
+            self._input_protocol()
+        if self._mmap is None:
+            try:
+                self._i_chunk_fh._fh.seek(0)
+            except (IOError, AttributeError):
+                if self.path is None:
+                    return None
+                return self._iter_ranges_reopened(ranges)
+        return (self._read_range(offset, length) for offset, length in ranges)
+
+    def _iter_ranges_reopened(self, ranges):
+        with Chunk(path=self.path, mode='rb', gpg=self._gpg) as reopened:
+            fh = reopened._i_chunk_fh._fh
+            pos = 0
+            for offset, length in ranges:
+                _skip_bytes(fh, offset - pos)
+                yield _read_exactly(fh, length)
+                pos = offset + length
+
+    def get_at(self, pos):
+        '''
+        Read and decode only the message at position pos in the chunk,
+        using the trailer, or else the index, to find it.
+
+        :raises IndexError: if there is no such message
+        '''
+        if self.trailer is not None:
+            offset, length = self.trailer.find(pos)
+        else:
+            offset, length = self.index[pos][:2]
+        return self._get_range(offset, length)
+
+    def _get_range(self, offset, length):
+        'decode the message at offset, as for Chunk.get'
+        if self.message is None:
+            ## message='auto' and nothing has been read yet
+            self._input_protocol()
+        msg = self.message()
+        blob = self._read_range(offset, length)
+        _decode(msg, protocol(TTransport.TMemoryBuffer(blob)), self._thrift_spec)
+        self._check_version(msg)
+        if self._lazy:
+            from _lazy import from_decoded
+            msg = from_decoded(msg, blob)
+        elif self._post is not None:
+            msg = self._post(msg)
+        if self.read_wrapper is not None:
+            msg = self.read_wrapper(msg)
+        return msg
+
+    def _read_range(self, offset, length):
+        '''
+        bytes of the uncompressed message stream from offset to
+        offset + length, without passing them through the md5
+        '''
+        if self._mmap is not None:
+            blob = self._mmap[offset:offset + length]
+            if len(blob) != length:
+                raise EOFError('read %d bytes instead of %d' % (len(blob), length))
+            return blob
+        fh = self._i_chunk_fh._fh
+        try:
+            fh.seek(offset)
+        except (IOError, AttributeError):
+            ## pipes from decompression children cannot seek, so start
+            ## a new one and read up to offset
+            if self.path is None:
+                raise IOError('cannot seek in this Chunk to read a message')
+            with Chunk(path=self.path, mode='rb', gpg=self._gpg) as reopened:
+                fh = reopened._i_chunk_fh._fh
+                _skip_bytes(fh, offset)
+                return _read_exactly(fh, length)
+        return _read_exactly(fh, length)
+
+def _map_file(fh):
+    '''
+    map the whole of an open file read-only, or return '' for an empty
+    file, which cannot be mapped
+    '''
+    if os.fstat(fh.fileno()).st_size == 0:
+        return ''
+    return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _skip_bytes(fh, count):
+    while count > 0:
+        data = fh.read(min(count, chunk_transport.DEFAULT_BUFFER))
+        if not data:
+            raise EOFError()
+        count -= len(data)
+
+def _inner_codec(path, compression=None):
+    'Codec for path ending in .gpg, chosen by the extension before .gpg'
+    if compression is not None:
+        return get_codec(compression)
+    return codec_for_path(path[:-len('.gpg')])
+
+def _epoch_ticks(msg):
+    'stream_time.epoch_ticks of msg, or None'
+    stream_time = getattr(msg, 'stream_time', None)
+    if stream_time is None:
+        return None
+    return stream_time.epoch_ticks
+
+def _fsync_path(path):
+    'flush the file or directory at path to disk'
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _read_exactly(fh, length):
+    return read_all(fh.read, length)
+
+def decrypt_and_uncompress(data, gpg_private=None, tmp_dir='/tmp', gpg=None):
     '''
     Given a data buffer of bytes, if gpg_key_path is provided, decrypt
     data using gnupg, and uncompress using xz.
 
+    :param gpg: GpgContext for decrypting, instead of gpg_private, so
+    that the key is imported once for many calls
+
     :returns (logs, data): where logs is an array of strings, and data
     is a binary string.
     '''
     _errors = []
-    tmp_path = os.path.join(tmp_dir, 'tmp-compress-and-encrypt-path-' + uuid.uuid4().hex)
-    if not os.path.exists(tmp_path):
-        os.makedirs(tmp_path)
-    if gpg_private is not None:
+    own_gpg = None
+    if gpg is None and gpg_private is not None:
         ### setup gpg for decryption
-        gpg_dir = os.path.join(tmp_path, 'gpg_dir')
-        os.makedirs(gpg_dir)
-
-        gpg_child = subprocess.Popen(
-            ['gpg', '--no-permission-warning', '--homedir', gpg_dir,
-             '--import', gpg_private],
-            stderr=subprocess.PIPE)
-        s_out, errors = gpg_child.communicate()
-        if errors:
-            _errors.append('gpg logs to stderr, read carefully:\n\n%s' % errors)
-
-        ## decrypt it, and free memory
-        ## encrypt using the fingerprint for our trec-kba-rsa key pair
-        gpg_child = subprocess.Popen(
-            ## setup gpg to decrypt with trec-kba private key
-            ## (i.e. make it the recipient), with zero compression,
-            ## ascii armoring is off by default, and --output - must
-            ## appear before --decrypt -
-            ['gpg',   '--no-permission-warning', '--homedir', gpg_dir,
-             '--trust-model', 'always', '--output', '-', '--decrypt', '-'],
-            stdin =subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        ## communicate with child via its stdin 
-        data, errors = gpg_child.communicate(data)
-        if errors:
-            _errors.append(errors)
-
-        ## remove the gpg_dir
-        shutil.rmtree(gpg_dir, ignore_errors=True)
+        gpg = own_gpg = GpgContext(gpg_private=gpg_private, tmp_dir=tmp_dir)
+        _errors.extend(gpg.logs)
+    try:
+        if gpg is not None:
+            ## decrypt it, and free memory
+            data, errors = gpg.decrypt(data)
+            if errors:
+                _errors.append(errors)
+    finally:
+        ## remove the gpg homedir
+        if own_gpg is not None:
+            own_gpg.close()
 
     ## launch xz child
     xz_child = subprocess.Popen(
@@ -455,15 +1773,25 @@ def decrypt_and_uncompress(data, gpg_private=None, tmp_dir='/tmp'):
 
     return _errors, data
 
-def compress_and_encrypt(data, gpg_public=None, gpg_recipient='trec-kba'):
+def compress_and_encrypt(data, gpg_public=None, gpg_recipient='trec-kba',
+                         threads=1, tmp_dir='/tmp', gpg=None):
     '''
     Given a data buffer of bytes compress it using xz, if gpg_public
     is provided, encrypt data using gnupg.
+
+    :param threads: number of threads for xz to compress with, which
+    splits the output into independently compressed blocks
+
+    :param gpg: GpgContext for encrypting to its recipient, instead of
+    gpg_public, so that the key is imported once for many calls
     '''
     _errors = []
+    xz_args = ['xz', '--compress']
+    if threads != 1:
+        xz_args.append('--threads=%d' % threads)
     ## launch xz child
     xz_child = subprocess.Popen(
-        ['xz', '--compress'],
+        xz_args,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE)
@@ -473,105 +1801,206 @@ def compress_and_encrypt(data, gpg_public=None, gpg_recipient='trec-kba'):
 
     assert not errors, errors
 
-    if gpg_public is not None:
+    own_gpg = None
+    if gpg is None and gpg_public is not None:
         ### setup gpg for encryption.  
-        gpg_dir = os.path.join(tmp_dir, 'tmp-compress-and-encrypt-' + uuid.uuid1().hex)
-        os.makedirs(gpg_dir)
-
-        ## Load public key.  Could do this just once, but performance
-        ## hit is minor and code simpler to do it everytime
-        gpg_child = subprocess.Popen(
-            ['gpg', '--no-permission-warning', '--homedir', gpg_dir,
-             '--import', gpg_public],
-            stderr=subprocess.PIPE)
-        s_out, errors = gpg_child.communicate()
-        if errors:
-            _errors.append('gpg logs to stderr, read carefully:\n\n%s' % errors)
-
-        ## encrypt using the fingerprint for our trec-kba-rsa key pair
-        gpg_child = subprocess.Popen(
-            ## setup gpg to decrypt with trec-kba private key
-            ## (i.e. make it the recipient), with zero compression,
-            ## ascii armoring is off by default, and --output - must
-            ## appear before --encrypt -
-            ['gpg',  '--no-permission-warning', '--homedir', gpg_dir,
-             '-r', gpg_recipient, '-z', '0', '--trust-model', 'always',
-             '--output', '-', '--encrypt', '-'],
-            stdin =subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        ## communicate with child via its stdin 
-        data, errors = gpg_child.communicate(data)
-        if errors:
-            _errors.append(errors)
-
-        shutil.rmtree(gpg_dir, ignore_errors=True)
+        gpg = own_gpg = GpgContext(gpg_public=gpg_public, recipient=gpg_recipient,
+                                   tmp_dir=tmp_dir)
+        _errors.extend(gpg.logs)
+    try:
+        if gpg is not None:
+            data, errors = gpg.encrypt(data)
+            if errors:
+                _errors.append(errors)
+    finally:
+        if own_gpg is not None:
+            own_gpg.close()
 
     return _errors, data
 
-def compress_and_encrypt_path(path, gpg_public=None, gpg_recipient='trec-kba', tmp_dir='/tmp'):
+def compress_and_encrypt_path(path, gpg_public=None, gpg_recipient='trec-kba', tmp_dir='/tmp',
+                              threads=1, gpg=None):
     '''
     Given a path in the local file system, compress it using xz, if gpg_public
     is provided, encrypt data using gnupg.
 
+    :param threads: number of threads for xz to compress with, which
+    splits the output into independently compressed blocks
+
+    :param gpg: GpgContext for encrypting to its recipient, instead of
+    gpg_public, so that the key is imported once for many calls
+
     :returns: path to file of encrypted, compressed data
     :rtype: str
     '''
     _errors = []
     assert os.path.exists(path), path
-    command = 'xz --compress < ' + path
 
     tmp_path = os.path.join(tmp_dir, 'tmp-compress-and-encrypt-path-' + uuid.uuid4().hex)
     if not os.path.exists(tmp_path):
         os.makedirs(tmp_path)
 
-    if gpg_public is not None:
-        ### setup gpg for encryption.  
-        gpg_dir = os.path.join(tmp_path, 'gpg_dir')
-        os.makedirs(gpg_dir)
-
-        ## Load public key.  Could do this just once, but performance
-        ## hit is minor and code simpler to do it everytime
-        gpg_child = subprocess.Popen(
-            ['gpg', '--no-permission-warning', '--homedir', gpg_dir,
-             '--import', gpg_public],
-            stderr=subprocess.PIPE)
-        s_out, errors = gpg_child.communicate()
-        if errors:
-            _errors.append('gpg logs to stderr, read carefully:\n\n%s' % errors)
-
-        ## setup gpg to decrypt with provided private key (i.e. make
-        ## it the recipient), with zero compression, ascii armoring is
-        ## off by default, and --output - must come before --encrypt -
-        command += '| gpg  --no-permission-warning --homedir ' + gpg_dir \
-                 + ' -r ' + gpg_recipient \
-                 + ' -z 0 --trust-model always --output - --encrypt - '
-
     ## we want to capture any errors, so do all the work before
     ## returning.  Store the intermediate result in this temp file:
     o_path = os.path.join(tmp_path, 'o_path')
-    e_path = os.path.join(tmp_path, 'e_path')
 
-    command += ' 1> ' + o_path 
+    own_gpg = None
+    try:
+        if gpg is None and gpg_public is not None:
+            gpg = own_gpg = GpgContext(gpg_public=gpg_public, recipient=gpg_recipient,
+                                       tmp_dir=tmp_dir)
+            _errors.extend(gpg.logs)
+        ## xz and gpg child processes, connected without a shell
+        o_fh = compress_and_encrypt_file(open(o_path, 'wb'), gpg=gpg, compression='xzcat',
+                                         threads=threads)
+        try:
+            with open(path, 'rb') as i_fh:
+                shutil.copyfileobj(i_fh, o_fh, 2**16)
+        finally:
+            o_fh.close()
+    except IOError, exc:
+        ## will send back errors in list
+        _errors.append(str(exc))
+    finally:
+        if own_gpg is not None:
+            own_gpg.close()
+
+    return _errors, o_path
 
-    ## wrap entire command in parentheses and pipe stderr to a file
-    command = '( ' + command + ') 2> ' + e_path
+class pipeline_file(object):
+    '''
+    File-like object for the last of a pipeline of streams, such as an
+    xz reader reading from a gpg child process reading from a file.
+    Data moves through the pipeline in small pieces as it is read or
+    written, and a stage that falls behind blocks the others, so
+    memory use does not grow with the amount of data.  close closes
+    every stage, last first, and then anything in closers, such as a
+    GpgContext made for this pipeline.
+    '''
+    def __init__(self, stages, mode, closers=()):
+        self._stages = stages
+        self._closers = list(closers)
+        self.mode = mode
 
-    ## launch xz child
-    child = os.system(command)
+    def read(self, size=-1):
+        return self._stages[-1].read(size)
 
-    if os.path.exists(e_path):
-        errors = open(e_path).read()
-        ## clean up temp path
-        os.remove(e_path)
-    else:
-        errors = None
+    def write(self, data):
+        self._stages[-1].write(data)
 
-    if errors:
-        ## will send back errors in list
-        _errors.append(errors)
+    def flush(self):
+        self._stages[-1].flush()
 
-    if gpg_public is not None:
-        shutil.rmtree(gpg_dir, ignore_errors=True)
+    def close(self):
+        stages = self._stages
+        self._stages = []
+        try:
+            for stage in reversed(stages):
+                stage.close()
+        finally:
+            for closer in self._closers:
+                closer.close()
+            self._closers = []
+
+def decrypt_and_uncompress_file(fh, gpg_private=None, gpg=None, compression='xz',
+                                threads=1, tmp_dir='/tmp'):
+    '''
+    Streaming variant of decrypt_and_uncompress, which never holds a
+    whole chunk in memory, for iterating over with Chunk:
 
-    return _errors, o_path
+        with GpgContext(gpg_private='trec-kba-rsa.secret-key') as gpg:
+            fh = decrypt_and_uncompress_file(open(path, 'rb'), gpg=gpg)
+            for si in Chunk(file_obj=fh):
+                ...
+            fh.close()
+
+    :param fh: file to read encrypted, compressed bytes from, which is
+    closed when the returned file is closed
+
+    :param gpg_private: path to a private key for decrypting, imported
+    into a GpgContext that is removed when the returned file is closed
+
+    :param gpg: GpgContext for decrypting, instead of gpg_private.  If
+    neither is given, fh is only uncompressed.
+
+    :param compression: codec name of the compression inside the
+    encryption, or 'none'
+
+    :returns: file-like object of the uncompressed bytes
+    '''
+    stages = [fh]
+    closers = []
+    if gpg is None and gpg_private is not None:
+        gpg = GpgContext(gpg_private=gpg_private, tmp_dir=tmp_dir)
+        closers.append(gpg)
+    try:
+        if gpg is not None:
+            stages.append(gpg.decrypt_reader(fh))
+        codec = get_codec(compression)
+        if codec is not None:
+            stages.append(codec.reader(stages[-1], threads=threads))
+    except:
+        pipeline_file(stages, 'rb', closers).close()
+        raise
+    return pipeline_file(stages, 'rb', closers)
+
+def iter_decrypt_and_uncompress(fh, block_size=2**16, **kwargs):
+    '''
+    Generate the uncompressed bytes of fh in blocks of at most
+    block_size bytes.  fh is closed when the generator finishes or is
+    closed.  Takes the same keyword arguments as
+    decrypt_and_uncompress_file.
+    '''
+    i_fh = decrypt_and_uncompress_file(fh, **kwargs)
+    try:
+        while True:
+            data = i_fh.read(block_size)
+            if not data:
+                break
+            yield data
+    finally:
+        i_fh.close()
+
+def compress_and_encrypt_file(fh, gpg_public=None, gpg_recipient='trec-kba', gpg=None,
+                              compression='xz', compression_level=None, threads=1,
+                              tmp_dir='/tmp'):
+    '''
+    Streaming variant of compress_and_encrypt, which never holds a
+    whole chunk in memory, for writing to with Chunk:
+
+        o_fh = compress_and_encrypt_file(open(path, 'wb'), gpg=gpg)
+        with Chunk(file_obj=o_fh, mode='wb') as ch:
+            ...
+
+    :param fh: file to write compressed, encrypted bytes to, which is
+    closed when the returned file is closed
+
+    :param gpg_public: path to a public key for encrypting to
+    gpg_recipient, imported into a GpgContext that is removed when the
+    returned file is closed
+
+    :param gpg: GpgContext for encrypting to its recipient, instead of
+    gpg_public.  If neither is given, the output is only compressed.
+
+    :param threads: number of threads for xz to compress with, which
+    splits the output into independently compressed blocks
+
+    :returns: file-like object that raises IOError from close if gpg
+    failed
+    '''
+    stages = [fh]
+    closers = []
+    if gpg is None and gpg_public is not None:
+        gpg = GpgContext(gpg_public=gpg_public, recipient=gpg_recipient, tmp_dir=tmp_dir)
+        closers.append(gpg)
+    try:
+        if gpg is not None:
+            stages.append(gpg.encrypt_writer(fh))
+        codec = get_codec(compression)
+        if codec is not None:
+            stages.append(codec.writer(stages[-1], 'wb', level=compression_level,
+                                       threads=threads))
+    except:
+        pipeline_file(stages, 'wb', closers).close()
+        raise
+    return pipeline_file(stages, 'wb', closers)
@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+'''
+Registry of the compression formats that streamcorpus.Chunk can read
+and write, keyed by file extension and by the magic bytes at the start
+of a compressed stream.
+
+Every codec provides streaming readers and writers around an open
+file, so a chunk is never held in memory in compressed form.  The fast
+codecs, zstd and lz4, decompress many times faster than xz, at some
+cost in compression ratio, which suits chunks that are re-processed
+often.  The libraries for zstd, lz4 and snappy are optional; their
+codecs are registered regardless, so the extensions are recognized,
+and using one without its library raises an Exception that names the
+missing package.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+
+import sys
+import gzip
+import logging
+logger = logging.getLogger('streamcorpus')
+
+from _xz import lzma, xz_blocks, xz_block_reader, xz_block_writer, \
+    subprocess_reader, subprocess_writer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+## map from codec name to Codec
+_codecs = {}
+
+class CodecReadError(IOError):
+    '''
+    raised by reading a codec_file when the codec fails, as most do
+    when the compressed stream is cut short or damaged
+    '''
+    pass
+
+class Codec(object):
+    '''
+    A compression format.
+
+    :param name: short name, such as 'zstd', used by
+    Chunk(compression=name)
+
+    :param extensions: file extensions, such as '.zst', that select
+    this codec for a path
+
+    :param magic: bytes at the start of every stream in this format,
+    or a tuple of alternatives
+
+    :param reader: function (fh, threads) that returns a file-like
+    object of the uncompressed bytes read from fh
+
+    :param writer: function (fh, level, threads, block_size) that
+    returns a file-like object that compresses what is written to it
+    into fh, and closes fh when it is closed.  level=None means the
+    default level of the codec.
+
+    :param module: the optional library that the codec needs, or None
+    if it is missing
+    '''
+    def __init__(self, name, extensions, magic, reader, writer, module=True):
+        self.name = name
+        self.extensions = extensions
+        self.magic = magic
+        self._reader = reader
+        self._writer = writer
+        self._module = module
+
+    @property
+    def available(self):
+        return self._module is not None
+
+    def _check_available(self):
+        if not self.available:
+            raise Exception('the python library for %s is not installed' % self.name)
+
+    def reader(self, fh, threads=1):
+        self._check_available()
+        return codec_file(self, fh, self._reader(fh, threads), 'rb', threads)
+
+    def writer(self, fh, mode='wb', level=None, threads=1, block_size=2**24):
+        self._check_available()
+        return codec_file(self, fh, self._writer(fh, level, threads, block_size), mode)
+
+    def __repr__(self):
+        return 'Codec(%r)' % self.name
+
+def register_codec(codec):
+    '''
+    Add a Codec to the registry, replacing any codec with the same name.
+    '''
+    _codecs[codec.name] = codec
+
+def get_codec(name):
+    '''
+    :returns: the Codec registered as name, or None for 'none'
+    :raises KeyError: if there is no such codec
+    '''
+    if name == 'none':
+        return None
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise KeyError('no codec %r in %r' % (name, sorted(_codecs)))
+
+def codec_for_path(path):
+    '''
+    :returns: the Codec with the longest extension that path ends
+    with, or None if the path is not compressed
+    '''
+    best = None
+    best_len = 0
+    for codec in _codecs.values():
+        for ext in codec.extensions:
+            if path.endswith(ext) and len(ext) > best_len:
+                best = codec
+                best_len = len(ext)
+    return best
+
+def codec_for_magic(prefix):
+    '''
+    :returns: the Codec whose magic bytes start prefix, or None
+    '''
+    for codec in _codecs.values():
+        if codec.magic and prefix.startswith(codec.magic):
+            return codec
+    return None
+
+def magic_size():
+    'number of leading bytes needed by codec_for_magic'
+    size = 0
+    for codec in _codecs.values():
+        magic = codec.magic or ()
+        if isinstance(magic, str):
+            magic = (magic,)
+        for alternative in magic:
+            size = max(size, len(alternative))
+    return size
+
+## most layers to unwrap, e.g. gpg around xz
+MAX_LAYERS = 3
+
+def detect_and_open(fh, threads=1):
+    '''
+    Inspect the first bytes of fh for the magic bytes of a registered
+    codec, and if one is found, decompress it in-process.  Repeats for
+    layered formats, such as xz inside gpg.
+
+    :returns: a file-like object of the uncompressed bytes of fh,
+    which is fh itself if fh is not compressed and can seek
+    '''
+    for layer in xrange(MAX_LAYERS):
+        prefix, fh = peek(fh, magic_size())
+        codec = codec_for_magic(prefix)
+        if codec is None:
+            break
+        logger.debug('detected %s from magic bytes', codec.name)
+        fh = codec.reader(fh, threads=threads)
+    return fh
+
+def peek(fh, size):
+    '''
+    Read up to size bytes from the start of fh without consuming them.
+
+    :returns (prefix, fh): where fh is either the same file, seeked
+    back, or a prefixed_file that replays prefix
+    '''
+    if hasattr(fh, 'tell') and hasattr(fh, 'seek'):
+        try:
+            pos = fh.tell()
+            prefix = fh.read(size)
+            fh.seek(pos)
+            return prefix, fh
+        except IOError:
+            ## pipes like stdin have seek but fail, and only when
+            ## called, so nothing has been read yet
+            pass
+    prefix = fh.read(size)
+    return prefix, prefixed_file(prefix, fh)
+
+class prefixed_file(object):
+    '''
+    Adapter around a file that has already been read from, which
+    returns the bytes that were read before reading more from the file
+    '''
+    def __init__(self, prefix, fh):
+        self._prefix = prefix
+        self._fh = fh
+        if hasattr(fh, 'mode'):
+            self.mode = fh.mode
+
+    def read(self, size=-1):
+        if not self._prefix:
+            return self._fh.read(size)
+        if size < 0:
+            data = self._prefix + self._fh.read()
+            self._prefix = ''
+            return data
+        data = self._prefix[:size]
+        self._prefix = self._prefix[size:]
+        return data
+
+    def seek(self, offset, whence=0):
+        ## only works if the underlying file can seek
+        if not hasattr(self._fh, 'seek'):
+            raise IOError('cannot seek in %r' % self._fh)
+        self._fh.seek(offset, whence)
+        self._prefix = ''
+
+    def close(self):
+        self._fh.close()
+
+class codec_file(object):
+    '''
+    Adapter around the stream returned by a codec, which reads until
+    it has the requested number of bytes or reaches EOF, can rewind to
+    the start by restarting the codec on the underlying file, and
+    closes the underlying file.
+    '''
+    def __init__(self, codec, fh, stream, mode, threads=1):
+        self.codec = codec
+        self.mode = mode
+        self._fh = fh
+        self._stream = stream
+        self._threads = threads
+        self._started = False
+        self.message_aligned = getattr(stream, 'message_aligned', False)
+
+    def read(self, size=-1):
+        self._started = True
+        try:
+            return self._read(size)
+        except (EOFError, CodecReadError):
+            raise
+        except Exception, exc:
+            ## each codec reports a damaged stream in its own way,
+            ## e.g. gzip with IOError or struct.error
+            raise CodecReadError('%s stream: %s' % (self.codec.name, exc)), \
+                None, sys.exc_info()[2]
+
+    def _read(self, size):
+        if size < 0:
+            parts = []
+            while True:
+                data = self._stream.read(2**20)
+                if not data:
+                    return ''.join(parts)
+                parts.append(data)
+        data = self._stream.read(size)
+        if len(data) == size or not data:
+            return data
+        parts = [data]
+        have = len(data)
+        while have < size:
+            data = self._stream.read(size - have)
+            if not data:
+                break
+            parts.append(data)
+            have += len(data)
+        return ''.join(parts)
+
+    def write(self, data):
+        self._stream.write(data)
+
+    def flush(self):
+        self._stream.flush()
+
+    def seek(self, offset, whence=0):
+        assert whence == 0, 'codec_file only seeks to absolute offsets'
+        if offset == 0 and 'r' in self.mode:
+            if not self._started:
+                return
+            ## restart decompression, which every codec can do if the
+            ## underlying file can seek
+            ## raises IOError, leaving the stream as it was, if the
+            ## underlying file cannot seek
+            self._fh.seek(0)
+            self._stream.close()
+            self._started = False
+            self._stream = self.codec._reader(self._fh, self._threads)
+            return
+        try:
+            self._stream.seek(offset)
+        except (AttributeError, ValueError, OSError), exc:
+            raise IOError('cannot seek in %s stream: %r' % (self.codec.name, exc))
+
+    def close(self):
+        self._stream.close()
+        self._fh.close()
+
+def _gzip_reader(fh, threads):
+    return gzip.GzipFile(fileobj=fh, mode='rb')
+
+def _gzip_writer(fh, level, threads, block_size):
+    if level is None:
+        level = 9
+    return gzip.GzipFile(fileobj=fh, mode='wb', compresslevel=level)
+
+register_codec(Codec('gzip', ('.gz',), '\x1f\x8b', _gzip_reader, _gzip_writer))
+
+def _xz_reader(fh, threads):
+    if lzma is None:
+        logger.debug('backports.lzma is not installed, so reading .xz with xzcat')
+        return _xzcat_reader(fh, threads)
+    if threads > 1 and hasattr(fh, 'seek'):
+        try:
+            blocks = xz_blocks(fh)
+            fh.seek(0)
+        except IOError:
+            ## not seekable, so decompress sequentially
+            blocks = ()
+        if len(blocks) > 1:
+            return xz_block_reader(fh, threads, blocks)
+    return lzma.LZMAFile(fh, 'rb')
+
+def _xz_writer(fh, level, threads, block_size):
+    if lzma is None:
+        raise Exception('backports.lzma is required to write .xz files')
+    if level is None:
+        level = 6
+    if threads > 1:
+        return xz_block_writer(fh, threads=threads, block_size=block_size, preset=level)
+    return lzma.LZMAFile(fh, 'wb', preset=level)
+
+## the xz codec can fall back to xzcat for reading files, so it is
+## available without backports.lzma
+register_codec(Codec('xz', ('.xz',), '\xfd7zXZ\x00', _xz_reader, _xz_writer))
+
+def _xzcat_reader(fh, threads):
+    return subprocess_reader(['xzcat'], stdin=fh)
+
+def _xzcat_writer(fh, level, threads, block_size):
+    if level is None:
+        level = 6
+    args = ['xz', '-%d' % level]
+    if threads != 1:
+        ## splits the output into independently compressed blocks
+        args.append('--threads=%d' % threads)
+    return subprocess_writer(args, fh)
+
+## .xz through xz child processes, even if backports.lzma is
+## installed, for Chunk(compression='xzcat').  It has no extension or
+## magic bytes of its own, so it is only used when asked for by name.
+register_codec(Codec('xzcat', (), None, _xzcat_reader, _xzcat_writer))
+
+def _zstd_reader(fh, threads):
+    return zstandard.ZstdDecompressor().stream_reader(fh)
+
+def _zstd_writer(fh, level, threads, block_size):
+    if level is None:
+        level = 3
+    ## zstd compresses in its own threads when threads > 1
+    if threads <= 1:
+        threads = 0
+    return zstandard.ZstdCompressor(level=level, threads=threads).stream_writer(fh)
+
+register_codec(Codec('zstd', ('.zst', '.zstd'), '\x28\xb5\x2f\xfd',
+                     _zstd_reader, _zstd_writer, zstandard))
+
+def _lz4_reader(fh, threads):
+    return lz4.frame.LZ4FrameFile(fh, 'rb')
+
+def _lz4_writer(fh, level, threads, block_size):
+    if level is None:
+        level = 0
+    return lz4.frame.LZ4FrameFile(fh, 'wb', compression_level=level)
+
+register_codec(Codec('lz4', ('.lz4',), '\x04\x22\x4d\x18',
+                     _lz4_reader, _lz4_writer, lz4))
+
+class snappy_reader(object):
+    '''
+    File-like object that decompresses the snappy framing format
+    '''
+    def __init__(self, fh):
+        self._fh = fh
+        self._decompressor = snappy.StreamDecompressor()
+        ## decompressed bytes from self._offset on are not yet read
+        self._buf = ''
+        self._offset = 0
+
+    def read(self, size=-1):
+        offset = self._offset
+        if 0 <= size <= len(self._buf) - offset:
+            self._offset = offset + size
+            return self._buf[offset:offset + size]
+        parts = [self._buf[offset:]]
+        have = len(parts[0])
+        while size < 0 or have < size:
+            data = self._fh.read(2**16)
+            if not data:
+                self._decompressor.flush()
+                break
+            data = self._decompressor.decompress(data)
+            parts.append(data)
+            have += len(data)
+        self._buf = ''.join(parts)
+        if size < 0:
+            size = have
+        self._offset = size
+        return self._buf[:size]
+
+    def close(self):
+        pass
+
+class snappy_writer(object):
+    '''
+    File-like object that compresses into the snappy framing format
+    '''
+    def __init__(self, fh):
+        self._fh = fh
+        self._compressor = snappy.StreamCompressor()
+
+    def write(self, data):
+        self._fh.write(self._compressor.add_chunk(data))
+
+    def flush(self):
+        self._fh.flush()
+
+    def close(self):
+        self._fh.close()
+
+def _gpg_reader(fh, threads):
+    ## uses the default keyring of the user running the process
+    return subprocess_reader(['gpg', '--batch', '--quiet', '--no-permission-warning',
+                              '--decrypt'], stdin=fh)
+
+def _gpg_writer(fh, level, threads, block_size):
+    raise Exception('encrypting needs a recipient, see compress_and_encrypt')
+
+## OpenPGP messages start with a public-key or symmetric-key
+## encrypted session key packet, in either the old or new packet
+## format, or are ASCII armored.  gpg has no extension in the
+## registry, so paths ending in .gpg keep the explicit handling in
+## Chunk, and it is found only by its magic bytes.
+register_codec(Codec('gpg', (), ('\x84', '\x85', '\x86', '\x8c', '\x8d', '\x8e',
+                                 '\xc1', '\xc3', '-----BEGIN PGP MESSAGE-----'),
+                     _gpg_reader, _gpg_writer))
+
+register_codec(Codec('snappy', ('.sz', '.snappy'), '\xff\x06\x00\x00sNaPpY',
+                     lambda fh, threads: snappy_reader(fh),
+                     lambda fh, level, threads, block_size: snappy_writer(fh),
+                     snappy))
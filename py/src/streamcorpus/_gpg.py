@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+Provides GpgContext, a gpg home directory that keys are imported into
+once, for encrypting and decrypting any number of chunks, such as the
+.sc.xz.gpg files of the KBA corpus.  Encryption and decryption stream
+through a gpg child process, so no chunk is ever held in memory
+whole:
+
+    with GpgContext(gpg_private='trec-kba-rsa.secret-key') as gpg:
+        for path in paths:
+            for si in Chunk(path, gpg=gpg):
+                ...
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+
+import os
+import uuid
+import shutil
+import logging
+import subprocess
+logger = logging.getLogger('streamcorpus')
+
+from _xz import subprocess_reader, subprocess_writer
+
+def _default_homedir():
+    'home directory that gpg uses for the user running the process'
+    return os.environ.get('GNUPGHOME') or os.path.expanduser('~/.gnupg')
+
+class GpgContext(object):
+    '''
+    gpg home directory holding the keys for encrypting to recipient
+    and for decrypting.
+    '''
+    def __init__(self, gpg_private=None, gpg_public=None, recipient='trec-kba',
+                 homedir=None, tmp_dir='/tmp'):
+        '''
+        :param gpg_private: path to a private key to import, for
+        decrypting
+
+        :param gpg_public: path to a public key to import, for
+        encrypting to recipient
+
+        :param homedir: existing gpg home directory to use, which is
+        left in place by close.  By default, a new one is made in
+        tmp_dir and removed by close.
+        '''
+        self.recipient = recipient
+        ## stderr of gpg when importing keys, for reading carefully
+        self.logs = []
+        self._own_homedir = homedir is None
+        if homedir is None:
+            homedir = os.path.join(tmp_dir, 'tmp-gpg-' + uuid.uuid4().hex)
+            os.makedirs(homedir, 0700)
+        self.homedir = homedir
+        for key_path in [gpg_private, gpg_public]:
+            if key_path is not None:
+                self.import_key(key_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _args(self, *args):
+        return ['gpg', '--batch', '--quiet', '--no-permission-warning',
+                '--homedir', self.homedir, '--trust-model', 'always'] + list(args)
+
+    def import_key(self, key_path):
+        'add the public or private key in the file key_path'
+        child = subprocess.Popen(self._args('--import', key_path),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        s_out, errors = child.communicate()
+        if child.returncode != 0:
+            raise IOError('gpg --import %s exited with status %d: %s' % (
+                    key_path, child.returncode, errors))
+        if errors:
+            self.logs.append('gpg logs to stderr, read carefully:\n\n%s' % errors)
+
+    def decrypt(self, data):
+        '''
+        :returns (data, errors): the plaintext of the encrypted bytes
+        data, and what gpg wrote to stderr
+        '''
+        child = subprocess.Popen(self._args('--output', '-', '--decrypt', '-'),
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+        return child.communicate(data)
+
+    def encrypt(self, data):
+        '''
+        :returns (data, errors): data encrypted for self.recipient,
+        without compressing, and what gpg wrote to stderr
+        '''
+        child = subprocess.Popen(self._args('-r', self.recipient, '-z', '0',
+                                            '--output', '-', '--encrypt', '-'),
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+        return child.communicate(data)
+
+    def decrypt_reader(self, fh):
+        '''
+        :returns: file-like object of the plaintext of the encrypted
+        bytes read from fh
+        '''
+        ## --output - must appear before --decrypt -
+        return subprocess_reader(self._args('--output', '-', '--decrypt', '-'), stdin=fh)
+
+    def encrypt_writer(self, fh):
+        '''
+        :returns: file-like object that encrypts what is written to it
+        for self.recipient, without compressing, into fh, and closes
+        fh when it is closed
+        '''
+        return subprocess_writer(self._args('-r', self.recipient, '-z', '0',
+                                            '--output', '-', '--encrypt', '-'), fh)
+
+    def close(self):
+        'remove the home directory, if this made it'
+        if self._own_homedir and self.homedir is not None:
+            try:
+                ## gpg 2 starts an agent for each home directory
+                subprocess.call(['gpgconf', '--homedir', self.homedir, '--kill', 'gpg-agent'],
+                                stdout=open(os.devnull, 'wb'), stderr=subprocess.STDOUT)
+            except OSError:
+                pass
+            shutil.rmtree(self.homedir, ignore_errors=True)
+            self.homedir = None
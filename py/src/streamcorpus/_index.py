@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+'''
+Provides a sidecar index for streamcorpus.Chunk files that maps each
+stream_id and doc_id to the byte offset and length of its serialized
+message, so that a single message can be read and decoded without
+deserializing the rest of the chunk.
+
+Offsets always refer to the uncompressed stream of messages, so the
+same index works for .sc, .sc.gz and .sc.xz versions of a chunk.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+
+import os
+import logging
+logger = logging.getLogger('streamcorpus')
+
+INDEX_SUFFIX = '.idx'
+INDEX_HEADER = '#streamcorpus-index'
+INDEX_FORMAT_VERSION = 1
+
+def index_path(path):
+    '''
+    path of the sidecar index for a chunk stored at path
+    '''
+    return path + INDEX_SUFFIX
+
+class ChunkIndex(object):
+    '''
+    Byte offset and length of every message in a chunk, looked up by
+    stream_id or doc_id.
+    '''
+    def __init__(self):
+        ## list of (offset, length, stream_id, doc_id) in chunk order
+        self._entries = []
+        self._by_stream_id = {}
+        self._by_doc_id = {}
+
+    def add(self, offset, length, stream_id=None, doc_id=None):
+        'record the position of the next message in the chunk'
+        pos = len(self._entries)
+        self._entries.append((offset, length, stream_id, doc_id))
+        if stream_id is not None:
+            self._by_stream_id[stream_id] = pos
+        if doc_id is not None:
+            self._by_doc_id.setdefault(doc_id, []).append(pos)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        '''
+        Iterator over (offset, length, stream_id, doc_id) tuples in
+        the order that the messages appear in the chunk
+        '''
+        return iter(self._entries)
+
+    def __getitem__(self, pos):
+        'the (offset, length, stream_id, doc_id) of the message at pos'
+        return self._entries[pos]
+
+    def __contains__(self, stream_id):
+        return stream_id in self._by_stream_id
+
+    @property
+    def end_offset(self):
+        'offset of the first byte after the last indexed message'
+        if not self._entries:
+            return 0
+        offset, length, stream_id, doc_id = self._entries[-1]
+        return offset + length
+
+    def find(self, stream_id):
+        '''
+        :returns (offset, length): of the message with this stream_id
+        :raises KeyError: if stream_id is not in the index
+        '''
+        offset, length, _, _ = self._entries[self._by_stream_id[stream_id]]
+        return offset, length
+
+    def find_doc_id(self, doc_id):
+        '''
+        :returns: list of (offset, length) for all messages with this
+        doc_id, which may be empty
+        '''
+        return [self._entries[pos][:2] for pos in self._by_doc_id.get(doc_id, [])]
+
+    def dump(self, fh):
+        '''
+        write the index as tab-separated text to an open file handle
+        '''
+        fh.write('%s\t%d\t%d\n' % (INDEX_HEADER, INDEX_FORMAT_VERSION, self.end_offset))
+        for offset, length, stream_id, doc_id in self._entries:
+            fh.write('%d\t%d\t%s\t%s\n' % (offset, length, stream_id or '', doc_id or ''))
+
+    @classmethod
+    def load(cls, fh):
+        '''
+        construct a ChunkIndex from a file handle written by dump
+        '''
+        header = fh.readline().rstrip('\n').split('\t')
+        if header[0] != INDEX_HEADER or int(header[1]) != INDEX_FORMAT_VERSION:
+            raise ValueError('not a streamcorpus chunk index: %r' % header)
+        index = cls()
+        for line in fh:
+            offset, length, stream_id, doc_id = line.rstrip('\n').split('\t')
+            index.add(int(offset), int(length), stream_id or None, doc_id or None)
+        if index.end_offset != int(header[2]):
+            raise ValueError('truncated chunk index: end_offset=%d != %s' % (
+                    index.end_offset, header[2]))
+        return index
+
+    def save(self, path):
+        '''
+        write the index to the sidecar file for the chunk at path
+        '''
+        tmp_path = index_path(path) + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            self.dump(fh)
+        os.rename(tmp_path, index_path(path))
+
+    @classmethod
+    def from_sidecar(cls, path):
+        '''
+        load the sidecar index for the chunk at path, or return None
+        if there is no usable sidecar
+        '''
+        ipath = index_path(path)
+        if not os.path.exists(ipath):
+            return None
+        try:
+            with open(ipath, 'rb') as fh:
+                return cls.load(fh)
+        except ValueError, exc:
+            logger.warn('ignoring unusable index %s: %s', ipath, exc)
+            return None
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+'''
+Lazily decoded Thrift messages for streamcorpus.Chunk(lazy=True).
+
+A lazy message holds the serialized bytes of the top-level message it
+came from.  Scalar fields and small structs, like stream_time, are
+decoded up front.  Containers, like other_content and ratings, and
+structs that contain containers, like body, are decoded the first time
+that they are accessed, and then cached as ordinary attributes.
+Accessing a lazy struct, like body, gives another lazy message whose
+own containers, like body.sentences, are also decoded on demand.
+
+Lazy messages are instances of subclasses of the generated ttypes
+classes, so they work with isinstance checks, Chunk.add, serialize
+and ==.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+
+from thrift.Thrift import TType
+from thrift.transport import TTransport
+
+from _chunk import protocol, project_thrift_spec, _decode
+
+_CONTAINERS = (TType.MAP, TType.LIST, TType.SET)
+
+## map from generated class to its lazy subclass
+_lazy_classes = {}
+
+def _is_small(spec):
+    '''
+    True if the field described by spec is cheap enough to decode up
+    front: anything other than a container or a struct that has
+    containers or structs in it.
+    '''
+    if spec[1] in _CONTAINERS:
+        return False
+    if spec[1] == TType.STRUCT:
+        cls, cls_spec = spec[3]
+        for sub in cls_spec:
+            if sub is not None and (sub[1] in _CONTAINERS or sub[1] == TType.STRUCT):
+                return False
+    return True
+
+def _nested_spec(root_spec, path, fields):
+    '''
+    thrift_spec for decoding only fields of the struct reached by
+    following the field names in path from the root message
+    '''
+    if not path:
+        return project_thrift_spec(root_spec, fields)
+    projected = []
+    for spec in root_spec:
+        if spec is None or spec[2] != path[0]:
+            projected.append(None)
+        else:
+            fid, ftype, name, (cls, cls_spec), default = spec
+            projected.append((fid, ftype, name,
+                              (cls, _nested_spec(cls_spec, path[1:], fields)),
+                              default))
+    return tuple(projected)
+
+def lazy_message(cls):
+    '''
+    Returns the lazy subclass of a Thrift-generated class.
+    '''
+    if cls not in _lazy_classes:
+        eager = []
+        lazy_structs = {}
+        pending = []
+        for spec in cls.thrift_spec:
+            if spec is None:
+                continue
+            elif _is_small(spec):
+                eager.append(spec[2])
+            else:
+                pending.append(spec[2])
+                if spec[1] == TType.STRUCT:
+                    lazy_structs[spec[2]] = spec[3][0]
+        _lazy_classes[cls] = type('Lazy' + cls.__name__, (_LazyMixin, cls), dict(
+                _lazy_base=cls,
+                _lazy_eager=tuple(eager),
+                _lazy_structs=lazy_structs,
+                _lazy_fields=frozenset(pending),
+                ))
+    return _lazy_classes[cls]
+
+def lazy_thrift_spec(cls):
+    '''
+    thrift_spec that decodes only the fields of cls that lazy
+    instances of it decode up front
+    '''
+    return _nested_spec(cls.thrift_spec, (), lazy_message(cls)._lazy_eager)
+
+def from_decoded(msg, blob):
+    '''
+    Construct a lazy message from msg, which was decoded from blob
+    using lazy_thrift_spec(type(msg)).
+    '''
+    cls = type(msg)
+    return lazy_message(cls)._lazy_wrap(msg, cls, (), blob)
+
+def from_blob(cls, blob):
+    '''
+    Construct a lazy instance of cls from the serialized bytes of one
+    message, decoding only its small fields.
+    '''
+    return lazy_message(cls)._lazy_load(cls, (), blob)
+
+class _LazyMixin(object):
+    '''
+    Defines __getattr__ to decode fields that have not been accessed
+    yet.  Subclasses created by lazy_message do not declare
+    __slots__, so they inherit the __slots__ of the generated class
+    and keep their own bookkeeping in __dict__.
+    '''
+    @classmethod
+    def _lazy_load(cls, root, path, blob):
+        '''
+        Decode the small fields of the struct reached by path in the
+        root message serialized in blob, or return None if that
+        struct is not set.
+        '''
+        msg = _decode_blob(root, blob, path, cls._lazy_eager)
+        for name in path:
+            msg = getattr(msg, name)
+            if msg is None:
+                return None
+        return cls._lazy_wrap(msg, root, path, blob)
+
+    @classmethod
+    def _lazy_wrap(cls, msg, root, path, blob):
+        self = cls.__new__(cls)
+        for name in cls._lazy_eager:
+            setattr(self, name, getattr(msg, name))
+        self.__dict__['_lazy_root'] = root
+        self.__dict__['_lazy_path'] = path
+        self.__dict__['_lazy_blob'] = blob
+        self.__dict__['_lazy_pending'] = set(cls._lazy_fields)
+        return self
+
+    def __getattr__(self, name):
+        ## only called when the slot for name has never been set
+        pending = self.__dict__.get('_lazy_pending', ())
+        if name not in pending:
+            raise AttributeError(name)
+        root = self._lazy_root
+        path = self._lazy_path
+        blob = self._lazy_blob
+        if name in self._lazy_structs:
+            value = lazy_message(self._lazy_structs[name])._lazy_load(
+                root, path + (name,), blob)
+        else:
+            value = _decode_blob(root, blob, path, [name])
+            for step in path:
+                value = getattr(value, step)
+            value = getattr(value, name)
+        setattr(self, name, value)
+        pending.discard(name)
+        if not pending:
+            ## nothing left to decode, so stop holding the bytes
+            del self.__dict__['_lazy_blob']
+        return value
+
+    def __eq__(self, other):
+        if not isinstance(other, self._lazy_base):
+            return False
+        for attr in self.__slots__:
+            if getattr(self, attr) != getattr(other, attr):
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __repr__(self):
+        L = ['%s=%r' % (key, getattr(self, key))
+             for key in self.__slots__]
+        return '%s(%s)' % (self._lazy_base.__name__, ', '.join(L))
+
+    def __reduce__(self):
+        ## pickle as a fully decoded instance of the generated class
+        return (_unpickle, (self._lazy_base,
+                            [getattr(self, key) for key in self.__slots__]))
+
+def _unpickle(cls, values):
+    msg = cls()
+    for key, value in zip(cls.__slots__, values):
+        setattr(msg, key, value)
+    return msg
+
+_spec_cache = {}
+
+def _decode_blob(root, blob, path, fields):
+    '''
+    Decode only fields of the struct at path in the root message
+    serialized in blob, and return the root message
+    '''
+    key = (root, path, tuple(fields))
+    if key not in _spec_cache:
+        _spec_cache[key] = _nested_spec(root.thrift_spec, path, fields)
+    msg = root()
+    _decode(msg, protocol(TTransport.TMemoryBuffer(blob)), _spec_cache[key])
+    return msg
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+'''
+Provides ParallelChunkReader, which decodes the messages in one or
+more streamcorpus.Chunk files in a pool of worker processes.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+
+import Queue
+import cPickle
+import logging
+import traceback
+import collections
+import multiprocessing
+logger = logging.getLogger('streamcorpus')
+
+from _chunk import Chunk
+from _codecs import codec_for_path
+from ttypes import StreamItem as StreamItem_v0_3_0
+
+class ParallelChunkReader(object):
+    '''
+    Iterator over the messages in a list of chunk files, decoded in a
+    pool of worker processes.
+
+    Each chunk is split into batches of consecutive messages.  For
+    uncompressed chunks, workers read their batch directly from the
+    file using the chunk's ChunkIndex, so only offsets cross the
+    process boundary.  For compressed chunks, this process
+    decompresses and splits the stream with Chunk.iter_raw and sends
+    the raw bytes of each batch to a worker.
+
+    Speedup comes only from work done in the workers by func.
+    Without func, a worker could only send the bytes of each message
+    back to be decoded again here, which is slower than decoding them
+    here in the first place, so the messages are read in this process
+    as by Chunk, and no pool is started.
+    '''
+    def __init__(self, paths, message=StreamItem_v0_3_0, func=None,
+                 fields=None, ordered=True, num_workers=None,
+                 max_in_flight=None, batch_bytes=2**22):
+        '''
+        :param paths: path to a chunk, or list of paths
+
+        :param message: Thrift-generated class of the messages
+
+        :param func: a picklable function, e.g. defined at module
+        level, that is called in a worker on each message.  Its return
+        values are yielded instead of the messages, except that None
+        is skipped, so func can also act as a filter.  If None, the
+        messages are yielded, decoded in this process.
+
+        :param fields: decode only these fields, as in Chunk(fields=)
+
+        :param ordered: if True, yield results in the order of the
+        messages in paths; otherwise yield each batch as soon as it is
+        done.
+
+        :param num_workers: number of processes, defaults to the
+        number of CPUs
+
+        :param max_in_flight: maximum number of batches that have
+        been handed to workers but not yet yielded, which bounds
+        memory use.  Defaults to twice num_workers.
+
+        :param batch_bytes: approximate number of serialized bytes in
+        each batch
+        '''
+        if isinstance(paths, basestring):
+            paths = [paths]
+        ## fail here rather than hanging on a task that the pool
+        ## cannot send to a worker
+        cPickle.dumps((message, func, fields), 2)
+        self.paths = paths
+        self.message = message
+        self.func = func
+        self.fields = fields
+        self.ordered = ordered
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.max_in_flight = max_in_flight or 2 * self.num_workers
+        self.batch_bytes = batch_bytes
+
+    def _batches(self):
+        '''
+        generate (path, offset, length, data) tasks, where either data
+        or path, offset and length describe a run of whole messages
+        '''
+        for path in self.paths:
+            ## workers cannot seek into compressed chunks directly
+            if path.endswith('.gpg') or codec_for_path(path) is not None:
+                blobs = []
+                size = 0
+                for blob in Chunk(path=path, mode='rb', message=self.message).iter_raw():
+                    blobs.append(blob)
+                    size += len(blob)
+                    if size >= self.batch_bytes:
+                        yield None, None, None, ''.join(blobs)
+                        blobs = []
+                        size = 0
+                if blobs:
+                    yield None, None, None, ''.join(blobs)
+            else:
+                index = Chunk(path=path, mode='rb', message=self.message).index
+                start = None
+                end = None
+                for offset, length, _, _ in index:
+                    if start is None:
+                        start = offset
+                    end = offset + length
+                    if end - start >= self.batch_bytes:
+                        yield path, start, end - start, None
+                        start = None
+                if start is not None:
+                    yield path, start, end - start, None
+
+    def _tasks(self):
+        for path, offset, length, data in self._batches():
+            yield (self.message, self.fields, self.func, path, offset, length, data)
+
+    def __iter__(self):
+        if self.func is None:
+            for path in self.paths:
+                for msg in Chunk(path=path, mode='rb', message=self.message,
+                                 fields=self.fields):
+                    yield msg
+            return
+        pool = multiprocessing.Pool(self.num_workers)
+        try:
+            if self.ordered:
+                results = self._ordered(pool)
+            else:
+                results = self._unordered(pool)
+            for batch in results:
+                for result in _unpack(batch):
+                    yield result
+            pool.close()
+        finally:
+            ## also stops the workers when the caller abandons us
+            pool.terminate()
+            pool.join()
+
+    def _ordered(self, pool):
+        pending = collections.deque()
+        for task in self._tasks():
+            pending.append(pool.apply_async(_run_batch, (task,)))
+            if len(pending) >= self.max_in_flight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def _unordered(self, pool):
+        ## _run_batch catches all exceptions, so the callback is
+        ## always called
+        done = Queue.Queue()
+        in_flight = 0
+        for task in self._tasks():
+            pool.apply_async(_run_batch, (task,), callback=done.put)
+            in_flight += 1
+            if in_flight >= self.max_in_flight:
+                yield done.get()
+                in_flight -= 1
+        while in_flight:
+            yield done.get()
+            in_flight -= 1
+
+def _run_batch(task):
+    '''
+    decode one batch in a worker process
+
+    :returns (error, results): where error is a formatted traceback
+    or None, and results are what func returned other than None
+    '''
+    message, fields, func, path, offset, length, data = task
+    try:
+        if data is None:
+            with open(path, 'rb') as fh:
+                fh.seek(offset)
+                data = fh.read(length)
+        results = []
+        for msg in Chunk(data=data, mode='rb', message=message, fields=fields):
+            result = func(msg)
+            if result is not None:
+                results.append(result)
+        return None, results
+    except Exception:
+        return traceback.format_exc(), None
+
+def _unpack(batch):
+    error, results = batch
+    if error is not None:
+        raise Exception('worker failed:\n%s' % error)
+    return results
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+'''
+Provides RollingChunkWriter, which writes a stream of messages into a
+directory of streamcorpus.Chunk files, starting a new file whenever
+the current one is full or the date_hour of the messages changes.
+
+Files are named like the KBA corpus, by the date_hour of their first
+message, the number of messages and the md5 of their serialized
+messages:
+
+    <output_dir>/2012-01-01-12/news-150-<md5>.sc.xz
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+
+import os
+import uuid
+import logging
+logger = logging.getLogger('streamcorpus')
+
+from _chunk import Chunk
+from _codecs import get_codec
+from ttypes import StreamItem as StreamItem_v0_3_0
+
+PATH_FORMAT = '%(date_hour)s/%(name)s-%(count)d-%(md5)s.sc%(ext)s'
+
+## date_hour of messages that have no stream_time
+NO_DATE_HOUR = 'no-date-hour'
+
+class RollingChunkWriter(object):
+    '''
+    Writes messages into a series of chunk files under output_dir.
+    The paths of the finished files are in self.paths, in the order
+    that they were closed.
+    '''
+    def __init__(self, output_dir, name='chunk', max_items=500, max_bytes=None,
+                 split_by_date_hour=True, compression='xz', path_format=PATH_FORMAT,
+                 message=StreamItem_v0_3_0, **chunk_kwargs):
+        '''
+        :param output_dir: directory under which files are written
+
+        :param name: name of the files, such as the source of the
+        messages, e.g. 'news'
+
+        :param max_items: start a new file after this many messages,
+        or never if None
+
+        :param max_bytes: start a new file once this many serialized,
+        uncompressed bytes have been written to the current one, or
+        never if None
+
+        :param split_by_date_hour: if True, start a new file whenever
+        the date_hour of a message, as from get_date_hour, differs from
+        that of the messages in the current file.  Messages without a
+        stream_time have the date_hour NO_DATE_HOUR.
+
+        :param compression: codec name for every file, e.g. 'xz',
+        'gzip' or 'none'; see streamcorpus.get_codec
+
+        :param path_format: path of each file relative to output_dir,
+        filled in with date_hour, name, count, md5 and ext, the
+        extension of the codec
+
+        :param chunk_kwargs: passed to Chunk for every file, e.g.
+        compression_level, write_thread or trailer
+        '''
+        self.output_dir = output_dir
+        self.name = name
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.split_by_date_hour = split_by_date_hour
+        self.path_format = path_format
+        self.message = message
+        self.compression = compression
+        codec = get_codec(compression)
+        self._ext = codec and codec.extensions[0] or ''
+        assert 'checksum' not in chunk_kwargs, 'file names need checksum=md5'
+        self._chunk_kwargs = chunk_kwargs
+        self.paths = []
+        self._chunk = None
+        self._tmp_path = None
+        self._date_hour = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is not None:
+            self._discard()
+        else:
+            self.close()
+
+    def add(self, msg):
+        'add a message, starting a new file first if needed'
+        date_hour = self._get_date_hour(msg)
+        if self._chunk is not None and self._is_full(date_hour):
+            self._finish()
+        if self._chunk is None:
+            self._start(date_hour)
+        self._chunk.add(msg)
+
+    def add_many(self, msgs):
+        'add every message in the iterable msgs'
+        for msg in msgs:
+            self.add(msg)
+
+    def _get_date_hour(self, msg):
+        ## like get_date_hour, but for messages of any version,
+        ## including lazy ones
+        stream_time = getattr(msg, 'stream_time', None)
+        if stream_time is None or not stream_time.zulu_timestamp:
+            return NO_DATE_HOUR
+        return stream_time.zulu_timestamp.split(':')[0].replace('T', '-')
+
+    def _is_full(self, date_hour):
+        chunk = self._chunk
+        if self.max_items is not None and len(chunk) >= self.max_items:
+            return True
+        if self.max_bytes is not None and chunk.end_offset >= self.max_bytes:
+            return True
+        if self.split_by_date_hour and date_hour != self._date_hour:
+            return True
+        return False
+
+    def _start(self, date_hour):
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        ## the name depends on the md5, so write to a temporary file
+        ## on the same file system, and rename it in _finish
+        self._tmp_path = os.path.join(
+            self.output_dir, '.%s-%s.sc%s.tmp' % (self.name, uuid.uuid4().hex, self._ext))
+        self._chunk = Chunk(self._tmp_path, mode='wb', message=self.message,
+                            compression=self.compression, **self._chunk_kwargs)
+        self._date_hour = date_hour
+
+    def _finish(self):
+        '''
+        close the current file and move it to its final name
+        '''
+        chunk = self._chunk
+        self._chunk = None
+        chunk.close()
+        path = os.path.join(self.output_dir, self.path_format % dict(
+                date_hour=self._date_hour, name=self.name, count=len(chunk),
+                md5=chunk.md5_hexdigest, ext=self._ext))
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        os.rename(self._tmp_path, path)
+        self._tmp_path = None
+        self.paths.append(path)
+        logger.debug('wrote %d messages to %s', len(chunk), path)
+
+    def _discard(self):
+        'remove the current, unfinished file'
+        if self._chunk is not None:
+            try:
+                self._chunk.close()
+            except Exception, exc:
+                logger.warn('failed to close %s: %r', self._tmp_path, exc)
+            self._chunk = None
+        if self._tmp_path is not None and os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+        self._tmp_path = None
+
+    def close(self):
+        'finish the current file, if any messages were added to it'
+        if self._chunk is not None:
+            self._finish()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+'''
+Provides the optional trailer that Chunk(trailer=True) writes after
+the last message of a chunk.  It records the number of messages, the
+offset of each one, the range of their stream_times and the checksum
+of their bytes, so that the size of a chunk is known, and any message
+can be read, without decoding the whole chunk.
+
+The trailer is laid out so that readers that do not know about it
+stop quietly in front of it.  It starts like a thrift field of type
+string, with a field id that no StreamItem uses, and a length that
+runs one byte past the end of the chunk.  Decoding it as a message
+skips the unknown field, runs out of bytes and raises EOFError, which
+readers treat as the end of the chunk.  Chunk itself recognizes the
+header at any message boundary and skips exactly the bytes of the
+trailer, so chunks written with trailers can still be concatenated.
+A fixed-size footer at the very end lets readers that can seek find
+the trailer directly:
+
+    \\x0b\\x7f\\xff  <length: i32>  <body>  <trailer size: u32> SCTRAILR
+
+Offsets refer to the uncompressed stream of messages, as in the
+sidecar ChunkIndex.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+
+import struct
+
+## thrift field header of type STRING (11) and field id 32767
+TRAILER_HEADER = '\x0b\x7f\xff'
+TRAILER_FORMAT_VERSION = 1
+FOOTER_MAGIC = 'SCTRAILR'
+
+_length = struct.Struct('>i')
+_body = struct.Struct('>BIQdd')
+_footer = struct.Struct('>I8s')
+
+## number of leading bytes that trailer_size needs
+TRAILER_PREFIX_SIZE = len(TRAILER_HEADER) + _length.size
+
+def trailer_size(prefix):
+    '''
+    :returns: the number of bytes in the trailer that starts with
+    prefix, the first TRAILER_PREFIX_SIZE bytes of it
+    '''
+    length, = _length.unpack(prefix[len(TRAILER_HEADER):TRAILER_PREFIX_SIZE])
+    ## the length field runs one byte past the trailer
+    return TRAILER_PREFIX_SIZE + length - 1
+
+class ChunkTrailer(object):
+    '''
+    Count, offsets, stream_time range and checksum of the messages in
+    a chunk.
+    '''
+    def __init__(self):
+        ## offset of the start of each message, in chunk order
+        self.offsets = []
+        ## offset of the first byte after the last message
+        self.end_offset = 0
+        ## range of stream_time.epoch_ticks, or None if no message
+        ## had a stream_time
+        self.min_stream_time = None
+        self.max_stream_time = None
+        ## name and hexdigest of the checksum of the message bytes,
+        ## e.g. 'md5'; None if the chunk was written without one
+        self.checksum = None
+        self.hexdigest = None
+
+    def add(self, offset, length, epoch_ticks=None):
+        'record the position of the next message in the chunk'
+        self.offsets.append(offset)
+        self.end_offset = offset + length
+        if epoch_ticks is not None:
+            if self.min_stream_time is None or epoch_ticks < self.min_stream_time:
+                self.min_stream_time = epoch_ticks
+            if self.max_stream_time is None or epoch_ticks > self.max_stream_time:
+                self.max_stream_time = epoch_ticks
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def find(self, pos):
+        '''
+        :returns (offset, length): of the message at position pos
+        :raises IndexError: if there is no such message
+        '''
+        if pos < 0:
+            pos += len(self.offsets)
+        offset = self.offsets[pos]
+        if pos + 1 < len(self.offsets):
+            return offset, self.offsets[pos + 1] - offset
+        return offset, self.end_offset - offset
+
+    def dumps(self):
+        '''
+        :returns: serialized bytes of the trailer, including the
+        header and footer
+        '''
+        parts = [_body.pack(TRAILER_FORMAT_VERSION, len(self.offsets), self.end_offset,
+                            _or_nan(self.min_stream_time), _or_nan(self.max_stream_time))]
+        for value in [self.checksum, self.hexdigest]:
+            value = value or ''
+            parts.append(chr(len(value)) + value)
+        parts.append(struct.pack('>%dQ' % len(self.offsets), *self.offsets))
+        body = ''.join(parts)
+        size = len(TRAILER_HEADER) + _length.size + len(body) + _footer.size
+        return ''.join([TRAILER_HEADER,
+                        ## one byte longer than the rest of the chunk
+                        _length.pack(len(body) + _footer.size + 1),
+                        body,
+                        _footer.pack(size, FOOTER_MAGIC)])
+
+    @classmethod
+    def loads(cls, data):
+        '''
+        construct a ChunkTrailer from the bytes written by dumps
+
+        :raises ValueError: if data is not a complete trailer
+        '''
+        if not data.startswith(TRAILER_HEADER):
+            raise ValueError('not a streamcorpus chunk trailer: %r' % data[:8])
+        if len(data) < len(TRAILER_HEADER) + _length.size + _body.size + _footer.size:
+            raise ValueError('truncated chunk trailer of %d bytes' % len(data))
+        size, magic = _footer.unpack(data[-_footer.size:])
+        if magic != FOOTER_MAGIC or size != len(data):
+            raise ValueError('chunk trailer footer %r does not match %d bytes' % (
+                    data[-_footer.size:], len(data)))
+        pos = len(TRAILER_HEADER) + _length.size
+        version, count, end_offset, min_time, max_time = _body.unpack_from(data, pos)
+        if version != TRAILER_FORMAT_VERSION:
+            raise ValueError('unknown chunk trailer version %d' % version)
+        pos += _body.size
+        values = []
+        for name in ['checksum', 'hexdigest']:
+            length = ord(data[pos])
+            values.append(data[pos + 1:pos + 1 + length] or None)
+            pos += 1 + length
+        offsets = struct.unpack_from('>%dQ' % count, data, pos)
+        if pos + 8 * count + _footer.size != len(data):
+            raise ValueError('chunk trailer has %d bytes left over' % (
+                    len(data) - pos - 8 * count - _footer.size))
+        trailer = cls()
+        trailer.offsets = list(offsets)
+        trailer.end_offset = end_offset
+        trailer.min_stream_time = _or_none(min_time)
+        trailer.max_stream_time = _or_none(max_time)
+        trailer.checksum, trailer.hexdigest = values
+        return trailer
+
+    @classmethod
+    def from_data(cls, data):
+        '''
+        load the trailer at the end of the bytes of a whole chunk, such
+        as a memory map, or return None if the chunk has no trailer
+        that covers all of it
+        '''
+        if len(data) < _footer.size:
+            return None
+        size, magic = _footer.unpack(data[-_footer.size:])
+        if magic != FOOTER_MAGIC or size > len(data):
+            return None
+        return _whole(cls.loads(data[-size:]), len(data) - size)
+
+    @classmethod
+    def from_file(cls, fh):
+        '''
+        load the trailer at the end of a seekable, uncompressed chunk
+        file, or return None if it has no trailer that covers all of
+        it.  The position of fh is restored.
+        '''
+        pos = fh.tell()
+        try:
+            fh.seek(0, 2)
+            file_size = fh.tell()
+            if file_size < _footer.size:
+                return None
+            fh.seek(file_size - _footer.size)
+            size, magic = _footer.unpack(fh.read(_footer.size))
+            if magic != FOOTER_MAGIC or size > file_size:
+                return None
+            fh.seek(file_size - size)
+            return _whole(cls.loads(fh.read(size)), file_size - size)
+        finally:
+            fh.seek(pos)
+
+def _whole(trailer, start):
+    '''
+    trailer, if it starts at offset start right after the messages
+    that it covers, or None if it only covers the last of several
+    chunks that were concatenated
+    '''
+    if trailer.end_offset != start:
+        return None
+    return trailer
+
+def _or_nan(value):
+    if value is None:
+        return float('nan')
+    return value
+
+def _or_none(value):
+    if value != value:
+        ## NaN
+        return None
+    return value
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+'''
+Converts StreamItems from the older v0_1_0 and v0_2_0 versions of
+streamcorpus.thrift to the current v0_3_0, for Chunk(upgrade=True).
+
+v0_2_0 and v0_3_0 number their fields the same way, so a v0_2_0
+message is decoded straight into the v0_3_0 classes by fastbinary,
+using a thrift_spec that reads the few fields whose types changed
+with their old types.  Only relation names and pronoun tokens need
+fixing up afterwards, which happens in Python.
+
+v0_1_0 was the KBA 2012 format, with different fields, so it is
+decoded as v0_1_0 and copied into v0_3_0 structures: title and anchor
+become other_content, cleansed becomes clean_visible, and the NER
+output becomes the raw_tagging of a 'stanford' tagging.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+
+from thrift.Thrift import TType
+from thrift.transport import TTransport
+
+from _chunk import protocol, serialize, _decode, VersionMismatchError
+from ttypes import StreamItem as StreamItem_v0_3_0, ContentItem, Tagging, \
+    StreamTime, RelationType, Versions, EntityType, MentionType, Gender, \
+    Attribute, AttributeType
+from ttypes_v0_1_0 import StreamItem as StreamItem_v0_1_0
+from ttypes_v0_2_0 import StreamItem as StreamItem_v0_2_0
+
+_CONTAINERS = (TType.LIST, TType.SET)
+
+def _compat_type(ttype, args, source_type, source_args):
+    '''
+    (type, args) for decoding a field stored as source_type into the
+    target classes; a field whose type changed keeps its stored type
+    '''
+    if ttype != source_type:
+        return source_type, source_args
+    if ttype == TType.STRUCT:
+        cls = args[0]
+        return ttype, (cls, compat_thrift_spec(cls.thrift_spec, source_args[1]))
+    if ttype in _CONTAINERS:
+        return ttype, _compat_type(args[0], args[1], source_args[0], source_args[1])
+    if ttype == TType.MAP:
+        return ttype, (_compat_type(args[0], args[1], source_args[0], source_args[1]) +
+                       _compat_type(args[2], args[3], source_args[2], source_args[3]))
+    return ttype, args
+
+def compat_thrift_spec(thrift_spec, source_spec):
+    '''
+    Construct a thrift_spec for decoding messages written with
+    source_spec into the classes of thrift_spec, matching fields by
+    number.  Fields that are only in source_spec are skipped.
+    '''
+    source_fields = dict((spec[0], spec) for spec in source_spec if spec is not None)
+    compat = []
+    for spec in thrift_spec:
+        if spec is None or spec[0] not in source_fields:
+            compat.append(spec)
+            continue
+        fid, ftype, name, args, default = spec
+        source = source_fields[fid]
+        ftype, args = _compat_type(ftype, args, source[1], source[3])
+        compat.append((fid, ftype, name, args, default))
+    return tuple(compat)
+
+## thrift_spec for decoding v0_2_0 bytes into StreamItem_v0_3_0
+v0_2_0_thrift_spec = compat_thrift_spec(StreamItem_v0_3_0.thrift_spec,
+                                        StreamItem_v0_2_0.thrift_spec)
+
+def _relation_type(name):
+    '''
+    v0_2_0 relation names follow ACE, e.g. PER-SOC.Lasting-Personal;
+    RelationType makes the replacements s/-// and s/./_/
+    '''
+    if not isinstance(name, basestring):
+        return name
+    return RelationType._NAMES_TO_VALUES.get(name.replace('-', '').replace('.', '_'))
+
+## v0_2_0 EntityType values that v0_3_0 replaced with entity_type PER,
+## mention_type PRO and a PER_GENDER attribute
+_pronoun_genders = {
+    3: Gender.MALE,    ## MALE_PRONOUN
+    4: Gender.FEMALE,  ## FEMALE_PRONOUN
+    }
+
+def _fix_pronouns(ci, tagger_id, sentences):
+    attributes = None
+    mentions = set()
+    for sentence_id, sentence in enumerate(sentences):
+        for token in sentence.tokens:
+            gender = _pronoun_genders.get(token.entity_type)
+            if gender is None:
+                continue
+            token.entity_type = EntityType.PER
+            token.mention_type = MentionType.PRO
+            ## one attribute for each mention, or for each token
+            ## that is not part of a mention
+            if token.mention_id != -1:
+                if (sentence_id, token.mention_id) in mentions:
+                    continue
+                mentions.add((sentence_id, token.mention_id))
+            if attributes is None:
+                attributes = ci.attributes.setdefault(tagger_id, [])
+            attributes.append(Attribute(attribute_type=AttributeType.PER_GENDER,
+                                        evidence=token.token, value=str(gender),
+                                        sentence_id=sentence_id,
+                                        mention_id=token.mention_id))
+
+def _fix_content_item(ci):
+    if ci is None:
+        return
+    if ci.relations:
+        for relations in ci.relations.values():
+            for relation in relations:
+                relation.relation_type = _relation_type(relation.relation_type)
+    if ci.sentences:
+        for tagger_id, sentences in ci.sentences.items():
+            _fix_pronouns(ci, tagger_id, sentences)
+
+def fix_v0_2_0(si):
+    '''
+    finish upgrading a StreamItem_v0_3_0 decoded from v0_2_0 bytes
+    with v0_2_0_thrift_spec
+    '''
+    si.version = Versions.v0_3_0
+    _fix_content_item(si.body)
+    if si.other_content:
+        for ci in si.other_content.values():
+            _fix_content_item(ci)
+    return si
+
+def _content_item_v0_1_0(ci):
+    if ci is None:
+        return None
+    new = ContentItem(raw=ci.raw, encoding=ci.encoding, clean_visible=ci.cleansed)
+    if ci.ner is not None:
+        new.taggings['stanford'] = Tagging(tagger_id='stanford', raw_tagging=ci.ner)
+    return new
+
+def upgrade_v0_1_0(si):
+    '''
+    :returns: StreamItem_v0_3_0 with the content of a
+    StreamItem_v0_1_0
+    '''
+    new = StreamItem_v0_3_0(
+        doc_id=si.doc_id,
+        abs_url=si.abs_url,
+        schost=si.schost,
+        original_url=si.original_url,
+        source=si.source,
+        body=_content_item_v0_1_0(si.body),
+        stream_id=si.stream_id,
+        )
+    if si.stream_time is not None:
+        new.stream_time = StreamTime(epoch_ticks=si.stream_time.epoch_ticks,
+                                     zulu_timestamp=si.stream_time.zulu_timestamp)
+    for name in ['title', 'anchor']:
+        ci = _content_item_v0_1_0(getattr(si, name))
+        if ci is not None:
+            new.other_content[name] = ci
+    if si.source_metadata is not None:
+        new.source_metadata['kba-2012'] = si.source_metadata
+    return new
+
+def upgrade_stream_item(si):
+    '''
+    :returns: a StreamItem_v0_3_0 with the content of si, which may
+    be a StreamItem of any version
+    '''
+    if isinstance(si, StreamItem_v0_3_0):
+        return si
+    if isinstance(si, StreamItem_v0_1_0):
+        return upgrade_v0_1_0(si)
+    if isinstance(si, StreamItem_v0_2_0):
+        new = StreamItem_v0_3_0()
+        _decode(new, protocol(TTransport.TMemoryBuffer(serialize(si))), v0_2_0_thrift_spec)
+        return fix_v0_2_0(new)
+    raise TypeError('cannot upgrade %r' % type(si))
+
+## map from the version field of a message to its class
+_classes_by_version = {
+    StreamItem_v0_2_0().version: StreamItem_v0_2_0,
+    StreamItem_v0_3_0().version: StreamItem_v0_3_0,
+    }
+
+class _version_probe(object):
+    'decoding target that keeps only field 1'
+    version = None
+
+_probe_spec = (None, (1, TType.I32, 'version', None, None))
+
+def sniff_message(i_protocol):
+    '''
+    Decode just the version of the next message from i_protocol, and
+    rewind the transport to the start of that message.  v0_1_0 has no
+    version; its field 1 is a string, which is skipped.
+
+    :returns: StreamItem class of the next message, or None if there
+    are no more messages
+    '''
+    i_transport = i_protocol.trans
+    i_transport.mark()
+    probe = _version_probe()
+    try:
+        _decode(probe, i_protocol, _probe_spec)
+    except EOFError:
+        return None
+    finally:
+        i_transport.rewind()
+    if probe.version is None:
+        return StreamItem_v0_1_0
+    if probe.version not in _classes_by_version:
+        raise VersionMismatchError('unknown StreamItem version %r' % probe.version)
+    return _classes_by_version[probe.version]
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+'''
+Provides Where, a predicate on the small top-level fields of a
+StreamItem that Chunk(where=...) evaluates before decoding the rest
+of each message.  Messages that it rejects are skipped over in the
+binary protocol without ever constructing their body, other_content
+or any other large field:
+
+    where = Where(start_time=1325376000, end_time=1325379600, source='news')
+    for si in Chunk(path, where=where):
+        ...
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+
+class Where(object):
+    '''
+    Conjunction of conditions on stream_time, source, schost,
+    stream_id and version.  Conditions left as None always match.
+    '''
+    def __init__(self, start_time=None, end_time=None, source=None, schost=None,
+                 stream_id_prefix=None, version=None):
+        '''
+        :param start_time: only match messages with a
+        stream_time.epoch_ticks at or after this many seconds since
+        the epoch
+
+        :param end_time: only match messages with a
+        stream_time.epoch_ticks before this many seconds since the
+        epoch
+
+        :param source: a source, such as 'news', or a list of them
+
+        :param schost: a schost, or a list of them
+
+        :param stream_id_prefix: a prefix of stream_id, such as the
+        epoch_ticks part, or a list of them
+
+        :param version: a Versions value, or a list of them.  Chunk
+        still raises VersionMismatchError for any message that does
+        not match its message class unless it is given
+        verify_version=False.
+        '''
+        self.start_time = start_time
+        self.end_time = end_time
+        self.source = _as_set(source)
+        self.schost = _as_set(schost)
+        self.stream_id_prefix = stream_id_prefix
+        if stream_id_prefix is not None and not isinstance(stream_id_prefix, basestring):
+            self.stream_id_prefix = tuple(stream_id_prefix)
+        self.version = _as_set(version, (basestring, int, long))
+
+        ## the top-level fields that __call__ reads
+        self.fields = []
+        if start_time is not None or end_time is not None:
+            self.fields.append('stream_time')
+        for name in ['source', 'schost', 'stream_id_prefix', 'version']:
+            if getattr(self, name) is not None:
+                self.fields.append(name.replace('_prefix', ''))
+
+    def __call__(self, msg):
+        'True if msg, with at least self.fields decoded, matches'
+        if 'stream_time' in self.fields:
+            if msg.stream_time is None or msg.stream_time.epoch_ticks is None:
+                return False
+            if not self.overlaps(msg.stream_time.epoch_ticks, msg.stream_time.epoch_ticks):
+                return False
+        if self.source is not None and msg.source not in self.source:
+            return False
+        if self.schost is not None and msg.schost not in self.schost:
+            return False
+        if self.stream_id_prefix is not None and \
+                not (msg.stream_id or '').startswith(self.stream_id_prefix):
+            return False
+        if self.version is not None and msg.version not in self.version:
+            return False
+        return True
+
+    def overlaps(self, min_time, max_time):
+        '''
+        False if no stream_time from min_time to max_time, inclusive,
+        can match, such as the range recorded in a ChunkTrailer
+        '''
+        if self.start_time is not None and max_time < self.start_time:
+            return False
+        if self.end_time is not None and min_time >= self.end_time:
+            return False
+        return True
+
+    def __repr__(self):
+        conditions = ['%s=%r' % (name, getattr(self, name)) for name in
+                      ['start_time', 'end_time', 'source', 'schost',
+                       'stream_id_prefix', 'version']
+                      if getattr(self, name) is not None]
+        return 'Where(%s)' % ', '.join(conditions)
+
+def _as_set(value, scalars=basestring):
+    if value is None:
+        return None
+    if isinstance(value, scalars):
+        return frozenset([value])
+    return frozenset(value)
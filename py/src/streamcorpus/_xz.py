@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+'''
+In-process reading of .xz files for streamcorpus.Chunk, using
+backports.lzma, with a block-parallel reader for .xz files that
+contain more than one block, such as those written by `xz -T` or
+with --block-size.
+
+If backports.lzma is not installed, .xz files are read through an
+xzcat child process instead.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+
+import zlib
+import bisect
+import struct
+import logging
+import threading
+import subprocess
+import collections
+from multiprocessing.pool import ThreadPool
+logger = logging.getLogger('streamcorpus')
+
+try:
+    from backports import lzma
+except:
+    lzma = None
+
+HEADER_MAGIC = '\xfd7zXZ\x00'
+FOOTER_MAGIC = 'YZ'
+
+class subprocess_reader(object):
+    '''
+    File-like object for reading the stdout of a child process.  The
+    child is reaped when the output reaches EOF, at which point a
+    non-zero exit status raises IOError, or when close is called.
+
+    :param stdin: optional file for the child to read.  If it has no
+    fileno, such as a StringIO, a thread copies it to the child.
+    '''
+    def __init__(self, args, shell=False, stdin=None):
+        self._args = args
+        source = None
+        if stdin is not None and not hasattr(stdin, 'fileno'):
+            source = stdin
+            stdin = subprocess.PIPE
+        self._child = subprocess.Popen(
+            args, shell=shell,
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        if source is not None:
+            feeder = threading.Thread(target=_feed, args=(source, self._child.stdin))
+            feeder.daemon = True
+            feeder.start()
+
+    def read(self, size=-1):
+        if self._child is None:
+            return ''
+        data = self._child.stdout.read(size)
+        if not data and size != 0:
+            self._reap()
+        return data
+
+    def _reap(self):
+        child = self._child
+        self._child = None
+        child.stdout.close()
+        errors = child.stderr.read()
+        child.stderr.close()
+        if child.wait() != 0:
+            raise IOError('%r exited with status %d: %s' % (
+                    self._args, child.returncode, errors))
+
+    def close(self):
+        if self._child is not None:
+            ## stop the child if it has not finished
+            if self._child.poll() is None:
+                self._child.kill()
+            self._child.stdout.close()
+            self._child.stderr.close()
+            self._child.wait()
+            self._child = None
+
+class subprocess_writer(object):
+    '''
+    File-like object for writing to the stdin of a child process,
+    whose stdout goes to the file fh.  close waits for the child, then
+    closes fh, and raises IOError if the child exited with a non-zero
+    status.
+
+    :param fh: file for the child's output.  If it has no fileno,
+    such as a StringIO, a thread copies the output to it.
+    '''
+    def __init__(self, args, fh, shell=False):
+        self._args = args
+        self._fh = fh
+        stdout = fh
+        if not hasattr(fh, 'fileno'):
+            stdout = subprocess.PIPE
+        else:
+            ## the child writes to the file descriptor directly
+            fh.flush()
+        self._child = subprocess.Popen(
+            args, shell=shell,
+            stdin=subprocess.PIPE,
+            stdout=stdout,
+            stderr=subprocess.PIPE)
+        self._threads = []
+        self._errors = []
+        if stdout is subprocess.PIPE:
+            self._start(_drain, self._child.stdout, fh)
+        self._start(_collect, self._child.stderr, self._errors)
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def write(self, data):
+        self._child.stdin.write(data)
+
+    def flush(self):
+        self._child.stdin.flush()
+
+    def close(self):
+        if self._child is None:
+            return
+        child = self._child
+        self._child = None
+        try:
+            child.stdin.close()
+        except IOError:
+            ## the child already exited, which its status reports
+            pass
+        child.wait()
+        for thread in self._threads:
+            thread.join()
+        self._fh.close()
+        if child.returncode != 0:
+            raise IOError('%r exited with status %d: %s' % (
+                    self._args, child.returncode, ''.join(self._errors)))
+
+def _collect(pipe, parts):
+    parts.append(pipe.read())
+    pipe.close()
+
+def _drain(pipe, fh):
+    'copy everything from pipe to fh, which stays open'
+    while True:
+        data = pipe.read(2**16)
+        if not data:
+            break
+        fh.write(data)
+    pipe.close()
+
+def _feed(source, pipe):
+    try:
+        while True:
+            data = source.read(2**16)
+            if not data:
+                break
+            pipe.write(data)
+    except IOError:
+        ## the child exited without reading everything, which the
+        ## reader reports from its exit status
+        pass
+    finally:
+        try:
+            pipe.close()
+        except IOError:
+            pass
+
+def _round4(size):
+    return (size + 3) & ~3
+
+def _crc32(data):
+    return struct.pack('<I', zlib.crc32(data) & 0xffffffff)
+
+def _read_varint(data, pos):
+    '''
+    decode an xz multibyte integer
+    :returns (value, pos): where pos is just past the integer
+    '''
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def _write_varint(value):
+    out = []
+    while value >= 0x80:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return ''.join(out)
+
+def _parse_index(index):
+    '''
+    :returns: list of (unpadded_size, uncompressed_size) records in
+    the index of an .xz stream
+    '''
+    if index[0] != '\0' or _crc32(index[:-4]) != index[-4:]:
+        raise ValueError('corrupt .xz index')
+    num_records, pos = _read_varint(index, 1)
+    records = []
+    for num in xrange(num_records):
+        unpadded, pos = _read_varint(index, pos)
+        uncompressed, pos = _read_varint(index, pos)
+        records.append((unpadded, uncompressed))
+    return records
+
+def _make_index(records):
+    index = '\0' + _write_varint(len(records))
+    for unpadded, uncompressed in records:
+        index += _write_varint(unpadded) + _write_varint(uncompressed)
+    index += '\0' * (-len(index) % 4)
+    return index + _crc32(index)
+
+def _make_footer(flags, index):
+    footer = struct.pack('<I', len(index) // 4 - 1) + flags
+    return _crc32(footer) + footer + FOOTER_MAGIC
+
+def xz_blocks(fh):
+    '''
+    Find every block in every stream of a seekable .xz file by
+    reading the stream footers and indexes from the end of the file.
+
+    :returns: list of (stream_flags, offset, unpadded_size,
+    uncompressed_size) in file order
+    '''
+    fh.seek(0, 2)
+    end = fh.tell()
+    streams = []
+    while end > 0:
+        fh.seek(end - 4)
+        if fh.read(4) == '\0\0\0\0':
+            ## stream padding
+            end -= 4
+            continue
+        fh.seek(end - 12)
+        footer = fh.read(12)
+        if len(footer) != 12 or footer[10:] != FOOTER_MAGIC:
+            raise ValueError('not an .xz file, or truncated')
+        flags = footer[8:10]
+        index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+        index_start = end - 12 - index_size
+        fh.seek(index_start)
+        records = _parse_index(fh.read(index_size))
+        offset = index_start - sum(_round4(unpadded) for unpadded, _ in records)
+        end = offset - 12
+        blocks = []
+        for unpadded, uncompressed in records:
+            blocks.append((flags, offset, unpadded, uncompressed))
+            offset += _round4(unpadded)
+        streams.append(blocks)
+    streams.reverse()
+    return [block for blocks in streams for block in blocks]
+
+def _block_stream(flags, block, unpadded, uncompressed):
+    '''
+    wrap the bytes of one block in its own single-block .xz stream,
+    so it can be decompressed independently of the others
+    '''
+    index = _make_index([(unpadded, uncompressed)])
+    return HEADER_MAGIC + flags + _crc32(flags) + block + index + _make_footer(flags, index)
+
+def _decompress_block(args):
+    return lzma.decompress(_block_stream(*args))
+
+class xz_block_reader(object):
+    '''
+    File-like object that decompresses the blocks of a multi-block
+    .xz file in a pool of threads; backports.lzma releases the GIL
+    while decompressing.  Reads from the file happen in the calling
+    thread, and at most twice as many blocks as threads are held in
+    memory.  Seeking uses the sizes in the .xz index to restart at the
+    block that holds the offset.  Closing it does not close fh.
+    '''
+    def __init__(self, fh, threads, blocks=None):
+        self._fh = fh
+        if blocks is None:
+            blocks = xz_blocks(self._fh)
+        self._blocks = blocks
+        ## uncompressed offset of the start of each block
+        self._starts = []
+        total = 0
+        for flags, offset, unpadded, uncompressed in blocks:
+            self._starts.append(total)
+            total += uncompressed
+        self._pool = ThreadPool(threads)
+        self._lookahead = 2 * threads
+        self.seek(0)
+
+    def seek(self, offset, whence=0):
+        assert whence == 0, 'xz_block_reader only seeks to absolute offsets'
+        self._pending = collections.deque()
+        self._next_block = max(0, bisect.bisect_right(self._starts, offset) - 1)
+        self._buf = ''
+        self._pos = 0
+        self._skip = offset - self._starts[self._next_block] if self._blocks else 0
+
+    def _submit(self):
+        while len(self._pending) < self._lookahead and self._next_block < len(self._blocks):
+            flags, offset, unpadded, uncompressed = self._blocks[self._next_block]
+            self._fh.seek(offset)
+            block = self._fh.read(_round4(unpadded))
+            self._pending.append(self._pool.apply_async(
+                    _decompress_block, ((flags, block, unpadded, uncompressed),)))
+            self._next_block += 1
+
+    def _fill(self):
+        'returns False at EOF'
+        while self._pos >= len(self._buf):
+            self._submit()
+            if not self._pending:
+                return False
+            self._buf = self._pending.popleft().get()
+            self._pos = self._skip
+            self._skip = 0
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if not self._fill():
+                break
+            if size < 0:
+                end = len(self._buf)
+            else:
+                end = min(len(self._buf), self._pos + size)
+                size -= end - self._pos
+            parts.append(self._buf[self._pos:end])
+            self._pos = end
+        return ''.join(parts)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+def _compress_block(args):
+    '''
+    compress data as a standalone .xz stream
+
+    :returns (block, records): the bytes of the blocks in that stream
+    and their index records
+    '''
+    data, preset, check = args
+    stream = lzma.compress(data, format=lzma.FORMAT_XZ, check=check, preset=preset)
+    index_size = (struct.unpack('<I', stream[-8:-4])[0] + 1) * 4
+    index_start = len(stream) - 12 - index_size
+    return stream[12:index_start], _parse_index(stream[index_start:-12])
+
+class xz_block_writer(object):
+    '''
+    File-like object that writes a single-stream .xz file made of
+    independently compressed blocks of about block_size uncompressed
+    bytes, which are compressed in a pool of threads.  The output can
+    be read by any xz tool, and in parallel by xz_block_reader.
+
+    Blocks are only cut between calls to write, so a caller that
+    writes whole messages gets blocks aligned to message boundaries;
+    Chunk does this when message_aligned is True.
+    '''
+    message_aligned = True
+    mode = 'wb'
+
+    def __init__(self, fh, threads=2, block_size=2**24, preset=6, check=None):
+        if lzma is None:
+            raise Exception('backports.lzma is required to write .xz files in-process')
+        if check is None:
+            check = lzma.CHECK_CRC64
+        self._fh = fh
+        self._flags = '\0' + chr(check)
+        self._preset = preset
+        self._check = check
+        self._block_size = block_size
+        self._pool = ThreadPool(threads)
+        self._lookahead = 2 * threads
+        self._pending = collections.deque()
+        self._parts = []
+        self._size = 0
+        self._records = []
+        self._fh.write(HEADER_MAGIC + self._flags + _crc32(self._flags))
+
+    def write(self, data):
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size >= self._block_size:
+            self._cut()
+
+    def _cut(self):
+        if self._size:
+            data = ''.join(self._parts)
+            self._parts = []
+            self._size = 0
+            self._pending.append(self._pool.apply_async(
+                    _compress_block, ((data, self._preset, self._check),)))
+        while len(self._pending) >= self._lookahead:
+            self._write_block()
+
+    def _write_block(self):
+        block, records = self._pending.popleft().get()
+        self._fh.write(block)
+        self._records.extend(records)
+
+    def flush(self):
+        ## flushing does not cut a block, which would hurt compression
+        self._fh.flush()
+
+    def close(self):
+        if self._pool is None:
+            return
+        self._cut()
+        while self._pending:
+            self._write_block()
+        self._pool.close()
+        self._pool = None
+        index = _make_index(self._records)
+        self._fh.write(index + _make_footer(self._flags, index))
+        self._fh.close()
@@ -0,0 +1,58 @@
+'''
+Helpers and fixtures shared by the tests of streamcorpus
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+
+import os
+import glob
+import uuid
+import shutil
+import pytest
+
+from streamcorpus import make_stream_item, ContentItem
+
+def make_si(num, raw=None, epoch_ticks=None):
+    '''
+    StreamItem for http://example.com/<num>
+
+    :param raw: body.raw, defaults to 'hello <num>!'
+
+    :param epoch_ticks: stream_time, defaults to num
+    '''
+    if epoch_ticks is None:
+        epoch_ticks = num
+    if raw is None:
+        raw = 'hello %d!' % num
+    si = make_stream_item(epoch_ticks, 'http://example.com/%d' % num)
+    si.body = ContentItem(raw=raw)
+    return si
+
+def _tmp_name(request):
+    ## e.g. /tmp/test_index-<uuid>
+    return '/tmp/%s-%s' % (request.module.__name__.split('.')[-1], uuid.uuid4())
+
+@pytest.fixture(scope='function')
+def path(request):
+    '''
+    path for a chunk in /tmp, which is removed afterwards along with
+    any file whose name extends it, such as its index or path + '.xz'
+    '''
+    path = _tmp_name(request) + '.sc'
+    def fin():
+        for p in glob.glob(path + '*'):
+            os.remove(p)
+    request.addfinalizer(fin)
+    return path
+
+@pytest.fixture(scope='function')
+def tmp_dir(request):
+    'new directory in /tmp, which is removed afterwards'
+    path = _tmp_name(request)
+    os.makedirs(path)
+    def fin():
+        shutil.rmtree(path, ignore_errors=True)
+    request.addfinalizer(fin)
+    return path
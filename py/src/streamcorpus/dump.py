@@ -11,10 +11,15 @@ from __future__ import absolute_import
 import os
 import sys
 import json
+import shutil
 import logging
+import tempfile
 import itertools
 import collections
-from streamcorpus._chunk import Chunk
+import multiprocessing
+from cStringIO import StringIO
+from streamcorpus._chunk import Chunk, deserialize
+from streamcorpus._where import Where
 from streamcorpus.ttypes import OffsetType, Token, EntityType, MentionType
 
 from streamcorpus.ttypes import StreamItem as StreamItem_v0_3_0
@@ -106,6 +111,25 @@ def smart_repr(x, limit=50, newlineSplitFields=False, indent=1, print_id=False):
     else:
         return '%s(%s)' % (x.__class__.__name__, splitter.join(vals))
 
+def _dump_fields(args):
+    '''
+    Returns the list of StreamItem fields that _dump needs to decode
+    for these args, or None if it needs all of them
+    '''
+    if args.labels_only:
+        return ['stream_id', 'body.sentences']
+    elif args.count:
+        return []
+    elif args.print_url:
+        return ['original_url', 'abs_url']
+    elif not (args.show_all or args.smart_dump):
+        ## .body and .other_content are discarded below without
+        ## being printed
+        return [spec[2] for spec in message_class.thrift_spec
+                if spec is not None and spec[2] not in ('body', 'other_content')]
+    else:
+        return None
+
 def _dump(fpath, args):
     '''
     Reads in a streamcorpus.Chunk file and prints the metadata of each
@@ -120,7 +144,9 @@ def _dump(fpath, args):
         stats = {}
 
     global message_class
-    for num, si in enumerate(Chunk(path=fpath, mode='rb', message=message_class)):
+    chunk = Chunk(path=fpath, mode='rb', message=message_class,
+                  fields=_dump_fields(args), where=args.where)
+    for num, si in enumerate(chunk):
         if args.limit and num >= args.limit:
             break
 
@@ -171,9 +197,25 @@ def _dump(fpath, args):
 
     if args.count:
         print '%d\t%d\t%s' % (num_stream_items, len(num_labeled_stream_items), fpath)
+        return num_stream_items, len(num_labeled_stream_items)
+
+def _dump_paths(fpaths, args):
+    '''
+    _dump each of fpaths
+
+    :returns (num_stream_items, num_labeled_stream_items): totals for
+    --count over fpaths, or (0, 0)
+    '''
+    totals = [0, 0]
+    for fpath in fpaths:
+        counts = _dump(fpath, args)
+        if counts is not None:
+            totals[0] += counts[0]
+            totals[1] += counts[1]
+    return tuple(totals)
 
 
-def _dump_ratings(fpaths, annotator_ids=[], include_header=False):
+def _dump_ratings(fpaths, annotator_ids=[], include_header=False, where=None, header=True):
     '''
     Read in a streamcorpus.Chunk files and print all Rating objects as
     tab-separated values
@@ -182,10 +224,13 @@ def _dump_ratings(fpaths, annotator_ids=[], include_header=False):
 
     :paramm annotator_ids: if present, only print Rating objects from
     from one of these annotators
+
+    :param header: if False, do not print the line of column names
     '''
-    print '\t'.join(['annotator_id', 'target_id', 'stream_id', 'num_mentions', 'mentions'])
+    if header:
+        print '\t'.join(['annotator_id', 'target_id', 'stream_id', 'num_mentions', 'mentions'])
     for fpath in fpaths:
-        for si in Chunk(path=fpath, mode='rb'):
+        for si in Chunk(path=fpath, mode='rb', where=where):
             for annotator_id, ratings in si.ratings.items():
                 if annotator_ids and annotator_id not in annotator_ids:
                     ## skip ratings not created by one of
@@ -219,7 +264,7 @@ token_attrs = [
     'dependency_path',
     ]
 
-def _dump_tokens(fpaths, annotator_ids=[], filter_tagger_ids=[]):
+def _dump_tokens(fpaths, annotator_ids=[], filter_tagger_ids=[], where=None, header=True):
     '''
     Read in a streamcorpus.Chunk files and print all tokens in a fixed
     order that enables diffing.
@@ -228,11 +273,14 @@ def _dump_tokens(fpaths, annotator_ids=[], filter_tagger_ids=[]):
 
     :paramm annotator_ids: if present, only print tokens with labels
     from one of these annotators
+
+    :param header: if False, do not print the line of column names
     '''
     global message_class
-    print '\t'.join(token_attrs + ['stream_id', 'labels'])
+    if header:
+        print '\t'.join(token_attrs + ['stream_id', 'labels'])
     for fpath in fpaths:
-        for si in Chunk(path=fpath, mode='rb', message=message_class):
+        for si in Chunk(path=fpath, mode='rb', message=message_class, where=where):
             if not si.body:
                 print 'no body: %s' % si.stream_id
                 continue
@@ -272,7 +320,7 @@ def _dump_tokens(fpaths, annotator_ids=[], filter_tagger_ids=[]):
                             print line
 
 
-def verify_offsets(fpaths):
+def verify_offsets(fpaths, where=None):
     '''
     Read in a streamcorpus.Chunk files and verify that the 'value'
     property in each offset matches the actual text at that offset.
@@ -285,7 +333,7 @@ def verify_offsets(fpaths):
         num_valid_line_offsets = 0
         num_valid_byte_offsets = 0
         num_valid_label_offsets = 0
-        for si in Chunk(path=fpath, mode='rb', message=message_class):
+        for si in Chunk(path=fpath, mode='rb', message=message_class, where=where):
             if not si.body:
                 print 'no body: %s' % si.stream_id
                 continue
@@ -358,36 +406,70 @@ num_valid_label_offsets: %d
 ''' % (num_valid_byte_offsets, num_valid_line_offsets, num_valid_label_offsets)
 
 
-def _find(fpaths, stream_id, dump_binary_stream_item=False):
+def _read_stream_ids(path):
     '''
-    Read in a streamcorpus.Chunk file and if any of its stream_ids
-    match stream_id, then print stream_item.body.raw to stdout
+    list of the stream_ids in a file with one on each line, or on
+    stdin if path is "-"
+    '''
+    if path == '-':
+        fh = sys.stdin
+    else:
+        fh = open(path, 'rb')
+    return [line.strip() for line in fh if line.strip()]
+
+def _find(fpaths, stream_ids, dump_binary_stream_item=False, where=None):
+    '''
+    Read in streamcorpus.Chunk files and print stream_item.body.raw
+    of every StreamItem whose stream_id is in stream_ids to stdout, or
+    write the binary StreamItems to stdout as a chunk.  Each chunk is
+    read only until every stream_id still missing has been found, or
+    not at all if its trailer shows it is empty, and stops when all
+    have been found.  Chunks with a sidecar index are not scanned.
     '''
     global message_class
-    sys.stderr.write('hunting for %r\n' % stream_id)
+    wanted = set(stream_ids)
+    if len(wanted) == 1:
+        sys.stderr.write('hunting for %r\n' % list(wanted)[0])
+    else:
+        sys.stderr.write('hunting for %d stream_ids\n' % len(wanted))
+    o_chunk = None
+    if dump_binary_stream_item:
+        o_chunk = Chunk(file_obj=sys.stdout, mode='wb')
+    errors = []
     for fpath in fpaths:
-        for si in Chunk(path=fpath, mode='rb', message=message_class):
-            if si.stream_id == stream_id:
-                if dump_binary_stream_item:
-                    o_chunk = Chunk(file_obj=sys.stdout, mode='wb')
-                    o_chunk.add(si)
-                    o_chunk.close()
-                    sys.exit()
-                elif si.body and si.body.raw:
-                    print si.body.raw
-                    sys.exit()
-                elif si.body:
-                    sys.exit('Found %s without si.body.raw' % stream_id)
-                else:
-                    sys.exit('Found %s without si.body' % stream_id)
-
-def _show_fields(fpaths, fields, len_fields):
+        if not wanted:
+            break
+        chunk = Chunk(path=fpath, mode='rb', message=message_class, where=where)
+        for stream_id, blob in chunk.find_raw(wanted):
+            wanted.discard(stream_id)
+            if o_chunk is not None:
+                ## copy the bytes without decoding the StreamItem
+                o_chunk.add_raw(blob)
+                continue
+            si = deserialize(blob, message=message_class)
+            if si.body and si.body.raw:
+                print si.body.raw
+            elif si.body:
+                errors.append('Found %s without si.body.raw' % stream_id)
+            else:
+                errors.append('Found %s without si.body' % stream_id)
+        chunk.close()
+    if o_chunk is not None:
+        o_chunk.close()
+    for stream_id in sorted(wanted):
+        errors.append('Did not find %s' % stream_id)
+    if errors:
+        sys.exit('\n'.join(errors))
+
+def _show_fields(fpaths, fields, len_fields, where=None):
     '''
     streamcorpus.Chunk files and display each field specified in 'fields'
     '''
     global message_class
     for fpath in fpaths:
-        for si in Chunk(path=fpath, mode='rb', message=message_class):
+        chunk = Chunk(path=fpath, mode='rb', message=message_class,
+                      fields=fields + len_fields, where=where)
+        for si in chunk:
             output = []
             for field in fields:
                 prop = si
@@ -410,14 +492,14 @@ def _show_fields(fpaths, fields, len_fields):
             sys.stdout.flush()
 
 
-def _find_missing_labels(fpaths, annotator_ids, component):
+def _find_missing_labels(fpaths, annotator_ids, component, where=None):
     '''
     Read in a streamcorpus.Chunk file and if any of its stream_ids
     match stream_id, then print stream_item.body.raw to stdout
     '''
     global message_class
     for fpath in fpaths:
-        for si in Chunk(path=fpath, mode='rb', message=message_class):
+        for si in Chunk(path=fpath, mode='rb', message=message_class, where=where):
             if not si.body:
                 print 'no body on %s %r' % (si.stream_id, si.abs_url)
                 continue
@@ -449,19 +531,32 @@ def _find_missing_labels(fpaths, annotator_ids, component):
                 else:
                     print getattr(si.body, component)
 
-def _stats(fpaths):
+stats_keys = ['stream_ids', 'num_targets_from_google', 'raw', 'raw_has_targs', 'raw_has_wp', 'media_type', 'clean_html', 'clean_has_targs', 'clean_has_wp',
+              'clean_visible', 'labelsets', 'labels', 'labels_has_targs', 'sentences', 'tokens', 'at_least_one_label']
+
+def _print_stats(name, c, labels):
+    print name
+    for k in stats_keys:
+        v = c.get(k)
+        print '\t%s: %s' % (k, v)
+    print '\tlabels: ' + ', '.join(['%s:%d' % it for it in sorted(labels.items())])
+
+def _stats(fpaths, where=None):
     '''
     Read streamcorpus.Chunk files and print their stats
+
+    :returns (c, labels): Counters of the stats and of the labels by
+    annotator_id, summed over fpaths
     '''
     global message_class
-    keys = ['stream_ids', 'num_targets_from_google', 'raw', 'raw_has_targs', 'raw_has_wp', 'media_type', 'clean_html', 'clean_has_targs', 'clean_has_wp',
-            'clean_visible', 'labelsets', 'labels', 'labels_has_targs', 'sentences', 'tokens', 'at_least_one_label']
+    total_c = collections.Counter()
+    total_labels = collections.Counter()
     for fpath in fpaths:
         #print fpath
         sys.stdout.flush()
         c = collections.Counter()
         labels = collections.Counter()
-        for num, si in enumerate( Chunk(path=fpath, mode='rb', message=message_class) ):
+        for num, si in enumerate( Chunk(path=fpath, mode='rb', message=message_class, where=where) ):
             #print si.stream_id
             sys.stdout.flush()
             c['stream_ids'] += 1
@@ -502,24 +597,23 @@ def _stats(fpaths):
                 c['at_least_one_label'] += int(bool(_labels))
                 sys.stdout.flush()
 
-        print fpath
-        for k in keys:
-            v = c.get(k)
-            print '\t%s: %s' % (k, v)
-        print '\tlabels: ' + ', '.join(['%s:%d' % it for it in labels.items()])
+        _print_stats(fpath, c, labels)
         #print json.dumps( c, indent=4 )
         #print json.dumps( labels, indent=4 )
         sys.stdout.flush()
+        total_c.update(c)
+        total_labels.update(labels)
+    return total_c, total_labels
 
 
 def _copy(args):
     count = 0
     ochunk = Chunk(file_obj=sys.stdout, mode='wb')
     for fpath in args.input_path:
-        ichunk = Chunk(path=fpath, mode='rb', message=message_class)
-        for si in ichunk:
+        ichunk = Chunk(path=fpath, mode='rb', message=message_class, where=args.where)
+        for blob in ichunk.iter_raw():
             count += 1
-            ochunk.add(si)
+            ochunk.add_raw(blob)
             if (args.limit is not None) and (count >= args.limit):
                 break
         ichunk.close()
@@ -529,6 +623,126 @@ def _copy(args):
     sys.stderr.write('wrote {0} items\n'.format(count))
 
 
+## most bytes of output that a worker of _map_files holds in memory
+## for one file, beyond which the output goes to a temporary file
+MAX_BUFFERED_OUTPUT = 2**24
+
+class _spooled_output(object):
+    '''
+    stdout for a worker of _map_files, which keeps what is printed in
+    memory until it exceeds max_size bytes, and then moves it to a
+    temporary file in spool_dir
+    '''
+    def __init__(self, spool_dir, max_size):
+        self._spool_dir = spool_dir
+        self._max_size = max_size
+        self._buf = StringIO()
+        self._file = None
+        self.path = None
+
+    def write(self, data):
+        if self._file is not None:
+            self._file.write(data)
+            return
+        self._buf.write(data)
+        if self._buf.tell() > self._max_size:
+            fd, self.path = tempfile.mkstemp(dir=self._spool_dir)
+            self._file = os.fdopen(fd, 'wb')
+            self._file.write(self._buf.getvalue())
+            self._buf = None
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        'returns the output held in memory, or None if it is in self.path'
+        if self._file is not None:
+            self._file.close()
+            return None
+        return self._buf.getvalue()
+
+def _call_on_file(task):
+    '''
+    worker for _map_files, which returns the output of the call, or
+    the path to a temporary file holding it, along with its return
+    value
+    '''
+    global message_class
+    func, fpath, args, kwargs, message_class, spool_dir = task
+    stdout = sys.stdout
+    sys.stdout = output = _spooled_output(spool_dir, MAX_BUFFERED_OUTPUT)
+    try:
+        result = func([fpath], *args, **kwargs)
+    except:
+        output.close()
+        if output.path is not None:
+            os.remove(output.path)
+        raise
+    finally:
+        sys.stdout = stdout
+    return output.close(), output.path, result
+
+def _map_files(jobs, func, fpaths, *args, **kwargs):
+    '''
+    Generate the results of func([fpath], *args, **kwargs) for each
+    of fpaths, in order.  With jobs > 1, the files are processed by a
+    pool of that many processes.  Each one collects what func prints
+    for a file, and that is written to stdout, in the order of fpaths,
+    as soon as every earlier file is done.  So the output is the same
+    as with jobs=1, which calls func in this process.
+
+    A worker holds at most MAX_BUFFERED_OUTPUT bytes of the output for
+    a file in memory, and writes the rest of it to a temporary file in
+    $TMPDIR, so the output for files that are waiting for an earlier
+    one to finish can take up that much disk space.
+    '''
+    if jobs <= 1:
+        for fpath in fpaths:
+            yield func([fpath], *args, **kwargs)
+        return
+    spool_dir = tempfile.mkdtemp(prefix='streamcorpus-dump-')
+    tasks = [(func, fpath, args, kwargs, message_class, spool_dir) for fpath in fpaths]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for output, path, result in pool.imap(_call_on_file, tasks, chunksize=1):
+            if path is None:
+                sys.stdout.write(output)
+            else:
+                with open(path, 'rb') as fh:
+                    shutil.copyfileobj(fh, sys.stdout, 2**20)
+                os.remove(path)
+            sys.stdout.flush()
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+def _parse_time(value):
+    '''
+    seconds since the epoch from either a number or a string like
+    '2000-01-01T12:34:00.000123Z'
+    '''
+    try:
+        return float(value)
+    except ValueError:
+        from streamcorpus import make_stream_time
+        return make_stream_time(value).epoch_ticks
+
+def _make_where(args):
+    '''
+    Where for the filtering options in args, or None if there are none
+    '''
+    where = Where(start_time=args.start_time, end_time=args.end_time,
+                  source=args.sources or None, schost=args.schosts or None,
+                  stream_id_prefix=args.stream_id_prefixes or None)
+    if not where.fields:
+        return None
+    return where
+
+
 def main():
     logger = logging.getLogger('streamcorpus')
     ch = logging.StreamHandler()
@@ -542,7 +756,10 @@ def main():
         help='Paths to a chunk files, or directory of chunks, or "-" for receiving paths over stdin')
     parser.add_argument('--stats', action='store_true', default=False,
                         help='print out the .body.raw of a specific stream_id')
-    parser.add_argument('--find', dest='find', metavar='STREAM_ID', help='print out the .body.raw of a specific stream_id')
+    parser.add_argument('--find', dest='find', metavar='STREAM_ID', action='append', default=[],
+                        help='print out the .body.raw of a specific stream_id; can be repeated')
+    parser.add_argument('--find-file', dest='find_file', metavar='PATH', default=None,
+                        help='like --find for each stream_id in a file with one per line, or "-" for stdin')
     parser.add_argument('--binary', dest='dump_binary_stream_item', 
                         action='store_true', default=False, 
                         help='Use with --find to write full binary StreamItem of specific stream_id to stdout intead of .body.raw')
@@ -584,6 +801,20 @@ def main():
     parser.add_argument('--print-url', action='store_true',
                         default=False, dest='print_url')
     parser.add_argument('--copy', action='store_true', default=False, help='copy items to stdout, useful with --limit')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='process this many files at once in worker processes; '
+                        'output is the same as with --jobs 1.  --find and --copy are not parallel')
+    parser.add_argument('--start-time', type=_parse_time, default=None, dest='start_time',
+                        help='only use StreamItems with a stream_time at or after this epoch_ticks or zulu_timestamp')
+    parser.add_argument('--end-time', type=_parse_time, default=None, dest='end_time',
+                        help='only use StreamItems with a stream_time before this epoch_ticks or zulu_timestamp')
+    parser.add_argument('--source', action='append', default=[], dest='sources',
+                        help='only use StreamItems from this source; can be repeated')
+    parser.add_argument('--schost', action='append', default=[], dest='schosts',
+                        help='only use StreamItems with this schost; can be repeated')
+    parser.add_argument('--stream-id-prefix', action='append', default=[],
+                        dest='stream_id_prefixes',
+                        help='only use StreamItems whose stream_id starts with this; can be repeated')
     args = parser.parse_args()
 
     if args.version not in versioned_classes:
@@ -593,50 +824,82 @@ def main():
     global message_class
     message_class = versioned_classes[args.version]
 
+    if args.find_file == '-' and '-' in args.input_path:
+        sys.exit('cannot read both paths and --find-file from stdin')
+
     ## make input_path into an iterable over path strings
     paths = []
     for ipath in args.input_path:
         if ipath == '-':
             paths.extend(itertools.imap(lambda line: line.strip(), sys.stdin))
         elif os.path.isdir(ipath):
+            ## sorted, so that output does not depend on the file system
             paths.extend(
-                map(lambda fname: os.path.join(args.input_path, fname),
-                    os.listdir(args.input_path)))
+                map(lambda fname: os.path.join(ipath, fname),
+                    sorted(os.listdir(ipath))))
         else:
             paths.append(ipath)
     args.input_path = paths
 
+    ## filters that Chunk applies before decoding whole StreamItems
+    args.where = _make_where(args)
+
     ## now actually do whatever was requested
+    jobs = args.jobs
     if args.fields:
-        _show_fields(args.input_path, args.fields, args.len_fields)
+        for _ in _map_files(jobs, _show_fields, args.input_path,
+                            args.fields, args.len_fields, where=args.where):
+            pass
 
     elif args.stats:
-        _stats(args.input_path)
-
-    elif args.find:
+        total_c = collections.Counter()
+        total_labels = collections.Counter()
+        for c, labels in _map_files(jobs, _stats, args.input_path, where=args.where):
+            total_c.update(c)
+            total_labels.update(labels)
+        if len(args.input_path) > 1:
+            _print_stats('total', total_c, total_labels)
+
+    elif args.find or args.find_file:
+        if args.find_file:
+            args.find.extend(_read_stream_ids(args.find_file))
         _find(args.input_path, args.find, 
-              dump_binary_stream_item=args.dump_binary_stream_item)
+              dump_binary_stream_item=args.dump_binary_stream_item,
+              where=args.where)
 
     elif args.tokens:
-        _dump_tokens(args.input_path, args.annotator_ids, args.tagger_ids)
+        print '\t'.join(token_attrs + ['stream_id', 'labels'])
+        for _ in _map_files(jobs, _dump_tokens, args.input_path, args.annotator_ids,
+                            args.tagger_ids, where=args.where, header=False):
+            pass
 
     elif args.find_missing:
-        _find_missing_labels(args.input_path, args.annotator_ids, args.component)
+        for _ in _map_files(jobs, _find_missing_labels, args.input_path,
+                            args.annotator_ids, args.component, where=args.where):
+            pass
 
     elif args.verify_offsets:
-        verify_offsets(args.input_path)
+        for _ in _map_files(jobs, verify_offsets, args.input_path, where=args.where):
+            pass
 
     elif args.ratings:
-        _dump_ratings(args.input_path, 
-                      annotator_ids=args.annotator_ids,
-                      include_header=args.include_header)
+        print '\t'.join(['annotator_id', 'target_id', 'stream_id', 'num_mentions', 'mentions'])
+        for _ in _map_files(jobs, _dump_ratings, args.input_path,
+                            annotator_ids=args.annotator_ids,
+                            include_header=args.include_header,
+                            where=args.where, header=False):
+            pass
 
     elif args.copy:
         _copy(args)
 
     else:
-        for fpath in args.input_path:
-            _dump(fpath, args)
+        totals = [0, 0]
+        for counts in _map_files(jobs, _dump_paths, args.input_path, args):
+            totals[0] += counts[0]
+            totals[1] += counts[1]
+        if args.count and len(args.input_path) > 1:
+            print '%d\t%d\ttotal' % tuple(totals)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+'''
+A command line utility for rewriting directory trees of
+streamcorpus.Chunk files in the current version of StreamItem,
+v0_3_0.  Chunks of any older version are upgraded as they are read,
+with Chunk(message='auto', upgrade=True).
+
+Each chunk is written to the same relative path under the output
+directory, compressed the same way as its input unless --compression
+says otherwise.  Chunks are migrated in parallel by a pool of
+processes.  A manifest listing the md5 of the serialized StreamItems
+in each new chunk, as reported by Chunk.md5_hexdigest, the number of
+items, and the relative path is written to the top of the output
+tree.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012 Diffeo, Inc.
+'''
+from __future__ import absolute_import
+import os
+import sys
+import logging
+import traceback
+import multiprocessing
+from streamcorpus._chunk import Chunk
+from streamcorpus._codecs import codec_for_path, get_codec
+
+logger = logging.getLogger('streamcorpus')
+
+MANIFEST_NAME = 'md5-manifest.txt'
+
+def split_chunk_path(path):
+    '''
+    :returns: (base, codec) where base is path without its
+    compression extension, and codec is the Codec for that extension,
+    or None
+    '''
+    codec = codec_for_path(path)
+    if codec is None:
+        return path, None
+    ext = max([ext for ext in codec.extensions if path.endswith(ext)], key=len)
+    return path[:-len(ext)], codec
+
+def is_chunk_path(path):
+    '''
+    True if path names a chunk that can be migrated: .sc, possibly
+    followed by a compression extension.  Encrypted chunks, .gpg,
+    cannot be written back and are not included.
+    '''
+    return split_chunk_path(path)[0].endswith('.sc')
+
+def find_chunks(input_dir):
+    '''
+    :returns: sorted list of the paths, relative to input_dir, of all
+    chunks in the tree under input_dir
+    '''
+    rel_paths = []
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            if is_chunk_path(fname):
+                rel_paths.append(os.path.relpath(path, input_dir))
+            else:
+                logger.debug('not a chunk, skipping %r', path)
+    rel_paths.sort()
+    return rel_paths
+
+def output_rel_path(rel_path, compression=None):
+    '''
+    :param compression: codec name for the output, or None to keep
+    the compression of rel_path
+    '''
+    if compression is None:
+        return rel_path
+    base, codec = split_chunk_path(rel_path)
+    codec = get_codec(compression)
+    if codec is None:
+        return base
+    return base + codec.extensions[0]
+
+def migrate_chunk(input_path, output_path, compression_level=None):
+    '''
+    Write every StreamItem of input_path, upgraded to v0_3_0, to a
+    new chunk at output_path.  The compression of output_path is
+    selected by its extension.  If anything fails, output_path is
+    removed.
+
+    :returns: (md5_hexdigest, count) of the new chunk
+    '''
+    dirname = os.path.dirname(output_path)
+    if dirname and not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            ## another process made it first
+            if not os.path.isdir(dirname):
+                raise
+    count = 0
+    try:
+        ## both are closed before output_path is removed
+        with Chunk(output_path, mode='wb', compression_level=compression_level) as o_chunk:
+            with Chunk(input_path, message='auto', upgrade=True) as i_chunk:
+                for si in i_chunk:
+                    o_chunk.add(si)
+                    count += 1
+    except:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    return o_chunk.md5_hexdigest, count
+
+def _migrate_one(args):
+    '''
+    worker for multiprocessing.Pool, which reports failures as a
+    traceback string so that one bad chunk does not stop the others
+    '''
+    input_dir, output_dir, rel_path, compression, compression_level = args
+    out_rel_path = output_rel_path(rel_path, compression)
+    try:
+        md5, count = migrate_chunk(os.path.join(input_dir, rel_path),
+                                   os.path.join(output_dir, out_rel_path),
+                                   compression_level=compression_level)
+    except Exception:
+        return rel_path, out_rel_path, None, None, traceback.format_exc()
+    return rel_path, out_rel_path, md5, count, None
+
+def migrate_tree(input_dir, output_dir, processes=None, compression=None,
+                 compression_level=None):
+    '''
+    Migrate every chunk under input_dir to the same relative path
+    under output_dir, and write a manifest of the new chunks to
+    output_dir/md5-manifest.txt, with one line per chunk:
+
+        <md5>\\t<count>\\t<relative path>
+
+    :param processes: number of worker processes, defaults to the
+    number of CPUs; 1 migrates in this process
+
+    :param compression: codec name for all outputs, or None to keep
+    the compression of each input
+
+    :returns: list of (relative input path, traceback) for chunks
+    that could not be migrated
+    '''
+    if os.path.abspath(input_dir) == os.path.abspath(output_dir):
+        raise Exception('cannot migrate %r in place' % input_dir)
+    if compression is not None:
+        ## fail before starting any workers
+        get_codec(compression)
+    tasks = [(input_dir, output_dir, rel_path, compression, compression_level)
+             for rel_path in find_chunks(input_dir)]
+    logger.info('migrating %d chunks from %r to %r', len(tasks), input_dir, output_dir)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes == 1:
+        results = map(_migrate_one, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_migrate_one, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    failures = []
+    manifest = []
+    for rel_path, out_rel_path, md5, count, error in results:
+        if error is not None:
+            logger.error('failed to migrate %r:\n%s', rel_path, error)
+            failures.append((rel_path, error))
+        else:
+            manifest.append('%s\t%d\t%s\n' % (md5, count, out_rel_path))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'wb') as fh:
+        fh.writelines(manifest)
+    logger.info('migrated %d chunks, %d failed', len(manifest), len(failures))
+    return failures
+
+def read_manifest(path):
+    '''
+    :returns: list of (md5, count, relative path) from a manifest
+    written by migrate_tree
+    '''
+    entries = []
+    for line in open(path, 'rb'):
+        md5, count, rel_path = line.rstrip('\n').split('\t', 2)
+        entries.append((md5, int(count), rel_path))
+    return entries
+
+def main():
+    ch = logging.StreamHandler()
+    logger.addHandler(ch)
+    logger.setLevel(logging.INFO)
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Rewrite a directory tree of chunks as v0_3_0 StreamItems')
+    parser.add_argument('input_dir', help='directory of chunks to migrate')
+    parser.add_argument('output_dir', help='directory to write the migrated tree')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes, defaults to the number of CPUs')
+    parser.add_argument('--compression', default=None,
+                        help='compress all outputs with this codec, e.g. xz, gzip or none; '
+                        'defaults to the compression of each input')
+    parser.add_argument('--compression-level', type=int, default=None,
+                        dest='compression_level')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.input_dir):
+        sys.exit('%r is not a directory' % args.input_dir)
+
+    failures = migrate_tree(args.input_dir, args.output_dir,
+                            processes=args.processes,
+                            compression=args.compression,
+                            compression_level=args.compression_level)
+    if failures:
+        sys.exit('failed to migrate %d chunks' % len(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -58,12 +58,25 @@ import ttypes_v0_1_0
 import ttypes_v0_2_0
 
 from _chunk import Chunk, decrypt_and_uncompress, compress_and_encrypt, \
-    compress_and_encrypt_path, \
+    compress_and_encrypt_path, decrypt_and_uncompress_file, \
+    iter_decrypt_and_uncompress, compress_and_encrypt_file, \
     serialize, deserialize, \
-    VersionMismatchError
-
-__all__ = ['Chunk', 'decrypt_and_uncompress', 'compress_and_encrypt', 
-           'compress_and_encrypt_path', 
+    VersionMismatchError, ChunkTruncatedError
+from _index import ChunkIndex
+from _trailer import ChunkTrailer
+from _parallel import ParallelChunkReader
+from _rolling import RollingChunkWriter
+from _gpg import GpgContext
+from _where import Where
+from _codecs import Codec, register_codec, get_codec
+from _upgrade import upgrade_stream_item
+
+__all__ = ['Chunk', 'ChunkIndex', 'ChunkTrailer', 'ParallelChunkReader',
+           'RollingChunkWriter', 'GpgContext', 'Where',
+           'Codec', 'register_codec', 'get_codec', 'upgrade_stream_item',
+           'decrypt_and_uncompress', 'compress_and_encrypt', 
+           'compress_and_encrypt_path', 'decrypt_and_uncompress_file',
+           'iter_decrypt_and_uncompress', 'compress_and_encrypt_file',
            'serialize', 'deserialize',
            'make_stream_time', 'make_stream_item',
            'get_date_hour',
@@ -85,6 +98,7 @@ __all__ = ['Chunk', 'decrypt_and_uncompress', 'compress_and_encrypt',
            'ttypes_v0_1_0',
            'ttypes_v0_2_0',
            'VersionMismatchError',
+           'ChunkTruncatedError',
            ]
 
 def get_date_hour(stream_thing):
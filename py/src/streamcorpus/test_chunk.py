@@ -3,6 +3,7 @@ import uuid
 import time
 import errno
 import shutil
+import hashlib
 import pytest
 from cStringIO import StringIO
 import logging
@@ -24,25 +25,44 @@ from . import StreamItem_v0_2_0, StreamItem_v0_3_0
 from streamcorpus import _chunk
 
 TEST_XZ_PATH = os.path.join(os.path.dirname(__file__), '../../../test-data/john-smith-tagged-by-lingpipe-0-v0_2_0.sc.xz')
-TEST_SC_PATH = os.path.join(os.path.dirname(__file__), '../../../test-data/john-smith-tagged-by-lingpipe-0-v0_2_0.sc')
 
 def make_si():
     si = make_stream_item( None, 'http://example.com' )
     si.body = ContentItem(raw='hello!')
     return si
 
+@pytest.fixture(scope='module')
+def sc_path(request):
+    'uncompressed copy of the test chunk'
+    path = '/tmp/test_chunk-%s.sc' % str(uuid.uuid4())
+    if os.system('xz --decompress < %s > %s' % (TEST_XZ_PATH, path)) != 0:
+        pytest.skip('cannot run xz')
+    def fin():
+        os.remove(path)
+    request.addfinalizer(fin)
+    return path
+
 def test_version():
     si = make_si()
     assert si.version == Versions.v0_3_0
 
-def test_v0_2_0():
-    for si in Chunk(TEST_SC_PATH, message=StreamItem_v0_2_0):
+def test_v0_2_0(sc_path):
+    for si in Chunk(sc_path, message=StreamItem_v0_2_0):
         assert si.version == Versions.v0_2_0
 
     with pytest.raises(VersionMismatchError):
-        for si in Chunk(TEST_SC_PATH, message=StreamItem_v0_3_0):
+        for si in Chunk(sc_path, message=StreamItem_v0_3_0):
             pass
 
+def test_verify_version_false(sc_path):
+    ## v0_2_0 and v0_3_0 share stream_id and doc_id
+    sis = list(Chunk(sc_path, message=StreamItem_v0_3_0,
+                     fields=['stream_id'], verify_version=False))
+    assert len(sis) == len(list(Chunk(sc_path, message=StreamItem_v0_2_0).iter_raw()))
+    assert sis[0].stream_id
+    ## the version field was not decoded
+    assert sis[0].version == Versions.v0_3_0
+
 def test_chunk():
     ## write in-memory
     ch = Chunk()
@@ -98,10 +118,10 @@ def test_xz_write():
     assert len(list(Chunk(test_xz_path))) == 1
     os.system('rm %s' % test_xz_path)
 
-def test_speed():
+def test_speed(sc_path):
     count = 0
     start_time = time.time()
-    for si in Chunk(TEST_SC_PATH, message=StreamItem_v0_2_0):
+    for si in Chunk(sc_path, message=StreamItem_v0_2_0):
         count += 1
         assert si.body.clean_visible
     elapsed = time.time() - start_time
@@ -110,14 +130,6 @@ def test_speed():
     assert count == 197
 
 
-@pytest.fixture(scope='function')
-def path(request):
-    path = '/tmp/test_chunk-%s.sc' % str(uuid.uuid4())
-    def fin():
-        os.remove(path)
-    request.addfinalizer(fin)
-    return path
-
 def test_chunk_path_write(path):
     ## write to path
     ch = Chunk(path=path, mode='wb')
@@ -242,3 +254,326 @@ def test_with(path):
         ch.add(make_si())
         ch.add(make_si())
     assert len(list(Chunk(path))) == 3
+
+def test_fields_projection():
+    count = 0
+    for si in Chunk(TEST_XZ_PATH, message=StreamItem_v0_2_0,
+                    fields=['stream_id', 'body.clean_visible']):
+        count += 1
+        assert si.version == Versions.v0_2_0
+        assert si.stream_id
+        assert si.body.clean_visible
+        ## everything else is skipped
+        assert si.abs_url is None
+        assert si.body.raw is None
+        assert not si.body.sentences
+    assert count == 197
+
+def test_fields_projection_matches_full_decode(path):
+    with Chunk(path, mode='wb') as ch:
+        for num in range(5):
+            ch.add(make_si())
+    full = list(Chunk(path))
+    projected = list(Chunk(path, fields=['stream_id', 'body']))
+    assert [si.stream_id for si in projected] == [si.stream_id for si in full]
+    assert [si.body for si in projected] == [si.body for si in full]
+    assert all(si.stream_time is None for si in projected)
+
+def test_fields_projection_unknown_field():
+    with pytest.raises(ValueError):
+        Chunk(data='', fields=['not_a_field'])
+    with pytest.raises(ValueError):
+        Chunk(data='', fields=['stream_id.not_a_struct'])
+
+def test_lazy():
+    full = list(Chunk(TEST_XZ_PATH, message=StreamItem_v0_2_0))
+    count = 0
+    for si, si_full in zip(Chunk(TEST_XZ_PATH, message=StreamItem_v0_2_0, lazy=True), full):
+        count += 1
+        assert isinstance(si, StreamItem_v0_2_0)
+        assert si.stream_id == si_full.stream_id
+        ## containers are not decoded until accessed
+        assert 'body' in si._lazy_pending
+        assert si.body.clean_visible == si_full.body.clean_visible
+        assert 'sentences' in si.body._lazy_pending
+        assert si.body.sentences == si_full.body.sentences
+        assert si == si_full
+        assert si_full == si
+    assert count == 197
+
+def test_lazy_round_trip(path):
+    with Chunk(path, mode='wb') as ch:
+        ch.add(make_si())
+    si = list(Chunk(path, lazy=True))[0]
+    assert deserialize(serialize(si)) == si
+    assert repr(si) == repr(list(Chunk(path))[0])
+
+def test_iter_raw_add_raw(path):
+    ## copy without decoding
+    o_chunk = Chunk(path, mode='wb')
+    for blob in Chunk(TEST_XZ_PATH, message=StreamItem_v0_2_0).iter_raw():
+        o_chunk.add_raw(blob)
+    o_chunk.close()
+    assert len(o_chunk) == 197
+    assert o_chunk.md5_hexdigest == hashlib.md5(open(path).read()).hexdigest()
+    assert list(Chunk(path, message=StreamItem_v0_2_0)) == \
+        list(Chunk(TEST_XZ_PATH, message=StreamItem_v0_2_0))
+
+def test_iter_raw_fields():
+    sis = [make_si() for num in range(3)]
+    ch = Chunk()
+    for si in sis:
+        ch.add(si)
+    ch.flush()
+    pairs = list(Chunk(data=ch._o_chunk_fh._fh.getvalue()).iter_raw(fields=['stream_id']))
+    assert [msg.stream_id for msg, blob in pairs] == [si.stream_id for si in sis]
+    assert [blob for msg, blob in pairs] == [serialize(si) for si in sis]
+    assert pairs[0][0].body is None
+
+def test_iter_raw_version_protection(path):
+    with Chunk(path, mode='wb') as ch:
+        ch.add(make_si())
+    with pytest.raises(VersionMismatchError):
+        list(Chunk(path, message=StreamItem_v0_2_0).iter_raw())
+
+def test_memory_map(path):
+    sis = [make_si() for num in range(10)]
+    with Chunk(path=path, mode='wb') as ch:
+        for si in sis:
+            ch.add(si)
+    ch = Chunk(path=path, mode='rb', memory_map=True)
+    assert list(ch) == sis
+    assert list(ch) == sis
+    assert [msg for msg, blob in ch.iter_raw(fields=['stream_id'])] == \
+        list(Chunk(path=path, mode='rb', fields=['stream_id']))
+    assert ch.md5_hexdigest == hashlib.md5(open(path).read()).hexdigest()
+    ch.close()
+
+def test_memory_map_close_while_iterating(path):
+    sis = [make_si() for num in range(200)]
+    with Chunk(path=path, mode='wb') as ch:
+        ch.add_many(sis)
+    ch = Chunk(path=path, mode='rb', memory_map=True)
+    messages = iter(ch)
+    assert next(messages) == sis[0]
+    ## closing must not unmap pages that the iterator still reads
+    ch.close()
+    assert list(messages) == sis[1:]
+    raw = Chunk(path=path, mode='rb', memory_map=True)
+    blobs = raw.iter_raw()
+    next(blobs)
+    raw.close()
+    assert len(list(blobs)) == 199
+
+def test_memory_map_empty(path):
+    Chunk(path=path, mode='wb').close()
+    assert list(Chunk(path=path, mode='rb', memory_map=True)) == []
+
+@pytest.mark.parametrize('checksum_thread', [False, True])
+def test_checksum(path, checksum_thread):
+    import zlib
+    sis = [make_si() for num in range(10)]
+    with Chunk(path=path, mode='wb', checksum='crc32', checksum_thread=checksum_thread) as ch:
+        for si in sis:
+            ch.add(si)
+    data = open(path).read()
+    assert ch.md5_hexdigest is None
+    assert ch.checksum_hexdigest == '%08x' % (zlib.crc32(data) & 0xffffffff)
+
+    ch = Chunk(path=path, mode='rb', checksum='md5', checksum_thread=checksum_thread)
+    assert list(ch) == sis
+    assert ch.md5_hexdigest == hashlib.md5(data).hexdigest()
+
+    ch = Chunk(path=path, mode='rb', checksum='none')
+    assert list(ch) == sis
+    assert ch.checksum_hexdigest is None
+
+def test_checksum_thread_stops(path):
+    import threading
+    sis = [make_si() for num in range(3)]
+    with Chunk(path=path, mode='wb') as ch:
+        ch.add_many(sis)
+    data = open(path).read()
+    threads = threading.active_count()
+    for _ in range(200):
+        with Chunk(file_obj=StringIO(), mode='wb', checksum_thread=True) as ch:
+            ch.add_many(sis)
+        ch = Chunk(file_obj=StringIO(data), checksum_thread=True)
+        assert list(ch) == sis
+        ch.close()
+    assert threading.active_count() == threads
+    assert ch.md5_hexdigest == hashlib.md5(data).hexdigest()
+
+def test_checksum_thread_error():
+    from ._checksum import background_hash
+    class broken_hash(object):
+        def update(self, data):
+            raise ValueError(data)
+    hasher = background_hash(broken_hash())
+    hasher.update('foo')
+    with pytest.raises(ValueError):
+        hasher.hexdigest()
+    with pytest.raises(ValueError):
+        hasher.update('bar')
+    with pytest.raises(ValueError):
+        hasher.close()
+
+def test_checksum_unknown():
+    with pytest.raises(ValueError):
+        Chunk(checksum='not-a-checksum')
+
+def test_read_all_short_reads():
+    read_all = _chunk.read_all
+    data = os.urandom(10000)
+    fh = StringIO(data)
+    ## a reader that returns at most 7 bytes at a time
+    assert read_all(lambda sz: fh.read(min(sz, 7)), len(data)) == data
+    with pytest.raises(EOFError):
+        read_all(lambda sz: fh.read(min(sz, 7)), 1)
+
+class counting_file(object):
+    'file-like object that records the size of every write'
+    def __init__(self):
+        self.fh = StringIO()
+        self.writes = []
+    def write(self, data):
+        self.writes.append(len(data))
+        self.fh.write(data)
+
+def test_add_many():
+    sis = [make_stream_item(num, 'http://example.com/%d' % num) for num in range(100)]
+    fh = counting_file()
+    ch = Chunk(file_obj=fh, mode='wb', write_buffer_size=10000)
+    ch.add_many(iter(sis[:50]))
+    ch.extend(sis[50:])
+    assert len(ch) == 100
+    ch.flush()
+    assert fh.fh.getvalue() == ''.join(serialize(si) for si in sis)
+    ## messages were passed on in a few large writes
+    assert 1 < len(fh.writes) < len(sis) / 5
+    assert all(size >= 10000 for size in fh.writes[:-1])
+    assert list(Chunk(data=fh.fh.getvalue())) == sis
+
+def test_add_many_version_protection():
+    ch = Chunk(message=StreamItem_v0_3_0)
+    with pytest.raises(VersionMismatchError):
+        ch.add_many([make_si(), StreamItem_v0_2_0()])
+    assert len(ch) == 1
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_write_thread(path, compression):
+    sis = [make_stream_item(num, 'http://example.com/%d' % num) for num in range(100)]
+    with Chunk(path, mode='wb', compression=compression,
+               write_thread=True, write_buffer_size=1000) as ch:
+        for si in sis[:50]:
+            ch.add(si)
+        ch.add_many(sis[50:])
+    i_chunk = Chunk(path, compression=compression)
+    assert list(i_chunk) == sis
+    assert ch.md5_hexdigest == i_chunk.md5_hexdigest
+
+class failing_file(object):
+    def __init__(self):
+        self.closed = False
+    def write(self, data):
+        raise IOError('disk full')
+    def close(self):
+        self.closed = True
+
+def test_write_thread_error():
+    fh = failing_file()
+    ch = Chunk(file_obj=fh, mode='wb', write_thread=True, write_buffer_size=1)
+    ch.add(make_si())
+    ## the error reaches add once the queue is full
+    with pytest.raises(IOError):
+        for num in range(100):
+            ch.add(make_si())
+    with pytest.raises(IOError):
+        ch.close()
+    assert fh.closed
+    ## close is idempotent
+    ch.close()
+
+@pytest.mark.parametrize('fsync', [False, True])
+def test_atomic(path, fsync):
+    sis = [make_si() for num in range(10)]
+    dirname = os.path.dirname(path)
+    before = set(os.listdir(dirname))
+    ch = Chunk(path, mode='wb', atomic=True, fsync=fsync)
+    ch.add_many(sis)
+    ch.flush()
+    assert not os.path.exists(path)
+    tmp_names = set(os.listdir(dirname)) - before
+    assert len(tmp_names) == 1
+    ch.close()
+    assert set(os.listdir(dirname)) - before == set([os.path.basename(path)])
+    assert list(Chunk(path)) == sis
+
+def test_atomic_exception(path):
+    dirname = os.path.dirname(path)
+    before = set(os.listdir(dirname))
+    with pytest.raises(ZeroDivisionError):
+        with Chunk(path, mode='wb', atomic=True) as ch:
+            ch.add(make_si())
+            1 / 0
+    assert set(os.listdir(dirname)) == before
+
+def write_truncated(path, cut):
+    with Chunk(path, mode='wb') as ch:
+        for num in range(10):
+            ch.add(make_si())
+    data = open(path, 'rb').read()
+    open(path, 'wb').write(data[:len(data) - cut])
+
+@pytest.mark.parametrize('memory_map', [False, True])
+def test_check_truncation(path, memory_map):
+    write_truncated(path, 0)
+    assert len(list(Chunk(path, check_truncation=True, memory_map=memory_map))) == 10
+    os.remove(path)
+
+    write_truncated(path, 5)
+    ## without checking, the partial message is dropped
+    assert len(list(Chunk(path, memory_map=memory_map))) == 9
+    ch = Chunk(path, check_truncation=True, memory_map=memory_map)
+    with pytest.raises(_chunk.ChunkTruncatedError):
+        list(ch)
+    assert len(ch) == 9
+    with pytest.raises(_chunk.ChunkTruncatedError):
+        list(Chunk(path, check_truncation=True, memory_map=memory_map).iter_raw())
+
+@pytest.mark.skipif('not _chunk.lzma')
+def test_check_truncation_xz(path):
+    path += '.xz'
+    try:
+        with Chunk(path, mode='wb') as ch:
+            for num in range(200):
+                si = make_si()
+                si.body.raw = os.urandom(500)
+                ch.add(si)
+        data = open(path, 'rb').read()
+        open(path, 'wb').write(data[:len(data) / 2])
+        with pytest.raises(_chunk.ChunkTruncatedError):
+            list(Chunk(path, check_truncation=True))
+    finally:
+        os.remove(path)
+
+def test_check_truncation_gz(path):
+    path += '.gz'
+    try:
+        with Chunk(path, mode='wb') as ch:
+            for num in range(200):
+                si = make_si()
+                si.body.raw = os.urandom(500)
+                ch.add(si)
+        data = open(path, 'rb').read()
+        ## cut in the middle, and in the gzip trailer
+        for size in (len(data) / 2, len(data) - 3):
+            open(path, 'wb').write(data[:size])
+            with pytest.raises(_chunk.ChunkTruncatedError):
+                list(Chunk(path, check_truncation=True))
+            with pytest.raises(_chunk.ChunkTruncatedError):
+                list(Chunk(path, check_truncation=True).iter_raw())
+            with pytest.raises(IOError):
+                list(Chunk(path))
+    finally:
+        os.remove(path)
@@ -0,0 +1,146 @@
+import os
+import pytest
+import subprocess
+from distutils.spawn import find_executable
+from cStringIO import StringIO
+
+from . import Chunk, get_codec
+import _codecs
+from _codecs import codec_for_path, codec_for_magic, magic_size
+from . import conftest
+
+CODEC_EXTENSIONS = [('gzip', '.gz'), ('xz', '.xz'), ('zstd', '.zst'),
+                    ('lz4', '.lz4'), ('snappy', '.sz')]
+
+def make_si(num):
+    return conftest.make_si(num, raw='hello %d! ' % num * 100)
+
+def skip_unavailable(name):
+    if not get_codec(name).available:
+        pytest.skip('library for %s is not installed' % name)
+    if name == 'xz' and _codecs.lzma is None:
+        pytest.skip('backports.lzma is not installed')
+
+def test_codec_for_path():
+    assert codec_for_path('a/b.sc.xz').name == 'xz'
+    assert codec_for_path('a/b.sc.gz').name == 'gzip'
+    assert codec_for_path('a/b.sc.zst').name == 'zstd'
+    assert codec_for_path('a/b.sc.lz4').name == 'lz4'
+    assert codec_for_path('a/b.sc') is None
+    assert get_codec('none') is None
+    with pytest.raises(KeyError):
+        get_codec('not-a-codec')
+
+@pytest.mark.parametrize(('name', 'ext'), CODEC_EXTENSIONS)
+def test_round_trip(tmp_dir, name, ext):
+    skip_unavailable(name)
+    path = os.path.join(tmp_dir, 'chunk.sc' + ext)
+    sis = [make_si(num) for num in range(20)]
+    with Chunk(path, mode='wb', compression_level=1) as ch:
+        for si in sis:
+            ch.add(si)
+    prefix = open(path, 'rb').read(magic_size())
+    assert codec_for_magic(prefix).name == name
+    ch = Chunk(path)
+    assert list(ch) == sis
+    ## iterating again restarts decompression
+    assert list(ch) == sis
+    ## seeking into the decompressed stream
+    assert Chunk(path).get(sis[12].stream_id) == sis[12]
+
+def test_compression_overrides_extension(tmp_dir):
+    path = os.path.join(tmp_dir, 'chunk.sc.xz')
+    si = make_si(1)
+    with Chunk(path, mode='wb', compression='none') as ch:
+        ch.add(si)
+    assert codec_for_magic(open(path, 'rb').read(magic_size())) is None
+    assert list(Chunk(path, compression='none')) == [si]
+
+@pytest.mark.skipif('not find_executable("xzcat")')
+def test_xzcat(tmp_dir):
+    path = os.path.join(tmp_dir, 'chunk.sc.xz')
+    sis = [make_si(num) for num in range(20)]
+    with Chunk(path, mode='wb', compression='xzcat') as ch:
+        ch.add_many(sis)
+    assert subprocess.call(['xz', '--test', path]) == 0
+    fds = len(os.listdir('/dev/fd'))
+    ch = Chunk(path, compression='xzcat')
+    assert list(ch) == sis
+    ## iterating again restarts xzcat
+    assert list(ch) == sis
+    ch.close()
+    assert len(os.listdir('/dev/fd')) == fds
+
+def test_compression_level(tmp_dir):
+    skip_unavailable('zstd')
+    sizes = []
+    for level in [1, 19]:
+        path = os.path.join(tmp_dir, 'chunk-%d.sc.zst' % level)
+        with Chunk(path, mode='wb', compression_level=level) as ch:
+            for num in range(50):
+                ch.add(make_si(num))
+        sizes.append(os.path.getsize(path))
+    assert sizes[1] < sizes[0]
+
+def test_missing_library():
+    codec = _codecs.Codec('fake', ('.fake',), 'FAKE', None, None, None)
+    assert not codec.available
+    with pytest.raises(Exception):
+        codec.reader(StringIO('FAKE'))
+
+@pytest.mark.parametrize(('name', 'ext'), CODEC_EXTENSIONS)
+def test_detect_data(tmp_dir, name, ext):
+    skip_unavailable(name)
+    path = os.path.join(tmp_dir, 'chunk.sc' + ext)
+    sis = [make_si(num) for num in range(5)]
+    with Chunk(path, mode='wb') as ch:
+        for si in sis:
+            ch.add(si)
+    data = open(path, 'rb').read()
+    assert list(Chunk(data=data)) == sis
+    assert list(Chunk(file_obj=open(path, 'rb'))) == sis
+
+def test_detect_pipe(tmp_dir):
+    skip_unavailable('zstd')
+    sis = [make_si(num) for num in range(5)]
+    path = os.path.join(tmp_dir, 'chunk')
+    with Chunk(file_obj=open(path, 'wb'), mode='wb', compression='zstd') as ch:
+        for si in sis:
+            ch.add(si)
+    data = open(path, 'rb').read()
+    assert codec_for_magic(data).name == 'zstd'
+    ## a pipe cannot seek back after the magic bytes are read
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, data)
+    os.close(write_fd)
+    assert list(Chunk(file_obj=os.fdopen(read_fd, 'rb'))) == sis
+
+def test_detect_uncompressed():
+    sis = [make_si(num) for num in range(5)]
+    ch = Chunk()
+    for si in sis:
+        ch.add(si)
+    ch.flush()
+    data = ch._o_chunk_fh._fh.getvalue()
+    assert list(Chunk(data=data)) == sis
+    assert list(Chunk(data=data, compression='none')) == sis
+
+@pytest.mark.skipif('not find_executable("gpg")')
+def test_detect_gpg_around_xz(tmp_dir, monkeypatch):
+    skip_unavailable('xz')
+    ## a throwaway keyring that gpg --decrypt finds by default
+    os.chmod(tmp_dir, 0700)
+    monkeypatch.setenv('GNUPGHOME', tmp_dir)
+    subprocess.check_call(['gpg', '--batch', '--quiet', '--passphrase', '',
+                           '--quick-gen-key', 'test@example.com', 'rsa1024', 'encr', 'never'])
+    path = os.path.join(tmp_dir, 'chunk.sc.xz')
+    sis = [make_si(num) for num in range(5)]
+    with Chunk(path, mode='wb') as ch:
+        for si in sis:
+            ch.add(si)
+    gpg_child = subprocess.Popen(
+        ['gpg', '--batch', '--quiet', '--trust-model', 'always',
+         '-r', 'test@example.com', '-z', '0', '--encrypt'],
+        stdin=open(path, 'rb'), stdout=subprocess.PIPE)
+    data = gpg_child.communicate()[0]
+    assert list(Chunk(data=data)) == sis
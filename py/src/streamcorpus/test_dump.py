@@ -1,7 +1,24 @@
 
 import os
+import uuid
+import shutil
+import tempfile
+import pytest
 import subprocess
 
+from . import make_stream_item, ContentItem, Chunk, StreamItem_v0_3_0
+from . import dump
+from .dump import _find, _map_files, _show_fields, _stats
+
+@pytest.fixture(scope='function')
+def tmp_dir(request):
+    path = '/tmp/test_dump-%s' % str(uuid.uuid4())
+    os.makedirs(path)
+    def fin():
+        shutil.rmtree(path, ignore_errors=True)
+    request.addfinalizer(fin)
+    return path
+
 def test_dump():
     path = os.path.join(os.path.dirname(__file__), '../../../test-data/john-smith-tagged-by-lingpipe-0-v0_3_0.sc')
     cmd = 'python -m streamcorpus.dump %s --field stream_id --len body.clean_visible --len body.raw' % path
@@ -12,3 +29,65 @@ def test_dump():
     assert len(output.splitlines()) == 197
 
     
+
+def test_find_many(tmp_dir, capsys):
+    paths = []
+    sis = []
+    for num_chunk in range(3):
+        path = os.path.join(tmp_dir, '%d.sc' % num_chunk)
+        with Chunk(path, mode='wb') as ch:
+            for num in range(5):
+                si = make_stream_item(num_chunk * 5 + num, 'http://example.com/%d' % num)
+                si.body = ContentItem(raw='hello %d %d' % (num_chunk, num))
+                ch.add(si)
+                sis.append(si)
+        paths.append(path)
+    dump.message_class = StreamItem_v0_3_0
+    _find(paths, [sis[1].stream_id, sis[13].stream_id])
+    out, err = capsys.readouterr()
+    assert out.splitlines() == ['hello 0 1', 'hello 2 3']
+
+    with pytest.raises(SystemExit) as exc:
+        _find(paths, [sis[7].stream_id, 'not-a-stream-id'])
+    assert 'Did not find not-a-stream-id' in str(exc.value)
+    out, err = capsys.readouterr()
+    assert out.splitlines() == ['hello 1 2']
+
+def make_chunks(tmp_dir, num_chunks):
+    paths = []
+    for num_chunk in range(num_chunks):
+        path = os.path.join(tmp_dir, '%d.sc' % num_chunk)
+        with Chunk(path, mode='wb') as ch:
+            for num in range(num_chunk + 1):
+                si = make_stream_item(num, 'http://example.com/%d/%d' % (num_chunk, num))
+                si.body = ContentItem(raw='hello', clean_visible='hello')
+                ch.add(si)
+        paths.append(path)
+    return paths
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_map_files(tmp_dir, capsys, monkeypatch, jobs):
+    paths = make_chunks(tmp_dir, 5)
+    dump.message_class = StreamItem_v0_3_0
+    results = list(_map_files(jobs, _show_fields, paths, ['stream_id'], []))
+    assert results == [None] * 5
+    out, err = capsys.readouterr()
+    expected = []
+    for path in paths:
+        expected.extend('stream_id: %s' % si.stream_id for si in Chunk(path))
+    assert out.splitlines() == expected
+
+    ## output beyond MAX_BUFFERED_OUTPUT is spooled to a file
+    spool_dir = os.path.join(tmp_dir, 'spool')
+    os.makedirs(spool_dir)
+    monkeypatch.setattr(dump, 'MAX_BUFFERED_OUTPUT', 10)
+    monkeypatch.setattr(tempfile, 'tempdir', spool_dir)
+    list(_map_files(jobs, _show_fields, paths, ['stream_id'], []))
+    out, err = capsys.readouterr()
+    assert out.splitlines() == expected
+    assert os.listdir(spool_dir) == []
+
+    stats = list(_map_files(jobs, _stats, paths))
+    assert [c['stream_ids'] for c, labels in stats] == [1, 2, 3, 4, 5]
+    out, err = capsys.readouterr()
+    assert [line for line in out.splitlines() if not line.startswith('\t')] == paths
@@ -0,0 +1,179 @@
+import os
+import shutil
+import pytest
+import subprocess
+from distutils.spawn import find_executable
+from StringIO import StringIO
+
+from . import Chunk, GpgContext, \
+    compress_and_encrypt, decrypt_and_uncompress, compress_and_encrypt_path, compress_and_encrypt_file, decrypt_and_uncompress_file, iter_decrypt_and_uncompress
+from ._xz import subprocess_writer
+from . import conftest
+
+def make_si(num):
+    return conftest.make_si(num, raw='hello %d! ' % num * 100)
+
+@pytest.fixture(scope='function')
+def tmp_dir(request, tmp_dir):
+    'tmp_dir from conftest, private, and without the agent of make_keys'
+    os.chmod(tmp_dir, 0700)
+    def fin():
+        subprocess.call(['gpgconf', '--homedir', os.path.join(tmp_dir, 'keys'),
+                         '--kill', 'gpg-agent'])
+    request.addfinalizer(fin)
+    return tmp_dir
+
+def make_keys(tmp_dir):
+    '''
+    :returns (public, private): paths to the exported keys of a new
+    throwaway key pair for test@example.com
+    '''
+    key_dir = os.path.join(tmp_dir, 'keys')
+    os.makedirs(key_dir, 0700)
+    gpg = ['gpg', '--batch', '--quiet', '--homedir', key_dir]
+    subprocess.check_call(gpg + ['--passphrase', '', '--quick-gen-key',
+                                 'test@example.com', 'rsa1024', 'encr', 'never'])
+    paths = []
+    for name in ['export', 'export-secret-keys']:
+        path = os.path.join(tmp_dir, name)
+        subprocess.check_call(gpg + ['--output', path, '--' + name])
+        paths.append(path)
+    return paths
+
+def test_subprocess_writer():
+    fh = StringIO()
+    ## keep the value after subprocess_writer closes fh
+    fh.close = lambda: None
+    writer = subprocess_writer(['tr', 'a-z', 'A-Z'], fh)
+    writer.write('hello ' * 100000)
+    writer.close()
+    assert fh.getvalue() == 'HELLO ' * 100000
+
+def test_subprocess_writer_error():
+    writer = subprocess_writer('cat > /dev/null; exit 3', StringIO(), shell=True)
+    writer.write('hello')
+    with pytest.raises(IOError):
+        writer.close()
+
+@pytest.mark.skipif('not find_executable("gpg")')
+@pytest.mark.parametrize('ext', ['.sc.gpg', '.sc.xz.gpg'])
+def test_gpg_round_trip(tmp_dir, ext):
+    public, private = make_keys(tmp_dir)
+    sis = [make_si(num) for num in range(5)]
+    path = os.path.join(tmp_dir, 'chunk' + ext)
+    ## gpg-agent's socket in the home directory must have a short path,
+    ## so these are made in /tmp rather than tmp_dir
+    with GpgContext(gpg_public=public, recipient='test@example.com') as gpg:
+        with Chunk(path, mode='wb', gpg=gpg) as ch:
+            for si in sis:
+                ch.add(si)
+    assert 'hello' not in open(path, 'rb').read()
+
+    with GpgContext(gpg_private=private) as gpg:
+        homedir = gpg.homedir
+        ## the keys are imported once for any number of chunks
+        for _ in range(2):
+            assert list(Chunk(path, gpg=gpg)) == sis
+        assert list(Chunk(file_obj=open(path, 'rb'), gpg=gpg)) == sis
+    assert not os.path.exists(homedir)
+
+@pytest.mark.skipif('not find_executable("gpg")')
+def test_gpg_file_obj(tmp_dir):
+    public, private = make_keys(tmp_dir)
+    sis = [make_si(num) for num in range(5)]
+    path = os.path.join(tmp_dir, 'chunk.sc.xz.gpg')
+    with GpgContext(gpg_public=public, gpg_private=private,
+                    recipient='test@example.com') as gpg:
+        with Chunk(file_obj=open(path, 'wb'), mode='wb', compression='xz', gpg=gpg) as ch:
+            for si in sis:
+                ch.add(si)
+        ## compression is detected inside the encryption
+        assert list(Chunk(data=open(path, 'rb').read(), gpg=gpg)) == sis
+
+@pytest.mark.skipif('not find_executable("gpg")')
+def test_gpg_context_for_data(tmp_dir):
+    public, private = make_keys(tmp_dir)
+    sis = [make_si(num) for num in range(5)]
+    path = os.path.join(tmp_dir, 'chunk.sc')
+    with Chunk(path, mode='wb') as ch:
+        ch.add_many(sis)
+    data = open(path, 'rb').read()
+    with GpgContext(gpg_public=public, gpg_private=private,
+                    recipient='test@example.com') as gpg:
+        ## the keys are imported once for any number of calls
+        for _ in range(2):
+            errors, encrypted = compress_and_encrypt(data, gpg=gpg)
+            assert 'hello' not in encrypted
+            errors, decrypted = decrypt_and_uncompress(encrypted, gpg=gpg)
+            assert decrypted == data
+            errors, o_path = compress_and_encrypt_path(path, gpg=gpg)
+            assert decrypt_and_uncompress(open(o_path, 'rb').read(), gpg=gpg)[1] == data
+            shutil.rmtree(os.path.dirname(o_path))
+        assert os.path.exists(gpg.homedir)
+
+def test_gpg_needed_for_writing(tmp_dir):
+    with pytest.raises(Exception):
+        Chunk(os.path.join(tmp_dir, 'chunk.sc.xz.gpg'), mode='wb')
+
+@pytest.mark.skipif('not find_executable("gpg")')
+def test_encrypt_path_without_shell(tmp_dir, monkeypatch):
+    public, private = make_keys(tmp_dir)
+    sis = [make_si(num) for num in range(5)]
+    ## none of this is interpreted by a shell
+    path = os.path.join(tmp_dir, "it's a $(touch oops); chunk.sc")
+    with Chunk(path, mode='wb') as ch:
+        ch.add_many(sis)
+    errors, o_path = compress_and_encrypt_path(path, gpg_public=public,
+                                               gpg_recipient='test@example.com')
+    assert not [error for error in errors if 'exited' in error], errors
+    shutil.move(o_path, path + '.xz.gpg')
+    shutil.rmtree(os.path.dirname(o_path))
+    assert 'hello' not in open(path + '.xz.gpg', 'rb').read()
+
+    ## without gpg=, .xz.gpg is decrypted with the user's own keys
+    monkeypatch.setenv('GNUPGHOME', os.path.join(tmp_dir, 'keys'))
+    assert list(Chunk(path + '.xz.gpg')) == sis
+    assert not os.path.exists('oops')
+
+def test_compress_file_round_trip(tmp_dir):
+    sis = [make_si(num) for num in range(50)]
+    path = os.path.join(tmp_dir, 'chunk.sc.xz')
+    with Chunk(file_obj=compress_and_encrypt_file(open(path, 'wb')), mode='wb') as ch:
+        for si in sis:
+            ch.add(si)
+    assert list(Chunk(path)) == sis
+    fh = decrypt_and_uncompress_file(open(path, 'rb'))
+    assert list(Chunk(file_obj=fh)) == sis
+    fh.close()
+    blocks = list(iter_decrypt_and_uncompress(open(path, 'rb'), block_size=1000))
+    assert max(len(block) for block in blocks) == 1000
+    assert list(Chunk(data=''.join(blocks))) == sis
+
+@pytest.mark.skipif('not find_executable("gpg")')
+def test_encrypt_file_round_trip(tmp_dir):
+    public, private = make_keys(tmp_dir)
+    sis = [make_si(num) for num in range(50)]
+    path = os.path.join(tmp_dir, 'chunk.sc.xz.gpg')
+    o_fh = compress_and_encrypt_file(open(path, 'wb'), gpg_public=public,
+                                     gpg_recipient='test@example.com')
+    with Chunk(file_obj=o_fh, mode='wb') as ch:
+        for si in sis:
+            ch.add(si)
+    with GpgContext(gpg_private=private) as gpg:
+        assert list(Chunk(path, gpg=gpg)) == sis
+    ## a GpgContext made from gpg_private is removed by close
+    fh = decrypt_and_uncompress_file(open(path, 'rb'), gpg_private=private)
+    homedir = fh._closers[0].homedir
+    assert list(Chunk(file_obj=fh)) == sis
+    fh.close()
+    assert not os.path.exists(homedir)
+
+@pytest.mark.skipif('not find_executable("gpg")')
+def test_decrypt_file_error(tmp_dir):
+    path = os.path.join(tmp_dir, 'chunk.sc.xz.gpg')
+    open(path, 'wb').write('\x85not really encrypted')
+    with GpgContext() as gpg:
+        fh = decrypt_and_uncompress_file(open(path, 'rb'), gpg=gpg)
+        with pytest.raises(IOError):
+            fh.read()
+        fh.close()
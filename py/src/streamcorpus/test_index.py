@@ -0,0 +1,133 @@
+import os
+import pytest
+from cStringIO import StringIO
+
+from . import Chunk, ChunkIndex, Where, serialize
+from . import StreamItem_v0_2_0
+from _index import index_path
+from .conftest import make_si
+
+TEST_XZ_PATH = os.path.join(os.path.dirname(__file__), '../../../test-data/john-smith-tagged-by-lingpipe-0-v0_2_0.sc.xz')
+
+def test_index_written_on_close(path):
+    ch = Chunk(path=path, mode='wb', index=True)
+    for num in range(10):
+        ch.add(make_si(num))
+    ch.close()
+    assert os.path.exists(index_path(path))
+
+    index = ChunkIndex.from_sidecar(path)
+    assert len(index) == 10
+    assert index.end_offset == os.path.getsize(path)
+    data = open(path).read()
+    for offset, length, stream_id, doc_id in index:
+        assert stream_id in data[offset:offset + length]
+
+def test_get(path):
+    sis = [make_si(num) for num in range(10)]
+    with Chunk(path=path, mode='wb', index=True) as ch:
+        for si in sis:
+            ch.add(si)
+    ch = Chunk(path=path, mode='rb')
+    assert ch.get(sis[7].stream_id) == sis[7]
+    assert ch.get(sis[0].stream_id) == sis[0]
+    with pytest.raises(KeyError):
+        ch.get('not-a-stream-id')
+
+def test_get_without_sidecar(path):
+    sis = [make_si(num) for num in range(10)]
+    with Chunk(path=path, mode='wb') as ch:
+        for si in sis:
+            ch.add(si)
+    assert not os.path.exists(index_path(path))
+    ch = Chunk(path=path, mode='rb', index=True)
+    assert ch.get(sis[3].stream_id) == sis[3]
+    ## index=True saves the index built by scanning
+    assert os.path.exists(index_path(path))
+    assert len(ChunkIndex.from_sidecar(path)) == 10
+
+def test_append_extends_index(path):
+    with Chunk(path=path, mode='wb', index=True) as ch:
+        ch.add(make_si(1))
+    si = make_si(2)
+    with Chunk(path=path, mode='ab', index=True) as ch:
+        ch.add(si)
+    index = ChunkIndex.from_sidecar(path)
+    assert len(index) == 2
+    assert Chunk(path=path).get(si.stream_id) == si
+
+def test_stale_index_ignored(path):
+    with Chunk(path=path, mode='wb', index=True) as ch:
+        ch.add(make_si(1))
+    si = make_si(2)
+    ## appending without index=True leaves the sidecar stale
+    with Chunk(path=path, mode='ab') as ch:
+        ch.add(si)
+    assert Chunk(path=path).get(si.stream_id) == si
+
+def test_index_dump_load():
+    index = ChunkIndex()
+    index.add(0, 10, 'a', 'x')
+    index.add(10, 5, None, 'x')
+    fh = StringIO()
+    index.dump(fh)
+    index2 = ChunkIndex.load(StringIO(fh.getvalue()))
+    assert list(index2) == list(index)
+    assert index2.find_doc_id('x') == [(0, 10), (10, 5)]
+
+def test_get_xz():
+    ch = Chunk(TEST_XZ_PATH, message=StreamItem_v0_2_0)
+    offset, length, stream_id, doc_id = list(ch.index)[150]
+    ch = Chunk(TEST_XZ_PATH, message=StreamItem_v0_2_0)
+    si = ch.get(stream_id)
+    assert si.stream_id == stream_id
+    assert si.body.clean_visible
+
+def test_get_memory_map(path):
+    sis = [make_si(num) for num in range(10)]
+    with Chunk(path=path, mode='wb', index=True) as ch:
+        for si in sis:
+            ch.add(si)
+    ch = Chunk(path=path, mode='rb', memory_map=True)
+    assert ch.get(sis[4].stream_id) == sis[4]
+
+@pytest.mark.parametrize('ext', ['', '.xz'])
+@pytest.mark.parametrize('index', [False, True])
+def test_find_raw(path, ext, index):
+    sis = [make_si(num) for num in range(20)]
+    path += ext
+    with Chunk(path=path, mode='wb', index=index) as ch:
+        ch.add_many(sis)
+    wanted = [sis[12].stream_id, sis[3].stream_id, 'not-a-stream-id']
+    ch = Chunk(path=path)
+    assert list(ch.find_raw(wanted)) == \
+        [(sis[3].stream_id, serialize(sis[3])), (sis[12].stream_id, serialize(sis[12]))]
+    assert list(ch.find_raw([])) == []
+    ch = Chunk(path=path, where=Where(start_time=5))
+    assert list(ch.find_raw(wanted)) == [(sis[12].stream_id, serialize(sis[12]))]
+
+def test_find_raw_stops_early(path):
+    sis = [make_si(num) for num in range(20)]
+    with Chunk(path=path, mode='wb') as ch:
+        ch.add_many(sis)
+    ch = Chunk(path=path)
+    found = ch.find_raw([sis[2].stream_id, sis[4].stream_id])
+    assert [stream_id for stream_id, blob in found] == [sis[2].stream_id, sis[4].stream_id]
+    ## read up to the last one that was wanted
+    assert ch._count == 5
+
+def test_find_raw_trailer(path):
+    sis = [make_si(num) for num in range(20)]
+    ## stream_id need not follow stream_time
+    sis[5].stream_id = '5000-abc'
+    with Chunk(path=path, mode='wb', trailer=True) as ch:
+        ch.add_many(sis)
+    ch = Chunk(path=path)
+    assert [stream_id for stream_id, blob in ch.find_raw(['5000-abc', sis[19].stream_id])] == \
+        ['5000-abc', sis[19].stream_id]
+
+    os.remove(path)
+    with Chunk(path=path, mode='wb', trailer=True) as ch:
+        pass
+    ch = Chunk(path=path)
+    assert list(ch.find_raw(['5000-abc'])) == []
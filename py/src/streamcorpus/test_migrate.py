@@ -0,0 +1,58 @@
+import os
+import shutil
+
+from . import Chunk, StreamItem_v0_1_0, StreamItem_v0_2_0, StreamItem_v0_3_0
+from .test_upgrade import make_si_v0_1_0
+from .migrate import migrate_tree, read_manifest, find_chunks, MANIFEST_NAME
+
+TEST_XZ_PATH = os.path.join(os.path.dirname(__file__), '../../../test-data/john-smith-tagged-by-lingpipe-0-v0_2_0.sc.xz')
+
+def make_tree(input_dir):
+    os.makedirs(os.path.join(input_dir, '2012-01-01-00'))
+    shutil.copy(TEST_XZ_PATH, os.path.join(input_dir, '2012-01-01-00', 'john-smith.sc.xz'))
+    with Chunk(os.path.join(input_dir, '2012-01-01-00', 'old.sc.gz'), mode='wb',
+               message=StreamItem_v0_1_0) as ch:
+        for num in range(3):
+            ch.add(make_si_v0_1_0(num))
+    with Chunk(os.path.join(input_dir, 'plain.sc'), mode='wb',
+               message=StreamItem_v0_1_0) as ch:
+        ch.add(make_si_v0_1_0(4))
+    open(os.path.join(input_dir, 'README'), 'wb').write('not a chunk')
+
+def test_migrate_tree(tmp_dir):
+    input_dir = os.path.join(tmp_dir, 'input')
+    output_dir = os.path.join(tmp_dir, 'output')
+    make_tree(input_dir)
+    assert find_chunks(input_dir) == ['2012-01-01-00/john-smith.sc.xz',
+                                      '2012-01-01-00/old.sc.gz',
+                                      'plain.sc']
+    assert migrate_tree(input_dir, output_dir, processes=2,
+                        compression_level=1) == []
+
+    entries = read_manifest(os.path.join(output_dir, MANIFEST_NAME))
+    assert [(count, rel_path) for md5, count, rel_path in entries] == \
+        [(197, '2012-01-01-00/john-smith.sc.xz'),
+         (3, '2012-01-01-00/old.sc.gz'),
+         (1, 'plain.sc')]
+    assert not os.path.exists(os.path.join(output_dir, 'README'))
+    for md5, count, rel_path in entries:
+        ch = Chunk(os.path.join(output_dir, rel_path), message=StreamItem_v0_3_0)
+        assert len(list(ch)) == count
+        assert ch.md5_hexdigest == md5
+
+    old = list(Chunk(TEST_XZ_PATH, message=StreamItem_v0_2_0))
+    new = list(Chunk(os.path.join(output_dir, entries[0][2])))
+    assert [si.stream_id for si in new] == [si.stream_id for si in old]
+
+def test_migrate_compression_and_failures(tmp_dir):
+    input_dir = os.path.join(tmp_dir, 'input')
+    output_dir = os.path.join(tmp_dir, 'output')
+    make_tree(input_dir)
+    open(os.path.join(input_dir, 'broken.sc'), 'wb').write('\x08\x00\x01\x00\x00\x00\x63\x00')
+    failures = migrate_tree(input_dir, output_dir, processes=1, compression='none')
+    assert [rel_path for rel_path, error in failures] == ['broken.sc']
+    assert not os.path.exists(os.path.join(output_dir, 'broken.sc'))
+    entries = read_manifest(os.path.join(output_dir, MANIFEST_NAME))
+    assert [rel_path for md5, count, rel_path in entries] == \
+        ['2012-01-01-00/john-smith.sc', '2012-01-01-00/old.sc', 'plain.sc']
+    assert len(list(Chunk(os.path.join(output_dir, 'plain.sc')))) == 1
@@ -0,0 +1,67 @@
+import os
+import uuid
+import pytest
+
+from . import Chunk, ParallelChunkReader
+from . import StreamItem_v0_2_0
+from .conftest import make_si
+
+TEST_XZ_PATH = os.path.join(os.path.dirname(__file__), '../../../test-data/john-smith-tagged-by-lingpipe-0-v0_2_0.sc.xz')
+
+@pytest.fixture(scope='function')
+def paths(request):
+    paths = []
+    for part in range(3):
+        path = '/tmp/test_parallel-%s.sc' % str(uuid.uuid4())
+        with Chunk(path, mode='wb') as ch:
+            for num in range(part * 100, part * 100 + 100):
+                ch.add(make_si(num))
+        paths.append(path)
+    def fin():
+        for path in paths:
+            os.remove(path)
+    request.addfinalizer(fin)
+    return paths
+
+def get_stream_id(si):
+    return si.stream_id
+
+def odd_stream_ids(si):
+    if int(si.stream_id.split('-')[0]) % 2:
+        return si.stream_id
+
+def test_ordered(paths):
+    expected = [si for path in paths for si in Chunk(path)]
+    reader = ParallelChunkReader(paths, num_workers=2, batch_bytes=1000)
+    assert list(reader) == expected
+
+def test_unordered(paths):
+    expected = [si.stream_id for path in paths for si in Chunk(path)]
+    reader = ParallelChunkReader(paths, func=get_stream_id, ordered=False,
+                                 num_workers=2, max_in_flight=2, batch_bytes=1000)
+    assert sorted(reader) == sorted(expected)
+
+def test_func_filter(paths):
+    reader = ParallelChunkReader(paths, func=odd_stream_ids, num_workers=2, batch_bytes=1000)
+    assert len(list(reader)) == 150
+
+def test_fields(paths):
+    reader = ParallelChunkReader(paths, fields=['stream_id'], num_workers=2)
+    sis = list(reader)
+    assert len(sis) == 300
+    assert all(si.body is None for si in sis)
+
+def test_compressed():
+    reader = ParallelChunkReader(TEST_XZ_PATH, message=StreamItem_v0_2_0,
+                                 func=get_stream_id, num_workers=2, batch_bytes=2**20)
+    assert list(reader) == [si.stream_id for si in Chunk(TEST_XZ_PATH, message=StreamItem_v0_2_0)]
+
+def test_worker_error(paths):
+    reader = ParallelChunkReader(paths, message=StreamItem_v0_2_0, func=get_stream_id,
+                                 num_workers=2)
+    with pytest.raises(Exception):
+        list(reader)
+
+def test_unpicklable_func(paths):
+    with pytest.raises(Exception):
+        ParallelChunkReader(paths, func=lambda si: si)
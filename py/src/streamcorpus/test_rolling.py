@@ -0,0 +1,80 @@
+import os
+import pytest
+
+from . import Chunk, RollingChunkWriter, get_date_hour, \
+    StreamItem_v0_2_0
+import ttypes_v0_2_0
+from . import conftest
+
+def make_si(num):
+    ## two messages per hour
+    return conftest.make_si(num, epoch_ticks=1800 * num)
+
+def read_all(paths):
+    sis = []
+    for path in paths:
+        sis.extend(Chunk(path))
+    return sis
+
+def test_split_by_date_hour(tmp_dir):
+    sis = [make_si(num) for num in range(6)]
+    with RollingChunkWriter(tmp_dir, name='news', compression='none') as writer:
+        writer.add_many(sis)
+    assert len(writer.paths) == 3
+    assert read_all(writer.paths) == sis
+    for path in writer.paths:
+        ch = Chunk(path)
+        items = list(ch)
+        date_hour, fname = path.split('/')[-2:]
+        assert date_hour == get_date_hour(items[0])
+        assert fname == 'news-2-%s.sc' % ch.md5_hexdigest
+    ## no temporary files are left behind
+    assert sorted(os.listdir(tmp_dir)) == ['1970-01-01-00', '1970-01-01-01', '1970-01-01-02']
+
+def test_other_message_class(tmp_dir):
+    sis = []
+    for num in range(4):
+        si = make_si(num)
+        sis.append(StreamItem_v0_2_0(
+                stream_id=si.stream_id, doc_id=si.doc_id,
+                stream_time=ttypes_v0_2_0.StreamTime(
+                    epoch_ticks=si.stream_time.epoch_ticks,
+                    zulu_timestamp=si.stream_time.zulu_timestamp)))
+    sis[3].stream_time = None
+    with RollingChunkWriter(tmp_dir, compression='none', message=StreamItem_v0_2_0) as writer:
+        writer.add_many(sis)
+    assert [path.split('/')[-2] for path in writer.paths] == \
+        ['1970-01-01-00', '1970-01-01-01', 'no-date-hour']
+    assert [list(Chunk(path, message=StreamItem_v0_2_0)) for path in writer.paths] == \
+        [sis[:2], sis[2:3], sis[3:]]
+
+def test_split_by_count_and_bytes(tmp_dir):
+    sis = [make_si(num) for num in range(10)]
+    with RollingChunkWriter(tmp_dir, max_items=3, split_by_date_hour=False,
+                            compression='gzip') as writer:
+        writer.add_many(sis)
+    assert [len(list(Chunk(path))) for path in writer.paths] == [3, 3, 3, 1]
+    assert all(path.endswith('.sc.gz') for path in writer.paths)
+    assert read_all(writer.paths) == sis
+
+    with RollingChunkWriter(os.path.join(tmp_dir, 'bytes'), max_items=None,
+                            max_bytes=1, split_by_date_hour=False,
+                            compression='none') as writer:
+        writer.add_many(sis[:4])
+    ## every file is full after its first message
+    assert len(writer.paths) == 4
+    assert read_all(writer.paths) == sis[:4]
+
+def test_exception_discards(tmp_dir):
+    with pytest.raises(ZeroDivisionError):
+        with RollingChunkWriter(tmp_dir, compression='none') as writer:
+            writer.add(make_si(0))
+            1 / 0
+    assert writer.paths == []
+    assert os.listdir(tmp_dir) == []
+
+def test_chunk_kwargs(tmp_dir):
+    sis = [make_si(num) for num in range(4)]
+    with RollingChunkWriter(tmp_dir, compression='none', trailer=True) as writer:
+        writer.add_many(sis)
+    assert [len(Chunk(path)) for path in writer.paths] == [2, 2]
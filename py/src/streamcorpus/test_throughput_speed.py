@@ -4,6 +4,7 @@ import time
 ## this is a python thing that makes a byte-buffer look like a filehandle
 from cStringIO import StringIO
 from streamcorpus.ttypes import StreamItem
+from streamcorpus._chunk import read_all
 
 ## these are the thrift library components for reading and writing
 ## to/from files and file-like objects, such as wrapped byte buffers
@@ -36,21 +37,8 @@ class AugmentedStringIO(object):
     def readAll(self, sz):
         '''
         This method allows TBinaryProtocolAccelerated to actually function.
-
-        Copied from here
-        http://svn.apache.org/repos/asf/hive/trunk/service/lib/py/thrift/transport/TTransport.py
         '''
-        buff = ''
-        have = 0
-        while (have < sz):
-            chunk = self.read(sz-have)
-            have += len(chunk)
-            buff += chunk
-
-            if len(chunk) == 0:
-                raise EOFError()
-
-        return buff
+        return read_all(self.read, sz)
 
 
 def deserialize(filehandle, num_objects=1000):
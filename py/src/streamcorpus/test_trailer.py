@@ -0,0 +1,126 @@
+import os
+import hashlib
+import pytest
+from cStringIO import StringIO
+
+from thrift.transport import TTransport
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+
+from . import Chunk, ChunkIndex, ChunkTrailer, \
+    StreamItem, serialize, ChunkTruncatedError
+from _chunk import lzma
+from .conftest import make_si
+
+def write_chunk(path, sis, **kwargs):
+    with Chunk(path=path, mode='wb', trailer=True, **kwargs) as ch:
+        ch.add_many(sis)
+    return ch
+
+def test_trailer(path):
+    sis = [make_si(num) for num in range(10)]
+    write_chunk(path, sis)
+    ch = Chunk(path)
+    ## known without decoding any message
+    assert len(ch) == 10
+    trailer = ch.trailer
+    assert trailer.min_stream_time == 0
+    assert trailer.max_stream_time == 9
+    data = open(path).read()
+    assert trailer.checksum == 'md5'
+    assert trailer.hexdigest == hashlib.md5(data[:trailer.end_offset]).hexdigest()
+    assert ch.get_at(7) == sis[7]
+    assert ch.get_at(-1) == sis[-1]
+    assert list(ch) == sis
+    assert list(Chunk(path, check_truncation=True)) == sis
+    assert list(Chunk(path).iter_raw()) == list(Chunk(data=data).iter_raw())
+    assert len(Chunk(path, memory_map=True)) == 10
+    assert len(Chunk(data=data)) == 10
+
+def test_trailer_ignored_by_thrift(path):
+    sis = [make_si(num) for num in range(10)]
+    write_chunk(path, sis)
+    ## reading with plain thrift, as readers that predate trailers do,
+    ## stops with EOFError in front of the trailer
+    i_protocol = TBinaryProtocol(TTransport.TBufferedTransport(
+            TTransport.TFileObjectTransport(open(path, 'rb'))))
+    read = []
+    with pytest.raises(EOFError):
+        while True:
+            si = StreamItem()
+            si.read(i_protocol)
+            read.append(si)
+    assert read == sis
+
+@pytest.mark.skipif('lzma is None')
+def test_trailer_xz(path):
+    sis = [make_si(num) for num in range(10)]
+    write_chunk(path + '.xz', sis)
+    ch = Chunk(path + '.xz', check_truncation=True)
+    ## the trailer of a compressed chunk is found at its end
+    assert ch.trailer is None
+    assert list(ch) == sis
+    assert len(ch.trailer) == 10
+    assert ch.get_at(3) == sis[3]
+
+def test_trailer_append(path):
+    sis = [make_si(num) for num in range(10)]
+    write_chunk(path, sis[:5])
+    with Chunk(path, mode='ab', trailer=True) as ch:
+        ch.add_many(sis[5:8])
+    ch = Chunk(path, check_truncation=True)
+    assert len(ch) == 8
+    assert ch.trailer.hexdigest is None
+    assert ch.get_at(6) == sis[6]
+    assert list(ch) == sis[:8]
+
+    ## appending without a trailer removes it
+    with Chunk(path, mode='ab') as ch:
+        ch.add_many(sis[8:])
+    ch = Chunk(path, check_truncation=True)
+    assert ch.trailer is None
+    assert list(ch) == sis
+
+def test_trailer_add_raw_and_index(path):
+    sis = [make_si(num) for num in range(10)]
+    with Chunk(path, mode='wb', trailer=True, index=True) as ch:
+        for si in sis:
+            ch.add_raw(serialize(si))
+    ch = Chunk(path)
+    assert ch.trailer.offsets == [offset for offset, _, _, _ in ChunkIndex.from_sidecar(path)]
+    assert ch.trailer.max_stream_time == 9
+    ## the sidecar is still current
+    assert ch.get(sis[2].stream_id) == sis[2]
+
+def test_trailer_concatenated(path):
+    sis = [make_si(num) for num in range(6)]
+    ## like cat a.sc b.sc c.sc > path
+    data = ''
+    for part in [sis[:3], [], sis[3:]]:
+        write_chunk(path, part)
+        data += open(path, 'rb').read()
+        os.remove(path)
+    open(path, 'wb').write(data)
+    for kwargs in [dict(data=data), dict(path=path), dict(path=path, memory_map=True)]:
+        ch = Chunk(check_truncation=True, **kwargs)
+        ## the last trailer only covers the last chunk
+        assert ch.trailer is None
+        assert list(ch) == sis
+        assert ch.trailer is None
+        assert len(ch) == 6
+        assert list(Chunk(**kwargs).iter_raw()) == [serialize(si) for si in sis]
+        assert Chunk(**kwargs).get(sis[4].stream_id) == sis[4]
+    ## the trailers in between are checked too
+    with pytest.raises(ChunkTruncatedError):
+        list(Chunk(data=data[:len(serialize(sis[0]))] + data[2 * len(serialize(sis[0])):],
+                   check_truncation=True))
+
+def test_trailer_loads_errors():
+    trailer = ChunkTrailer()
+    trailer.add(0, 10, 5.0)
+    data = trailer.dumps()
+    assert ChunkTrailer.loads(data).offsets == [0]
+    with pytest.raises(ValueError):
+        ChunkTrailer.loads(data[:-1])
+    with pytest.raises(ValueError):
+        ChunkTrailer.loads('not a trailer')
+    assert ChunkTrailer.from_data('no trailer here') is None
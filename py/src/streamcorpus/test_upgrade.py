@@ -0,0 +1,110 @@
+import os
+
+from . import Chunk, StreamItem_v0_1_0, StreamItem_v0_2_0, StreamItem_v0_3_0, \
+    Versions, RelationType, EntityType, MentionType, Gender, AttributeType, \
+    upgrade_stream_item
+import ttypes_v0_1_0
+import ttypes_v0_2_0
+
+TEST_XZ_PATH = os.path.join(os.path.dirname(__file__), '../../../test-data/john-smith-tagged-by-lingpipe-0-v0_2_0.sc.xz')
+
+def make_si_v0_1_0(num):
+    return StreamItem_v0_1_0(
+        doc_id='doc-%d' % num,
+        abs_url='http://example.com/%d' % num,
+        source='news',
+        body=ttypes_v0_1_0.ContentItem(raw='<p>hello</p>', encoding='utf-8',
+                                       cleansed='hello', ner='hello\tO'),
+        title=ttypes_v0_1_0.ContentItem(raw='title'),
+        source_metadata='metadata',
+        stream_id='1000-doc-%d' % num,
+        stream_time=ttypes_v0_1_0.StreamTime(epoch_ticks=1000.0,
+                                             zulu_timestamp='1970-01-01T00:16:40.000000Z'),
+        )
+
+def test_auto_detects_version():
+    sis = list(Chunk(TEST_XZ_PATH, message='auto'))
+    assert len(sis) == 197
+    assert isinstance(sis[0], StreamItem_v0_2_0)
+    assert Chunk(TEST_XZ_PATH, message='auto').get(sis[9].stream_id) == sis[9]
+
+def test_auto_v0_1_0(path):
+    with Chunk(path, mode='wb', message=StreamItem_v0_1_0) as ch:
+        ch.add(make_si_v0_1_0(1))
+    ch = Chunk(path, message='auto')
+    assert list(ch) == [make_si_v0_1_0(1)]
+    assert ch.message is StreamItem_v0_1_0
+
+def test_auto_empty(path):
+    Chunk(path, mode='wb').close()
+    assert list(Chunk(path, message='auto')) == []
+
+def test_upgrade_v0_2_0():
+    sis = list(Chunk(TEST_XZ_PATH, message=StreamItem_v0_2_0))
+    upgraded = list(Chunk(TEST_XZ_PATH, message='auto', upgrade=True))
+    assert len(upgraded) == len(sis)
+    for old, new in zip(sis, upgraded):
+        assert isinstance(new, StreamItem_v0_3_0)
+        assert new.version == Versions.v0_3_0
+        assert new.stream_id == old.stream_id
+        assert new.body.clean_visible == old.body.clean_visible
+        old_tokens = old.body.sentences['lingpipe'][0].tokens
+        new_tokens = new.body.sentences['lingpipe'][0].tokens
+        assert [t.mention_id for t in new_tokens] == [t.mention_id for t in old_tokens]
+    assert upgrade_stream_item(sis[3]) == upgraded[3]
+
+    ## v0_3_0 has no MALE_PRONOUN or FEMALE_PRONOUN
+    genders = {ttypes_v0_2_0.EntityType.MALE_PRONOUN: Gender.MALE,
+               ttypes_v0_2_0.EntityType.FEMALE_PRONOUN: Gender.FEMALE}
+    pronouns = 0
+    for old, new in zip(sis, upgraded):
+        attributes = dict(((attr.sentence_id, attr.mention_id), attr)
+                          for attr in new.body.attributes.get('lingpipe', []))
+        for sentence_id, (old_sentence, new_sentence) in enumerate(
+                zip(old.body.sentences['lingpipe'], new.body.sentences['lingpipe'])):
+            for old_token, new_token in zip(old_sentence.tokens, new_sentence.tokens):
+                assert new_token.entity_type in EntityType._VALUES_TO_NAMES \
+                    or new_token.entity_type is None
+                if old_token.entity_type not in genders:
+                    assert new_token.entity_type == old_token.entity_type
+                    continue
+                pronouns += 1
+                assert new_token.entity_type == EntityType.PER
+                assert new_token.mention_type == MentionType.PRO
+                attr = attributes[sentence_id, new_token.mention_id]
+                assert attr.attribute_type == AttributeType.PER_GENDER
+                assert attr.value == str(genders[old_token.entity_type])
+    assert pronouns == 2216
+
+def test_upgrade_fields():
+    upgraded = list(Chunk(TEST_XZ_PATH, message=StreamItem_v0_2_0, upgrade=True,
+                          fields=['stream_id']))
+    assert upgraded[0].stream_id
+    assert upgraded[0].body is None
+
+def test_upgrade_relations(path):
+    si = StreamItem_v0_2_0(stream_id='1-a', doc_id='a')
+    si.body = ttypes_v0_2_0.ContentItem(relations={'tagger': [
+                ttypes_v0_2_0.Relation(relation_name='PER-SOC.Lasting-Personal',
+                                       mention_id_1=3)]})
+    with Chunk(path, mode='wb', message=StreamItem_v0_2_0) as ch:
+        ch.add(si)
+    new, = list(Chunk(path, message='auto', upgrade=True))
+    relation = new.body.relations['tagger'][0]
+    assert relation.relation_type == RelationType.PERSOC_LastingPersonal
+    assert relation.mention_id_1 == 3
+
+def test_upgrade_v0_1_0(path):
+    with Chunk(path, mode='wb', message=StreamItem_v0_1_0) as ch:
+        ch.add(make_si_v0_1_0(1))
+    new, = list(Chunk(path, message='auto', upgrade=True))
+    assert isinstance(new, StreamItem_v0_3_0)
+    assert new.stream_id == '1000-doc-1'
+    assert new.stream_time.epoch_ticks == 1000.0
+    assert new.body.raw == '<p>hello</p>'
+    assert new.body.clean_visible == 'hello'
+    assert new.body.taggings['stanford'].raw_tagging == 'hello\tO'
+    assert new.other_content['title'].raw == 'title'
+    assert new.source_metadata == {'kba-2012': 'metadata'}
+    ## upgraded items can be written as v0_3_0
+    assert upgrade_stream_item(make_si_v0_1_0(1)) == new
@@ -0,0 +1,79 @@
+import pytest
+
+from . import Chunk, Where, serialize, \
+    VersionMismatchError, StreamItem_v0_1_0
+from . import conftest
+
+def make_si(num):
+    si = conftest.make_si(num, epoch_ticks=1000 + num)
+    si.source = ['news', 'social'][num % 2]
+    si.schost = 'example.com'
+    return si
+
+def write_chunk(path, sis, **kwargs):
+    with Chunk(path=path, mode='wb', **kwargs) as ch:
+        ch.add_many(sis)
+
+def test_where(path):
+    sis = [make_si(num) for num in range(10)]
+    write_chunk(path, sis)
+    def stream_ids(where):
+        return [si.stream_id for si in Chunk(path, where=where)]
+
+    assert stream_ids(Where(start_time=1003, end_time=1006)) == \
+        [si.stream_id for si in sis[3:6]]
+    assert stream_ids(Where(source='social', start_time=1004)) == \
+        [si.stream_id for si in sis[5::2]]
+    assert stream_ids(dict(source=['news', 'social'], schost='example.com')) == \
+        [si.stream_id for si in sis]
+    assert stream_ids(Where(stream_id_prefix=['1001-', '1007-'])) == \
+        [sis[1].stream_id, sis[7].stream_id]
+    assert stream_ids(Where(version=0)) == []
+    assert stream_ids(Where(schost='other.com')) == []
+
+    ## matching messages are decoded whole
+    assert list(Chunk(path, where=Where(end_time=1002))) == sis[:2]
+    assert list(Chunk(path, where=Where(end_time=1002), lazy=True)) == sis[:2]
+    ## only the messages that match are counted
+    ch = Chunk(path, where=Where(source='news'))
+    assert len(list(ch)) == len(ch) == 5
+    ch = Chunk(path, where=Where(source='news'))
+    assert list(ch.iter_raw()) == [serialize(si) for si in sis[::2]]
+    assert len(ch) == 5
+    assert [si.source for si, blob in ch.iter_raw(fields=['doc_id'])] == ['news'] * 5
+
+def test_where_with_fields(path):
+    sis = [make_si(num) for num in range(4)]
+    write_chunk(path, sis)
+    found = list(Chunk(path, fields=['stream_id'], where=Where(source='news')))
+    assert [si.stream_id for si in found] == [sis[0].stream_id, sis[2].stream_id]
+    assert found[0].body is None
+
+def test_where_unknown_field(path):
+    write_chunk(path, [make_si(0)])
+    with pytest.raises(ValueError):
+        list(Chunk(path, message=StreamItem_v0_1_0, verify_version=False,
+                   where=Where(version=1)))
+
+def test_where_check_truncation(path):
+    sis = [make_si(num) for num in range(10)]
+    write_chunk(path, sis, trailer=True)
+    ch = Chunk(path, where=Where(source='news'), check_truncation=True)
+    assert list(ch) == sis[::2]
+    ## the trailer counts every message, not just those that match
+    assert len(ch) == 5
+    assert list(ch.iter_raw()) == [serialize(si) for si in sis[::2]]
+
+def test_where_skips_by_trailer(path):
+    sis = [make_si(num) for num in range(5)]
+    write_chunk(path, sis, trailer=True)
+    ## give the first message version 99, so that reading it fails
+    data = open(path, 'rb').read()
+    assert data.startswith('\x08\x00\x01\x00\x00\x00\x01')
+    open(path, 'wb').write('\x08\x00\x01\x00\x00\x00\x63' + data[7:])
+    with pytest.raises(VersionMismatchError):
+        list(Chunk(path))
+    assert list(Chunk(path, where=Where(start_time=2000))) == []
+    assert list(Chunk(path, where=Where(end_time=500))) == []
+    with pytest.raises(VersionMismatchError):
+        list(Chunk(path, where=Where(start_time=1000)))
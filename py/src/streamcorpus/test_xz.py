@@ -0,0 +1,132 @@
+import os
+import uuid
+import pytest
+
+from . import Chunk, compress_and_encrypt
+from . import StreamItem_v0_2_0
+from streamcorpus import _xz
+from _xz import xz_blocks, subprocess_reader
+from _codecs import get_codec
+from . import conftest
+
+TEST_XZ_PATH = os.path.join(os.path.dirname(__file__), '../../../test-data/john-smith-tagged-by-lingpipe-0-v0_2_0.sc.xz')
+
+pytestmark = pytest.mark.skipif('not _xz.lzma')
+
+def open_xz(path, threads=1):
+    return get_codec('xz').reader(open(path, 'rb'), threads=threads)
+
+@pytest.fixture(scope='module')
+def multi_block_path(request):
+    path = '/tmp/test_xz-%s.sc.xz' % str(uuid.uuid4())
+    ## recompress the test data into blocks of 1MB
+    cmd = 'xz --decompress < %s | xz -0 --block-size=1MiB > %s' % (TEST_XZ_PATH, path)
+    if os.system(cmd) != 0:
+        pytest.skip('xz does not support --block-size')
+    def fin():
+        os.remove(path)
+    request.addfinalizer(fin)
+    return path
+
+def test_open_xz_in_process():
+    fh = open_xz(TEST_XZ_PATH)
+    assert not isinstance(fh._stream, subprocess_reader)
+    assert fh.read(10)
+    fh.close()
+
+def test_xz_blocks(multi_block_path):
+    blocks = xz_blocks(open(multi_block_path, 'rb'))
+    assert len(blocks) > 10
+    data = open_xz(multi_block_path).read()
+    assert sum(block[3] for block in blocks) == len(data)
+
+def test_block_parallel_read(multi_block_path):
+    expected = open_xz(multi_block_path).read()
+    fh = open_xz(multi_block_path, threads=4)
+    assert isinstance(fh._stream, _xz.xz_block_reader)
+    parts = []
+    while True:
+        data = fh.read(100000)
+        if not data:
+            break
+        parts.append(data)
+    assert ''.join(parts) == expected
+
+    fh.seek(3000000)
+    assert fh.read(5000) == expected[3000000:3005000]
+    fh.seek(10)
+    assert fh.read(10) == expected[10:20]
+    fh.close()
+
+def test_block_parallel_chunk(multi_block_path):
+    sis = list(Chunk(multi_block_path, message=StreamItem_v0_2_0, compression_threads=4))
+    assert len(sis) == 197
+    assert sis == list(Chunk(TEST_XZ_PATH, message=StreamItem_v0_2_0))
+
+def test_multi_stream():
+    ## two concatenated .xz streams
+    path = '/tmp/test_xz-%s.sc.xz' % str(uuid.uuid4())
+    data = open(TEST_XZ_PATH, 'rb').read()
+    with open(path, 'wb') as fh:
+        fh.write(data)
+        fh.write(data)
+    try:
+        assert len(xz_blocks(open(path, 'rb'))) == 2
+        assert len(list(Chunk(path, message=StreamItem_v0_2_0))) == 394
+        assert len(list(Chunk(path, message=StreamItem_v0_2_0, compression_threads=2))) == 394
+    finally:
+        os.remove(path)
+
+def test_subprocess_reader_reaped():
+    fh = subprocess_reader(['xzcat', TEST_XZ_PATH])
+    child = fh._child
+    while fh.read(2**20):
+        pass
+    assert child.returncode == 0
+
+def test_subprocess_reader_error():
+    fh = subprocess_reader(['xzcat', '/no/such/file.xz'])
+    with pytest.raises(IOError):
+        fh.read()
+
+def make_si(num):
+    return conftest.make_si(num, raw=os.urandom(1000).encode('hex'))
+
+def test_block_parallel_write():
+    path = '/tmp/test_xz-%s.sc.xz' % str(uuid.uuid4())
+    sis = [make_si(num) for num in range(300)]
+    try:
+        with Chunk(path, mode='wb', compression_threads=3, compression_block_size=50000) as ch:
+            for si in sis:
+                ch.add(si)
+        ## standard .xz that the xz tools can read
+        assert os.system('xz --test %s' % path) == 0
+        blocks = xz_blocks(open(path, 'rb'))
+        assert len(blocks) > 10
+        assert list(Chunk(path)) == sis
+        assert list(Chunk(path, compression_threads=3)) == sis
+
+        ## every block starts on a message boundary
+        data = open_xz(path).read()
+        starts = set(offset for offset, _, _, _ in Chunk(data=data).index)
+        offset = 0
+        for block in blocks:
+            assert offset in starts
+            offset += block[3]
+    finally:
+        os.remove(path)
+
+def test_block_writer_empty():
+    path = '/tmp/test_xz-%s.sc.xz' % str(uuid.uuid4())
+    try:
+        Chunk(path, mode='wb', compression_threads=2).close()
+        assert os.system('xz --test %s' % path) == 0
+        assert list(Chunk(path)) == []
+    finally:
+        os.remove(path)
+
+def test_compress_and_encrypt_threads():
+    data = os.urandom(100000).encode('hex')
+    errors, compressed = compress_and_encrypt(data, threads=2)
+    assert not errors
+    assert _xz.lzma.decompress(compressed) == data